@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+# Record several E4 wristbands from one process with asyncio.
+#
+# Every device gets its own connection to the E4 streaming server, performs
+# the same handshake as connect_device() and setup_subscribers() in
+# stream.py, and is written to its own directory:
+#   data/Empatica_E4_<subject ID>/<device ID>/{acc,bvp,gsr,ibi,hr,tmp}_data.csv
+# or in another format supported by storage.py.
+#
+# Usage:
+#   python async_recorder.py SUBJECT_ID [DEVICE_ID ...] [--duration SECONDS]
+# Without device IDs all devices in the server's device list are recorded.
+
+import argparse
+import asyncio
+import time
+from pathlib import Path
+
+from commands import CommandTimeout, PendingCommands, TIMEOUT, parse_reply
+from decoder import decode_lines
+from framing import LineFramer, split_connection_lost
+from storage import BACKENDS, Storage, TeeWriter
+from stream import BUFFER_SIZE, HOST, PORT, check_streaming_server_response
+
+
+# Subscription sent to the server -> streams it produces
+SUBSCRIPTIONS = {
+    "acc": ["acc"],
+    "bvp": ["bvp"],
+    "gsr": ["gsr"],
+    "ibi": ["ibi", "hr"],
+    "tmp": ["tmp"],
+}
+
+READ_SIZE = 16 * BUFFER_SIZE        # Bytes per read from a device connection
+
+
+class ConnectionLost(Exception):
+    # The server closed the connection or lost the device before the
+    # recording was stopped
+
+    def __init__(self, message, n_rows):
+        Exception.__init__(self, message)
+        self.n_rows = n_rows
+
+
+async def send_commands(reader, writer, commands, timeout = TIMEOUT):
+    # Send all commands at once and wait for their replies "R <command name> ...",
+    # matched as in commands.CommandChannel. Data lines received in between
+    # are ignored.
+    # Returns the list of replies in the order of commands.
+    # Args:
+    #   reader: asyncio.StreamReader
+    #   writer: asyncio.StreamWriter
+    #   commands: list of strings, without line terminator
+    pending = PendingCommands(commands)
+    writer.write("".join(command + "\r\n" for command in commands).encode())
+    await writer.drain()
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not pending.done():
+        try:
+            line = await asyncio.wait_for(reader.readline(), deadline - loop.time())
+        except asyncio.TimeoutError:
+            raise CommandTimeout("no reply to " + ", ".join(pending.missing()))
+        if not line:
+            raise ConnectionError("connection closed while waiting for " + ", ".join(pending.missing()))
+        fields = parse_reply(line.decode("utf-8"))
+        if fields is not None:
+            pending.match(fields)
+    return pending.replies
+
+
+async def send_command(reader, writer, command, timeout = TIMEOUT):
+    # Send one command and return its reply without line terminator
+    return (await send_commands(reader, writer, [command], timeout))[0]
+
+
+async def list_devices(host = HOST, port = PORT):
+    # Returns the IDs of the devices known to the streaming server
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        response = await send_command(reader, writer, "device_list")
+    finally:
+        writer.close()
+    # "R device_list 2 | 9ff167 Empatica_E4 | 7a3166 Empatica_E4"
+    return [device.split()[0] for device in response.split("|")[1:]]
+
+
+async def record_device(device_id, directory, subscriptions, backend = "csv", host = HOST, port = PORT,
+                        device_metrics = None, publisher = None, **policy):
+    # Connect to device_id, subscribe and write its data until cancelled.
+    # Returns the number of rows written.
+    # Raises ConnectionLost if the connection ends before that.
+    # Args:
+    #   device_id: string
+    #   directory: pathlib.Path, output directory of this device
+    #   subscriptions: list of strings, keys of SUBSCRIPTIONS
+    #   backend: string, one of storage.BACKENDS
+    #   device_metrics: metrics.DeviceMetrics, or None
+    #   publisher: publisher.Publisher the samples are also sent to, or None
+    #   policy: buffer sizes and intervals passed to storage.Storage
+    reader, writer = await asyncio.open_connection(host, port)
+    storage = None
+    n_rows = 0
+    try:
+        # Connect, pause and subscribe in one round trip
+        responses = await send_commands(reader, writer, ["device_connect " + device_id, "pause ON"] +
+                                        [f"device_subscribe {subscription} ON" for subscription in subscriptions])
+        if not check_streaming_server_response(responses[0]):
+            raise ConnectionError(f"failed to connect to device {device_id}: {responses[0]}")
+        for subscription, response in zip(subscriptions, responses[2:]):
+            if not check_streaming_server_response(response):
+                print(f"\t{device_id}: Failed to subscribe to {subscription.upper()}")
+
+        streams = [stream for subscription in subscriptions for stream in SUBSCRIPTIONS[subscription]]
+        storage = Storage(directory, streams, backend, **policy)
+        writers = storage.writers
+        if publisher is not None:
+            writers = {stream: TeeWriter(stream_writer, publisher.writer(device_id, stream))
+                       for stream, stream_writer in writers.items()}
+        writer.write("pause OFF\r\n".encode())
+        await writer.drain()
+        print(f"\t{device_id}: streaming")
+
+        framer = LineFramer()
+        while True:
+            data = await reader.read(READ_SIZE)
+            if not data:
+                raise ConnectionLost("connection closed by the streaming server", n_rows)
+            receive_ns = time.monotonic_ns()
+            framer.feed(data)
+            lines, lost = split_connection_lost(framer.lines())
+            decode_start = time.perf_counter()
+            rows, n_malformed = decode_lines(lines)
+            decode_seconds = time.perf_counter() - decode_start
+            counts = {}
+            for stream, row in rows:
+                stream_writer = writers.get(stream)
+                if stream_writer is not None:
+                    stream_writer.writerow(row)
+                counts[stream] = counts.get(stream, 0) + 1
+            n_rows += len(rows)
+            if device_metrics is not None:
+                device_metrics.add_bytes(len(data))
+                device_metrics.add_chunk(counts, n_malformed, decode_seconds, receive_ns)
+            if lost:
+                raise ConnectionLost("connection lost to device", n_rows)
+    except asyncio.CancelledError:
+        # Stopped by record(), close the files and report the rows written
+        pass
+    finally:
+        if storage is not None:
+            storage.close()
+        try:
+            writer.write("device_disconnect\r\n".encode())
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+    return n_rows
+
+
+async def record(subject_id, device_ids, subscriptions, duration = None, backend = "csv",
+                 host = HOST, port = PORT, data_dir = Path("./data"), metrics = None, publisher = None,
+                 **policy):
+    # Record all devices until duration seconds have passed, or forever.
+    # Data is saved under data_dir/Empatica_E4_<subject_id>/<device ID>/.
+    # The metrics of every device are recorded in metrics, a
+    # metrics.MetricsRegistry, if given, and the samples are also sent to
+    # publisher, a started publisher.Publisher, if given.
+    # Returns a dict of device ID -> number of rows written, or the exception
+    # that ended the recording of that device, e.g. ConnectionLost.
+    if not device_ids:
+        device_ids = await list_devices(host, port)
+    parent_dir = Path(data_dir).joinpath("Empatica_E4_" + subject_id)
+    tasks = [asyncio.create_task(record_device(device_id, parent_dir.joinpath(device_id),
+                                               subscriptions, backend, host, port,
+                                               metrics.device(device_id) if metrics is not None else None,
+                                               publisher, **policy))
+             for device_id in device_ids]
+    try:
+        done, pending = await asyncio.wait(tasks, timeout=duration)
+    finally:
+        for task in tasks:
+            task.cancel()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+    # A device stopped while still connecting has not written anything
+    return {device_id: 0 if isinstance(result, asyncio.CancelledError) else result
+            for device_id, result in zip(device_ids, results)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Record several Empatica E4 devices with asyncio.")
+    parser.add_argument("subject_id", help="data is saved under ./data/Empatica_E4_<subject_id>/")
+    parser.add_argument("devices", nargs="*", help="device IDs, default all devices of the server")
+    parser.add_argument("--duration", type=float, default=None, help="seconds to record, default until Ctrl+C")
+    parser.add_argument("--streams", default="acc,bvp,gsr,ibi,tmp", help="comma separated subscriptions")
+    parser.add_argument("--backend", default="csv", choices=sorted(BACKENDS), help="output format")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--publish", help="also send the samples to subscribers on tcp:HOST:PORT or unix:PATH")
+    args = parser.parse_args()
+
+    subscriptions = [stream.strip().lower() for stream in args.streams.split(",") if stream.strip()]
+    for subscription in subscriptions:
+        if subscription not in SUBSCRIPTIONS:
+            parser.error("unknown stream " + subscription)
+    devices = [device.upper() for device in args.devices]
+
+    publisher = None
+    if args.publish:
+        from publisher import Publisher
+        publisher = Publisher(args.publish)
+        publisher.start()
+        print(f"\tPublishing samples on {publisher.address}")
+    try:
+        results = asyncio.run(record(args.subject_id, devices, subscriptions,
+                                     args.duration, args.backend, args.host, args.port, publisher=publisher))
+    except KeyboardInterrupt:
+        return
+    finally:
+        if publisher is not None:
+            publisher.stop()
+    for device_id, result in results.items():
+        if isinstance(result, ConnectionLost):
+            result = f"{result}, {result.n_rows} rows"
+        elif not isinstance(result, Exception):
+            result = f"stopped, {result} rows"
+        print(f"\t{device_id}: {result}")
+
+
+if __name__ == "__main__":
+    main()
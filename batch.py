@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+# Batched decoding of E4 data lines into NumPy arrays.
+#
+# All lines received in one recv() are grouped per stream and converted
+# together, instead of building a Python list per sample. A group whose
+# lines do not all have the expected number of fields, or has acc values
+# that are not int16, is decoded line by line instead and its malformed
+# lines are counted. Needs numpy.
+#
+# Batch mode is not a faster decoder: parsing the numbers costs about the
+# same per line either way, so BlockDecoder is only 1.0-1.5x decode_lines
+# and slower for chunks below about 100 lines (see bench_decoder.py --batch;
+# np.fromstring per stream was slower still at these chunk sizes). The gain
+# is in the consumers. Decoding and writing blocks reaches 1.5-1.8x the
+# lines per second of rows with the npz backend from 400 lines per chunk
+# on, and 1.1-1.45x with csv and block_csv() from 100 lines on. The ring
+# buffers of ring_buffer.py and the acc features of features.py take blocks
+# vectorized. Below 100 lines per chunk rows are faster, but pipeline.py
+# decodes the chunks waiting in its queue together, so the chunks grow
+# when the writer falls behind.
+#
+# Arrays per stream:
+#   acc:                     timestamps float64 (n,), values int16 (n, 3)
+#   bvp, gsr, ibi, hr, tmp:  timestamps float64 (n,), values float32 (n,)
+
+import bisect
+import operator
+
+import numpy as np
+
+from decoder import DECODERS, decode_line
+
+
+# Number of values after the timestamp and their dtype, per stream
+VALUE_COLUMNS = {"acc": 3, "bvp": 1, "gsr": 1, "ibi": 1, "hr": 1, "tmp": 1}
+VALUE_DTYPES = {"acc": np.int16, "bvp": np.float32, "gsr": np.float32,
+                "ibi": np.float32, "hr": np.float32, "tmp": np.float32}
+
+# Characters at the start of a line that tell the tags apart, and
+# (tag, stream name, prefix) of every tag
+TAG_LENGTH = 6
+LINE_PREFIXES = [(tag, stream, (tag + " ")[:TAG_LENGTH]) for tag, (stream, _) in DECODERS.items()]
+_line_key = operator.itemgetter(slice(0, TAG_LENGTH))
+
+INT16_RANGE = (np.iinfo(np.int16).min, np.iinfo(np.int16).max)
+
+
+def _fits(stream, table):
+    # True if the values of every row of table can be stored as VALUE_DTYPES
+    # without changing them: whole numbers in the int16 range for acc
+    if VALUE_DTYPES[stream] is not np.int16:
+        return True
+    values = table[:, 1:]
+    return bool(((values >= INT16_RANGE[0]) & (values <= INT16_RANGE[1]) & (values == np.trunc(values))).all())
+
+
+class BlockDecoder(object):
+    # Decodes lists of lines into preallocated per-stream arrays.
+    # The arrays returned by decode() are views into buffers that are reused
+    # on the next call. Copy them if they have to be kept.
+
+    def __init__(self, capacity = 1024):
+        # Args:
+        #   capacity: initial number of samples per stream
+        self._timestamps = {}
+        self._values = {}
+        for stream in VALUE_COLUMNS:
+            self._allocate(stream, capacity)
+
+    def _allocate(self, stream, capacity):
+        shape = (capacity, 3) if VALUE_COLUMNS[stream] == 3 else (capacity,)
+        self._timestamps[stream] = np.empty(capacity, dtype=np.float64)
+        self._values[stream] = np.empty(shape, dtype=VALUE_DTYPES[stream])
+
+    def _reserve(self, stream, n_samples):
+        capacity = len(self._timestamps[stream])
+        if n_samples > capacity:
+            while capacity < n_samples:
+                capacity *= 2
+            self._allocate(stream, capacity)
+
+    def decode(self, lines):
+        # Decode a list of lines.
+        # Returns (blocks, n_malformed) where blocks maps stream name to
+        # (timestamps, values) for every stream present in lines.
+        # Args:
+        #   lines: list of strings
+        # A stable sort on the first TAG_LENGTH characters groups the lines
+        # per stream in their original order without a Python loop per line.
+        lines = sorted(lines, key=_line_key)
+        keys = list(map(_line_key, lines))
+        blocks = {}
+        n_malformed = 0
+        for tag, stream, prefix in LINE_PREFIXES:
+            start = bisect.bisect_left(keys, prefix)
+            end = bisect.bisect_right(keys, prefix, start)
+            if start == end:
+                continue
+            group = lines[start:end]
+            table = self._decode_fast(tag, stream, group)
+            if table is None:
+                # Fall back to decoding line by line, dropping malformed lines
+                table, n_bad = self._decode_slow(stream, group)
+                n_malformed += n_bad
+            if len(table):
+                blocks[stream] = self._store(stream, table)
+        return blocks, n_malformed
+
+    def _decode_fast(self, tag, stream, group):
+        # Returns the table of a group of lines, or None unless every line
+        # is the tag followed by exactly the expected number of valid fields
+        n_fields = VALUE_COLUMNS[stream] + 2
+        tokens = " ".join(group).replace(",", ".").split()
+        # A missing or extra field in any line moves the next line's tag
+        # away from its expected position
+        if len(tokens) != len(group) * n_fields or tokens[::n_fields] != [tag] * len(group):
+            return None
+        del tokens[::n_fields]
+        try:
+            table = np.array(tokens, dtype=np.float64).reshape(-1, n_fields - 1)
+        except ValueError:
+            return None
+        return table if _fits(stream, table) else None
+
+    def _decode_slow(self, stream, group):
+        rows = []
+        n_bad = 0
+        for line in group:
+            try:
+                decoded = decode_line(line)
+            except (ValueError, IndexError):
+                n_bad += 1
+                continue
+            if decoded is None or decoded[0] != stream:
+                # Not a data line of this stream, only shares the prefix
+                continue
+            row = np.array(decoded[1], dtype=np.float64)
+            if _fits(stream, row[np.newaxis]):
+                rows.append(row)
+            else:
+                n_bad += 1
+        table = np.array(rows, dtype=np.float64).reshape(-1, VALUE_COLUMNS[stream] + 1)
+        return table, n_bad
+
+    def _store(self, stream, table):
+        n_samples = len(table)
+        self._reserve(stream, n_samples)
+        timestamps = self._timestamps[stream][:n_samples]
+        values = self._values[stream][:n_samples]
+        timestamps[:] = table[:, 0]
+        if VALUE_COLUMNS[stream] == 3:
+            values[:] = table[:, 1:]
+        else:
+            values[:] = table[:, 1]
+        return timestamps, values
+
+
+def block_csv(stream, timestamps, values):
+    # Format a block as csv text, the same as csv.writer.writerows would for
+    # the rows written per sample by stream(), without building a Python
+    # list per row.
+    # Args:
+    #   stream: string, stream name
+    #   timestamps: np.ndarray
+    #   values: np.ndarray
+    if not len(timestamps):
+        return ""
+    # repr of the float64 timestamps is faster than astype(str) and gives the
+    # same text. float32 values need astype(str) for their shortest
+    # representation, repr of the float64 value would show the rounding.
+    if VALUE_COLUMNS[stream] == 3:
+        return "".join(map("%r,%d,%d,%d\r\n".__mod__, zip(timestamps.tolist(), *values.T.tolist())))
+    columns = zip(map(repr, timestamps.tolist()), values.astype(str).tolist())
+    return "\r\n".join(map(",".join, columns)) + "\r\n"
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+# Microbenchmark of decoder.decode_lines against the per-sample loop that
+# stream() used before, in lines per second.
+#
+# With --batch, also compares decode_lines with batch.BlockDecoder on chunks
+# of the sizes given with --chunk-lines (a recv() of BUFFER_SIZE bytes holds
+# about 100 lines), both decoding only and decoding and writing with the csv
+# and npz storage backends (requires numpy).
+#
+# Usage:
+#   python bench_decoder.py [--seconds N] [--repeat N] [--batch] [--chunk-lines N ...]
+
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+from bench_framing import synthetic_recording
+from decoder import decode_lines
+
+
+def legacy_decode(samples):
+    # The loop previously found in stream(), collecting rows instead of writing them
+    rows = []
+    for i in range(len(samples)):
+        stream_type = samples[i].split()[0]
+        if stream_type == "E4_Acc":
+            timestamp = float(samples[i].split()[1].replace(',','.'))
+            data = [int(samples[i].split()[2].replace(',','.')), int(samples[i].split()[3].replace(',','.')), int(samples[i].split()[4].replace(',','.'))]
+            rows.append(("acc", [timestamp] + data))
+
+        if stream_type == "E4_Bvp":
+            timestamp = float(samples[i].split()[1].replace(',','.'))
+            data = float(samples[i].split()[2].replace(',','.'))
+            rows.append(("bvp", [timestamp,data]))
+
+        if stream_type == "E4_Ibi":
+            timestamp = float(samples[i].split()[1].replace(',','.'))
+            data = float(samples[i].split()[2].replace(',','.'))
+            rows.append(("ibi", [timestamp,data]))
+
+        if stream_type == "E4_Hr":
+            timestamp = float(samples[i].split()[1].replace(',','.'))
+            data = float(samples[i].split()[2].replace(',','.'))
+            rows.append(("hr", [timestamp,data]))
+
+        if stream_type == "E4_Gsr":
+            timestamp = float(samples[i].split()[1].replace(',','.'))
+            data = float(samples[i].split()[2].replace(',','.'))
+            rows.append(("gsr", [timestamp,data]))
+
+        if stream_type == "E4_Temperature":
+            timestamp = float(samples[i].split()[1].replace(',','.'))
+            data = float(samples[i].split()[2].replace(',','.'))
+            rows.append(("tmp", [timestamp,data]))
+    return rows
+
+
+def best_rate(function, lines, repeat):
+    # Best lines per second out of repeat runs
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(lines)
+        best = min(best, time.perf_counter() - start)
+    return len(lines) / best
+
+
+def write_rows(chunk, writers, decoder = None):
+    rows, _ = decode_lines(chunk)
+    for stream, row in rows:
+        writers[stream].writerow(row)
+
+
+def write_blocks(chunk, writers, decoder):
+    blocks, _ = decoder.decode(chunk)
+    for stream, (timestamps, values) in blocks.items():
+        writers[stream].write_block(timestamps, values)
+
+
+def best_write_rate(function, chunks, backend, repeat):
+    # Best lines per second of decoding and writing all chunks out of repeat runs
+    from batch import BlockDecoder
+    from storage import CSV_HEADERS, Storage
+    best = float("inf")
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as directory:
+            storage = Storage(Path(directory), list(CSV_HEADERS), backend, index_interval=None)
+            decoder = BlockDecoder()
+            start = time.perf_counter()
+            for chunk in chunks:
+                function(chunk, storage.writers, decoder)
+            storage.close()
+            best = min(best, time.perf_counter() - start)
+    return sum(map(len, chunks)) / best
+
+
+def bench_batch(lines, chunk_sizes, repeat):
+    from batch import BlockDecoder
+    decoder = BlockDecoder()
+    print(f"{'chunk lines':>11}  {'decode_lines':>12}  {'BlockDecoder':>12}  "
+          f"{'csv rows':>10}  {'csv blocks':>10}  {'npz rows':>10}  {'npz blocks':>10}   lines/s")
+    for size in chunk_sizes:
+        chunks = [lines[i:i + size] for i in range(0, len(lines), size)]
+        rates = [best_rate(lambda _: [decode_lines(chunk) for chunk in chunks], lines, repeat),
+                 best_rate(lambda _: [decoder.decode(chunk) for chunk in chunks], lines, repeat)]
+        for backend in ["csv", "npz"]:
+            rates.append(best_write_rate(write_rows, chunks, backend, repeat))
+            rates.append(best_write_rate(write_blocks, chunks, backend, repeat))
+        print(f"{size:11d}  {rates[0]:12.0f}  {rates[1]:12.0f}  " + "  ".join(f"{rate:10.0f}" for rate in rates[2:]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark decoding of E4 data lines.")
+    parser.add_argument("--seconds", type=float, default=600, help="length of synthetic recording")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--batch", action="store_true", help="also benchmark batch.BlockDecoder")
+    parser.add_argument("--chunk-lines", type=int, nargs="+", default=[25, 100, 400, 2000],
+                        help="lines per chunk for --batch")
+    args = parser.parse_args()
+
+    lines = synthetic_recording(args.seconds).decode("utf-8").replace("\r", "").split("\n")
+    lines = [line for line in lines if line]
+
+    rows, n_malformed = decode_lines(lines)
+    if rows != legacy_decode(lines) or n_malformed:
+        raise SystemExit("ERROR: decoders disagree")
+
+    legacy = best_rate(legacy_decode, lines, args.repeat)
+    table = best_rate(decode_lines, lines, args.repeat)
+    print(f"{len(lines)} lines")
+    print(f"legacy loop:   {legacy:12.0f} lines/s")
+    print(f"decode_lines:  {table:12.0f} lines/s  ({table / legacy:.1f}x)")
+    if args.batch:
+        print()
+        bench_batch(lines, args.chunk_lines, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
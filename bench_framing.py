@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+# Throughput benchmark for framing.LineFramer.
+#
+# A recorded (or synthetic) E4 byte stream is cut at random boundaries and fed
+# through a fake socket. The benchmark checks that every sample comes out
+# intact and reports the framing throughput.
+#
+# Usage:
+#   python bench_framing.py [recording] [--seconds N] [--seed N]
+
+import argparse
+import random
+import time
+
+from framing import LineFramer
+
+
+class ChunkedSocket(object):
+    # Fake socket returning data in chunks of random size from recv_into
+
+    def __init__(self, data, max_chunk, seed):
+        self._data = memoryview(data)
+        self._pos = 0
+        self._max_chunk = max_chunk
+        self._random = random.Random(seed)
+
+    def recv_into(self, buffer):
+        chunk = min(len(buffer), self._random.randint(1, self._max_chunk), len(self._data) - self._pos)
+        buffer[:chunk] = self._data[self._pos:self._pos + chunk]
+        self._pos += chunk
+        return chunk
+
+
+def synthetic_recording(seconds, seed = 0):
+    # Create a byte stream resembling the E4 streaming server output.
+    # Uses the server's comma decimal separator.
+    # Args:
+    #   seconds: float, length of the recording
+    rnd = random.Random(seed)
+    streams = [("E4_Acc", 32), ("E4_Bvp", 64), ("E4_Gsr", 4), ("E4_Temperature", 4), ("E4_Ibi", 1), ("E4_Hr", 1)]
+    lines = []
+    t0 = 1600000000.0
+    for stream_type, rate in streams:
+        for i in range(int(seconds * rate)):
+            timestamp = ("%.3f" % (t0 + i / rate)).replace(".", ",")
+            if stream_type == "E4_Acc":
+                values = " ".join(str(rnd.randint(-128, 127)) for _ in range(3))
+            else:
+                values = ("%.6f" % rnd.uniform(-100, 100)).replace(".", ",")
+            lines.append(stream_type + " " + timestamp + " " + values + "\r\n")
+    rnd.shuffle(lines)
+    return "".join(lines).encode("utf-8")
+
+
+def run(data, max_chunk, seed):
+    expected = [line for line in data.decode("utf-8").replace("\r", "").split("\n") if line]
+    sock = ChunkedSocket(data, max_chunk, seed)
+    framer = LineFramer()
+    received = []
+
+    start = time.perf_counter()
+    while framer.recv_from(sock, max_chunk):
+        received.extend(framer.lines())
+    elapsed = time.perf_counter() - start
+
+    lost = len(expected) - len(received)
+    corrupted = sum(1 for a, b in zip(expected, received) if a != b)
+    return elapsed, len(received), lost, corrupted
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark framing of the E4 byte stream.")
+    parser.add_argument("recording", nargs="?", help="file with recorded server output")
+    parser.add_argument("--seconds", type=float, default=600, help="length of synthetic recording")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.recording:
+        with open(args.recording, "rb") as f:
+            data = f.read()
+    else:
+        data = synthetic_recording(args.seconds, args.seed)
+
+    print(f"{len(data)} bytes")
+    failed = False
+    for max_chunk in (16, 512, 4096, 65536):
+        elapsed, n_lines, lost, corrupted = run(data, max_chunk, args.seed)
+        print(f"max chunk {max_chunk:6d}: {n_lines / elapsed:12.0f} lines/s "
+              f"{len(data) / elapsed / 1e6:8.1f} MB/s  lost {lost}  corrupted {corrupted}")
+        failed = failed or lost or corrupted
+
+    if failed:
+        raise SystemExit("ERROR: samples were lost or corrupted")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+# End-to-end benchmark of the recorder against mock_server.py.
+#
+# Starts a mock E4 streaming server in-process, records from every device
+# for a fixed duration and reports sustained samples per second, the
+# latency from the server's sample timestamp to the row being written
+# (pipeline engine only) and, for both engines, the writer lag from
+# receiving a chunk to having written it, as recorded in metrics.DeviceMetrics.
+#
+# Engines:
+#   pipeline: one pipeline.StreamPipeline (reader + writer threads) per device
+#   async:    async_recorder.record with one event loop for all devices
+#
+# Usage:
+#   python bench_recorder.py [--devices N] [--rate-scale X] [--duration S] [--engine pipeline|async]
+# Options of mock_server.py after "--" are passed on to the server, e.g.
+#   -- --send-buffer 4096 --client-timeout 0.1
+# to drop the lines a recorder that falls behind cannot take.
+
+import argparse
+import asyncio
+import shutil
+import socket
+import tempfile
+import time
+from pathlib import Path
+
+import mock_server
+from metrics import Histogram, LAG_BUCKETS, MetricsRegistry
+from storage import Storage
+
+
+STREAM_NAMES = ["acc", "bvp", "gsr", "ibi", "hr", "tmp"]
+
+
+class LatencyWriter(object):
+    # Storage writer wrapper recording the delay between a sample's server
+    # timestamp and the moment it is written
+
+    def __init__(self, writer = None):
+        self.writer = writer
+        self.rows = 0
+        self.latencies = []
+
+    def writerow(self, row):
+        self.rows += 1
+        if self.rows % 16 == 0:
+            self.latencies.append(time.time() - row[0])
+        if self.writer is not None:
+            self.writer.writerow(row)
+
+    def write_block(self, timestamps, values):
+        self.rows += len(timestamps)
+        self.latencies.append(time.time() - float(timestamps[-1]))
+        if self.writer is not None:
+            self.writer.write_block(timestamps, values)
+
+
+def command(sock, text, timeout = 5):
+    # Send a command and wait for its "R <command>" reply
+    sock.settimeout(timeout)
+    sock.sendall((text + "\r\n").encode())
+    name = text.split()[0]
+    buffer = b""
+    while True:
+        data = sock.recv(4096)
+        if not data:
+            raise ConnectionError("connection closed")
+        buffer += data
+        for line in buffer.decode("utf-8").splitlines():
+            fields = line.split()
+            if len(fields) > 1 and fields[0] == "R" and fields[1] == name:
+                return line
+
+
+def run_pipeline(port, devices, duration, output, batch_mode, n_writers, registry):
+    from pipeline import StreamPipeline
+
+    streaming = [True]
+    pipelines = []
+    writers = []
+    storages = []
+    for device in devices:
+        sock = socket.create_connection(("127.0.0.1", port))
+        command(sock, "device_connect " + device)
+        command(sock, "pause ON")
+        for subscription in ["acc", "bvp", "gsr", "ibi", "tmp"]:
+            command(sock, "device_subscribe %s ON" % subscription)
+        storage = Storage(output.joinpath(device), STREAM_NAMES) if output else None
+        device_writers = {name: LatencyWriter(storage.writers[name] if storage else None)
+                          for name in STREAM_NAMES}
+        pipeline = StreamPipeline(sock, device_writers, lambda: streaming[0], n_writers=n_writers,
+                                  batch_mode=batch_mode, device_metrics=registry.device(device))
+        sock.sendall(b"pause OFF\r\n")
+        pipeline.start()
+        pipelines.append(pipeline)
+        writers += device_writers.values()
+        if storage:
+            storages.append(storage)
+
+    time.sleep(duration)
+    streaming[0] = False
+    dropped = 0
+    for pipeline in pipelines:
+        pipeline.join()
+        pipeline.sock.close()
+        dropped += pipeline.metrics.dropped_lines
+    for storage in storages:
+        storage.close()
+
+    latencies = sorted(latency for writer in writers for latency in writer.latencies)
+    return sum(writer.rows for writer in writers), latencies, dropped
+
+
+def run_async(port, devices, duration, output, registry):
+    import async_recorder
+    directory = output or Path(tempfile.mkdtemp())
+    asyncio.run(async_recorder.record("bench", devices, ["acc", "bvp", "gsr", "ibi", "tmp"], duration,
+                                      host="127.0.0.1", port=port, data_dir=directory, metrics=registry))
+    rows = 0
+    for path in directory.glob("Empatica_E4_bench/*/*_data.csv"):
+        with open(path) as f:
+            rows += sum(1 for _ in f) - 1
+    if output is None:
+        shutil.rmtree(directory)
+    return rows, [], 0
+
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def writer_lag(registry):
+    # Writer lag histogram of all devices in registry
+    histogram = Histogram(LAG_BUCKETS)
+    for device_metrics in registry.devices.values():
+        lag = device_metrics.writer_lag_seconds
+        histogram.counts = [a + b for a, b in zip(histogram.counts, lag.counts)]
+        histogram.count += lag.count
+        histogram.sum += lag.sum
+    return histogram
+
+
+def format_bound(seconds):
+    return "<%g" % (seconds * 1000) if seconds is not None else "-"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the recorder against the mock E4 server.")
+    parser.add_argument("--devices", type=int, default=4)
+    parser.add_argument("--rate-scale", type=float, default=10.0)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--engine", choices=["pipeline", "async"], default="pipeline")
+    parser.add_argument("--batch", action="store_true", help="decode in batch mode (requires numpy)")
+    parser.add_argument("--writers", type=int, default=1, help="writer threads per device")
+    parser.add_argument("--output", help="also write csv files to this directory")
+    parser.add_argument("server_args", nargs=argparse.REMAINDER, help="options for mock_server.py after --")
+    args = parser.parse_args()
+
+    server_args = [arg for arg in args.server_args if arg != "--"]
+    options = mock_server.parse_args(server_args + ["--devices", str(args.devices),
+                                                    "--rate-scale", str(args.rate_scale)])
+    server = mock_server.MockE4Server(options, port=0)
+    server.start()
+    port = server.server_address[1]
+    output = Path(args.output) if args.output else None
+
+    registry = MetricsRegistry()
+    start = time.perf_counter()
+    if args.engine == "pipeline":
+        rows, latencies, dropped = run_pipeline(port, server.devices, args.duration, output,
+                                                args.batch, args.writers, registry)
+    else:
+        rows, latencies, dropped = run_async(port, server.devices, args.duration, output, registry)
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+    server.server_close()
+
+    expected = sum(rate for streams in mock_server.STREAMS.values() for _, rate, _ in streams)
+    print(f"{args.devices} devices, {expected * args.rate_scale:.0f} samples/s per device offered")
+    print(f"lines sent by server:  {server.lines_sent}")
+    print(f"rows written:          {rows}  ({rows / elapsed:.0f} samples/s)")
+    print(f"dropped by server:     {server.lines_dropped}")
+    print(f"dropped by pipeline:   {dropped}")
+    if latencies:
+        print(f"latency ms:            p50 {percentile(latencies, 0.5) * 1000:.1f}  "
+              f"p99 {percentile(latencies, 0.99) * 1000:.1f}  max {latencies[-1] * 1000:.1f}")
+    lag = writer_lag(registry)
+    if lag.count:
+        print(f"writer lag ms:         p50 {format_bound(lag.quantile(0.5))}  "
+              f"p99 {format_bound(lag.quantile(0.99))}  mean {lag.sum / lag.count * 1000:.2f}")
+
+
+if __name__ == "__main__":
+    main()
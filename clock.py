@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+# Receive clock and drift correction of the E4 timestamps.
+#
+# The E4 streaming server stamps every sample with its own clock, and the
+# samples reach us in bursts. For every received batch the recorder notes
+# time.monotonic_ns() and the newest server timestamp of each stream in it.
+# A DriftEstimator per stream fits a linear map from server time to the
+# local monotonic clock, giving the clock offset and drift, so the samples of
+# several devices can be put on one corrected timeline.
+#
+# A batch arrives some unknown delay after its newest sample was taken: the
+# network, the server's buffering and, for the 4 Hz streams, up to 250 ms of
+# waiting for the next sample. Delays are never negative, so only the
+# observation with the smallest delay in every ENVELOPE_WINDOW seconds of
+# server time is fitted (the lower envelope). Older envelope points lose
+# weight with the server time passed, FORGETTING_TIME, so the fit follows
+# drift that changes with temperature. The drift is only reported once the
+# envelope spans MIN_SPAN seconds and its standard error is below
+# MAX_DRIFT_ERROR; before that the fit is an offset only.
+#
+# The work is done once per batch and stream, not per sample.
+# ClockRecorder writes every observation to clock_data.csv:
+#   receive_ns:  time.monotonic_ns() when the batch was received
+#   stream:      stream name
+#   timestamp:   newest server timestamp of the stream in the batch
+#   samples:     number of samples of the stream in the batch
+#   corrected_ns: timestamp mapped to the monotonic clock by the current fit
+#                of the stream
+#   drift_ppm:   drift of the server clock against the monotonic clock,
+#                empty (no drift) until it is known, see above
+# Any timestamp t of a stream can be corrected with the fit of the nearest
+# row of that stream: corrected_ns + (t - timestamp) * (1 + drift_ppm / 1e6) * 1e9
+
+import csv
+import math
+import threading
+
+from storage import DurableFile, FILE_BUFFER_SIZE, FLUSH_INTERVAL, FSYNC_INTERVAL
+
+
+ENVELOPE_WINDOW = 5.0       # Seconds of server time per lower envelope point
+FORGETTING_TIME = 600.0     # Seconds of server time after which a point keeps 1/e of its weight
+MIN_SPAN = 60.0             # Seconds of server time the envelope spans before a drift is reported
+MAX_DRIFT_ERROR = 5.0       # Standard error in ppm below which a drift is reported
+
+
+class DriftEstimator(object):
+    # Weighted least squares fit of
+    #   receive time - server time = offset + drift * server time
+    # to the lower envelope of the observations of one stream, updated with
+    # weighted running means and co-moments, which stay precise over long
+    # recordings. Values are taken relative to the first observation.
+
+    def __init__(self, window = ENVELOPE_WINDOW, forgetting_time = FORGETTING_TIME, min_span = MIN_SPAN,
+                 max_drift_error = MAX_DRIFT_ERROR):
+        self.window = window
+        self.forgetting_time = forgetting_time
+        self.min_span = min_span
+        self.max_drift_error = max_drift_error
+        self.n_observations = 0
+        self.n_points = 0           # Envelope points in the fit
+        self._x0 = None
+        self._y0 = None
+        self._window_start = None
+        self._best = None           # (x, delay) with the smallest delay y - x in the current window
+        self._first_x = None        # x of the first and the last envelope point
+        self._last_x = None
+        self._w = self._mean_x = self._mean_d = self._cxx = self._cxd = self._cdd = 0.0
+
+    def add(self, server_time, receive_ns):
+        # Args:
+        #   server_time: float, seconds of the server clock
+        #   receive_ns: int, time.monotonic_ns() when it was received
+        if self._x0 is None:
+            self._x0 = server_time
+            self._y0 = receive_ns
+        x = server_time - self._x0
+        d = (receive_ns - self._y0) / 1e9 - x
+        self.n_observations += 1
+        if self._window_start is None:
+            self._window_start = x
+        elif x - self._window_start >= self.window:
+            self._add_point(*self._best)
+            self._window_start = x
+            self._best = None
+        if self._best is None or d < self._best[1]:
+            self._best = (x, d)
+
+    def _add_point(self, x, d):
+        if self._last_x is not None:
+            f = math.exp(-max(x - self._last_x, 0.0) / self.forgetting_time)
+            self._w *= f
+            self._cxx *= f
+            self._cxd *= f
+            self._cdd *= f
+        else:
+            self._first_x = x
+        self._last_x = x
+        self._w += 1.0
+        dx = x - self._mean_x
+        dd = d - self._mean_d
+        self._mean_x += dx / self._w
+        self._mean_d += dd / self._w
+        self._cxx += dx * (x - self._mean_x)
+        self._cxd += dx * (d - self._mean_d)
+        self._cdd += dd * (d - self._mean_d)
+        self.n_points += 1
+
+    def span(self):
+        # Seconds of server time between the first and the last envelope point
+        return self._last_x - self._first_x if self._last_x is not None else 0.0
+
+    def drift_error(self):
+        # Standard error of the drift in ppm, None with too few points
+        if self._w <= 2.0 or self._cxx <= 0:
+            return None
+        residual = max(self._cdd - self._cxd * self._cxd / self._cxx, 0.0)
+        return math.sqrt(residual / (self._w - 2.0) / self._cxx) * 1e6
+
+    def drift_ppm(self):
+        # Returns the drift, None until the envelope spans min_span seconds
+        # and the drift is known to max_drift_error
+        if self.span() < self.min_span:
+            return None
+        error = self.drift_error()
+        if error is None or error > self.max_drift_error:
+            return None
+        return self._cxd / self._cxx * 1e6
+
+    def fit(self):
+        # Returns (intercept, slope) of receive time over server time in the
+        # relative units. Without a drift the intercept is the mean offset
+        # of the envelope points, or of the best observation of the first
+        # window, and the slope is 1.
+        if self._w == 0:
+            if self._best is None:
+                return 0.0, 1.0
+            return self._best[1], 1.0
+        drift = self.drift_ppm()
+        if drift is None:
+            return self._mean_d, 1.0
+        drift /= 1e6
+        return self._mean_d - drift * self._mean_x, 1.0 + drift
+
+    def corrected_ns(self, server_time):
+        # Map a server timestamp to the monotonic clock, in nanoseconds
+        if self._x0 is None:
+            return None
+        intercept, slope = self.fit()
+        return self._y0 + int((intercept + slope * (server_time - self._x0)) * 1e9)
+
+
+class ClockRecorder(object):
+    # Collects receive times of all streams of one device, with a DriftEstimator per stream
+
+    def __init__(self, path, buffer_size = FILE_BUFFER_SIZE, flush_interval = FLUSH_INTERVAL,
+                 fsync_interval = FSYNC_INTERVAL):
+        # Args:
+        #   path: pathlib.Path of the clock file
+        self.estimators = {}        # stream -> DriftEstimator
+        self.file = DurableFile(path, "w", buffer_size, flush_interval, fsync_interval)
+        self._writer = csv.writer(self.file)
+        self._writer.writerow(["receive_ns", "stream", "timestamp", "samples", "corrected_ns", "drift_ppm"])
+        # Several writer threads may observe different streams of the device
+        self._lock = threading.Lock()
+
+    def observe(self, stream, receive_ns, timestamp, n_samples):
+        # Args:
+        #   stream: string
+        #   receive_ns: int, time.monotonic_ns() of the batch
+        #   timestamp: float, newest server timestamp of stream in the batch
+        #   n_samples: int
+        with self._lock:
+            estimator = self.estimators.get(stream)
+            if estimator is None:
+                estimator = self.estimators[stream] = DriftEstimator()
+            estimator.add(timestamp, receive_ns)
+            drift = estimator.drift_ppm()
+            self._writer.writerow([receive_ns, stream, timestamp, n_samples, estimator.corrected_ns(timestamp),
+                                   "%.3f" % drift if drift is not None else ""])
+
+    def observe_rows(self, receive_ns, rows):
+        # Observe the rows of one batch, as returned by decoder.decode_lines
+        newest = {}
+        counts = {}
+        for stream, row in rows:
+            newest[stream] = row[0]
+            counts[stream] = counts.get(stream, 0) + 1
+        for stream, timestamp in newest.items():
+            self.observe(stream, receive_ns, timestamp, counts[stream])
+
+    def observe_blocks(self, receive_ns, blocks):
+        # Observe the blocks of one batch, as returned by batch.BlockDecoder.decode
+        for stream, (timestamps, values) in blocks.items():
+            self.observe(stream, receive_ns, float(timestamps[-1]), len(timestamps))
+
+    def close(self):
+        self.file.close()
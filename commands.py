@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+# Command channel to the E4 streaming server.
+#
+# Commands are sent without waiting for the previous reply, so subscribing
+# to all streams of a device costs one round trip instead of one per stream.
+# The server answers every command with a line
+#   R <command name> [<stream>] <result ...>
+# for example "R device_subscribe acc OK" or "R device_connect ERR ...".
+# Replies are matched to the pending command with the same name (and stream
+# for device_subscribe), or else to the oldest pending command of that name,
+# so an error reply without the stream name still completes a request.
+# Data lines (E4_*) and unexpected replies that arrive in between are not
+# mistaken for replies, the last UNSOLICITED_LINES of them are kept in
+# CommandChannel.unsolicited.
+
+import collections
+import socket
+import time
+
+from framing import LineFramer
+
+
+TIMEOUT = 5.0           # Seconds to wait for all replies of a request
+UNSOLICITED_LINES = 1000    # Lines kept in CommandChannel.unsolicited
+
+
+class CommandTimeout(Exception):
+    pass
+
+
+def command_key(fields):
+    # Returns (name, stream) of a command or of a reply without its "R"
+    if not fields:
+        return None, None
+    if fields[0] == "device_subscribe" and len(fields) > 1:
+        return fields[0], fields[1].lower()
+    return fields[0], None
+
+
+def parse_reply(line):
+    # Returns the fields of a reply line without "R", or None for data lines
+    fields = line.split()
+    if len(fields) < 2 or fields[0] != "R":
+        return None
+    return fields[1:]
+
+
+class PendingCommands(object):
+    # Commands waiting for their reply, in the order they were sent
+
+    def __init__(self, commands):
+        self.commands = list(commands)
+        self.replies = [None] * len(self.commands)
+        self._waiting = [(index, command_key(command.split())) for index, command in enumerate(self.commands)]
+
+    def match(self, fields):
+        # Store the reply fields with the matching command.
+        # Returns False if no pending command matches.
+        name, stream = command_key(fields)
+        same_name = [entry for entry in self._waiting if entry[1][0] == name]
+        if not same_name:
+            return False
+        exact = [entry for entry in same_name if entry[1][1] == stream]
+        entry = exact[0] if exact else same_name[0]
+        self._waiting.remove(entry)
+        self.replies[entry[0]] = "R " + " ".join(fields)
+        return True
+
+    def done(self):
+        return not self._waiting
+
+    def missing(self):
+        return [self.commands[index] for index, _ in self._waiting]
+
+
+class CommandChannel(object):
+    # Pipelined commands over a connected socket to the streaming server
+
+    def __init__(self, sock, timeout = TIMEOUT, recv_size = 4096):
+        # Args:
+        #   sock: socket.socket connected to the server
+        #   timeout: float, default seconds to wait for the replies of a request
+        self.sock = sock
+        self.timeout = timeout
+        self.recv_size = recv_size
+        self.framer = LineFramer()
+        self.unsolicited = collections.deque(maxlen=UNSOLICITED_LINES)
+
+    def send(self, commands):
+        # Send commands without waiting for replies, in one write
+        self.sock.sendall("".join(command + "\r\n" for command in commands).encode())
+
+    def request(self, commands, timeout = None):
+        # Send all commands at once and wait for all of their replies.
+        # Returns the list of replies in the order of commands.
+        # Raises CommandTimeout if a reply is missing after timeout seconds,
+        # and ConnectionError if the server closes the connection.
+        # Args:
+        #   commands: list of strings, without line terminator
+        pending = PendingCommands(commands)
+        self.send(commands)
+        self.wait(pending, self.timeout if timeout is None else timeout)
+        return pending.replies
+
+    def wait(self, pending, timeout):
+        deadline = time.monotonic() + timeout
+        previous_timeout = self.sock.gettimeout()
+        try:
+            while not pending.done():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise CommandTimeout("no reply to " + ", ".join(pending.missing()))
+                self.sock.settimeout(remaining)
+                try:
+                    n_bytes = self.framer.recv_from(self.sock, self.recv_size)
+                except socket.timeout:
+                    continue
+                if n_bytes == 0:
+                    raise ConnectionError("connection closed while waiting for " + ", ".join(pending.missing()))
+                for line in self.framer.lines():
+                    fields = parse_reply(line)
+                    if fields is None or not pending.match(fields):
+                        self.unsolicited.append(line)
+        finally:
+            self.sock.settimeout(previous_timeout)
+
+    def command(self, command, timeout = None):
+        # Send one command and return its reply
+        return self.request([command], timeout)[0]
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+
+# Compressed recording of the stream files.
+#
+# CompressedStreamWriter produces the same rows as the csv backend, but
+# collects them into frames of FRAME_SIZE bytes of text, or less if
+# flush_interval seconds have passed, that are compressed on a background
+# thread, so compression never blocks the thread receiving from
+# the server. Every frame is written as
+#   magic b"E4F1" | codec id (1 byte) | raw length | compressed length | crc32
+# (lengths and crc32 as 4 byte little endian) followed by the compressed
+# bytes. Frames are independent, so after a crash every complete frame can
+# still be read and a truncated last frame is skipped.
+#
+# Codecs: zstd (requires zstandard), lz4 (requires lz4) and zlib, which is
+# always available.
+#
+# Frames always end after a complete row, so read_lines() can stream the
+# rows of a file into csv.reader.
+#
+# Usage:
+#   python compression.py FILE.csvz            print the decompressed csv
+#   python compression.py --benchmark [--seconds N]
+
+import argparse
+import io
+import csv
+import queue
+import struct
+import sys
+import threading
+import time
+import zlib
+
+from storage import CSV_HEADERS, DurableFile, FILE_BUFFER_SIZE, FLUSH_INTERVAL, FSYNC_INTERVAL
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+MAGIC = b"E4F1"
+HEADER = struct.Struct("<4sBIII")
+FRAME_SIZE = 256 * 1024     # Bytes of csv text per frame
+CODEC = "zstd" if zstandard is not None else "zlib"
+
+
+def _codecs():
+    # name -> (id, compress, decompress) for the installed codecs
+    codecs = {"zlib": (1, lambda data: zlib.compress(data, 6), zlib.decompress)}
+    if zstandard is not None:
+        compressor = zstandard.ZstdCompressor(level=3)
+        decompressor = zstandard.ZstdDecompressor()
+        codecs["zstd"] = (2, compressor.compress, decompressor.decompress)
+    if lz4 is not None:
+        codecs["lz4"] = (3, lz4.frame.compress, lz4.frame.decompress)
+    return codecs
+
+CODECS = _codecs()
+CODEC_NAMES = {codec_id: name for name, (codec_id, _, _) in CODECS.items()}
+
+
+def encode_frame(data, codec = CODEC):
+    codec_id, compress, _ = CODECS[codec]
+    compressed = compress(data)
+    return HEADER.pack(MAGIC, codec_id, len(data), len(compressed), zlib.crc32(compressed)) + compressed
+
+
+def read_frames(path, first_frame = 0):
+    # Yields the decompressed bytes of every complete frame of a file,
+    # starting with frame number first_frame. Frames before it are skipped
+    # without decompressing them.
+    # Stops at a truncated or damaged frame, like the last frame after a crash.
+    with open(path, "rb") as f:
+        for _ in range(first_frame):
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size or header[:4] != MAGIC:
+                return
+            f.seek(HEADER.unpack(header)[3], 1)
+        while True:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+            magic, codec_id, raw_length, length, crc = HEADER.unpack(header)
+            if magic != MAGIC:
+                return
+            compressed = f.read(length)
+            if len(compressed) < length or zlib.crc32(compressed) != crc:
+                return
+            name = CODEC_NAMES.get(codec_id)
+            if name is None:
+                raise ValueError("frame compressed with codec %d, which is not installed" % codec_id)
+            yield CODECS[name][2](compressed)
+
+
+def complete_frames(path):
+    # Returns (number of frames, bytes) of the complete frames at the start
+    # of a file, without decompressing them
+    n_frames = length = 0
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size or header[:4] != MAGIC:
+                return n_frames, length
+            magic, codec_id, raw_length, compressed_length, crc = HEADER.unpack(header)
+            compressed = f.read(compressed_length)
+            if len(compressed) < compressed_length or zlib.crc32(compressed) != crc:
+                return n_frames, length
+            n_frames += 1
+            length = f.tell()
+
+
+def read_lines(path):
+    # Yields the csv lines of a compressed stream file
+    for data in read_frames(path):
+        yield from data.decode("utf-8").splitlines(keepends=True)
+
+
+def read_compressed(path):
+    # Returns the csv text of a compressed stream file
+    return b"".join(read_frames(path)).decode("utf-8")
+
+
+class CompressedStreamWriter(object):
+
+    def __init__(self, path, stream, codec = CODEC, frame_size = FRAME_SIZE, buffer_size = FILE_BUFFER_SIZE,
+                 flush_interval = FLUSH_INTERVAL, fsync_interval = FSYNC_INTERVAL, append = False, **policy):
+        # Args:
+        #   path: pathlib.Path
+        #   stream: string, stream name
+        #   codec: string, one of CODECS
+        #   frame_size: int, bytes of csv text per frame
+        #   append: bool, add frames to an existing file after its last complete frame
+        if codec not in CODECS:
+            raise ValueError("codec %s is not installed" % codec)
+        self.stream = stream
+        self.codec = codec
+        self.frame_size = frame_size
+        self.flush_interval = flush_interval
+        self.n_frames = 0                   # Frames ended so far
+        if append and path.exists():
+            self.n_frames, length = complete_frames(path)
+            with open(path, "rb+") as f:
+                f.truncate(length)
+        self.file = DurableFile(path, "ab" if self.n_frames else "wb", buffer_size, flush_interval, fsync_interval)
+        self.stats = self.file.stats
+        self.stats.raw_bytes = 0            # Bytes of csv text before compression
+        self.stats.compress_seconds = 0.0   # CPU time of the compression thread
+        self.closed = False
+        self._text = io.StringIO()
+        self._writer = csv.writer(self._text)
+        self._last_frame = time.monotonic()
+        self._frames = queue.Queue()
+        # Rows are written by one thread, frames are also ended by the flush
+        # timer of storage.Storage
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._compress_loop, name="e4-compress-" + stream, daemon=True)
+        self._thread.start()
+        if not self.n_frames:
+            self.writerow(CSV_HEADERS[stream])
+
+    def writerow(self, row):
+        with self._lock:
+            self._writer.writerow(row)
+            self._check_frame()
+
+    def writerows(self, rows):
+        with self._lock:
+            self._writer.writerows(rows)
+            self._check_frame()
+
+    def _check_frame(self):
+        if (self._text.tell() >= self.frame_size
+                or time.monotonic() - self._last_frame >= self.flush_interval):
+            self._end_frame()
+
+    def write_block(self, timestamps, values):
+        from batch import block_csv
+        text = block_csv(self.stream, timestamps, values)
+        with self._lock:
+            self._text.write(text)
+            self._check_frame()
+
+    def write_gap(self, lost_at, duration):
+        with self._lock:
+            self._writer.writerow(["#gap", lost_at, duration])
+            self._end_frame()
+
+    def _end_frame(self):
+        data = self._text.getvalue().encode("utf-8")
+        self._text.seek(0)
+        self._text.truncate()
+        self._last_frame = time.monotonic()
+        if data:
+            self.n_frames += 1
+            self._frames.put(data)
+
+    def _compress_loop(self):
+        while True:
+            data = self._frames.get()
+            if data is None:
+                return
+            start = time.thread_time()
+            frame = encode_frame(data, self.codec)
+            self.stats.compress_seconds += time.thread_time() - start
+            self.stats.raw_bytes += len(data)
+            self.file.write(frame)
+            self.file.flush()
+
+    def position(self):
+        # Number of the frame the next row is written to
+        return self.n_frames
+
+    def flush(self):
+        # Hand the buffered rows to the compression thread
+        with self._lock:
+            self._end_frame()
+
+    def close(self):
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            self._end_frame()
+        self._frames.put(None)
+        self._thread.join()
+        self.file.close()
+
+
+def benchmark(seconds, frame_size = FRAME_SIZE):
+    # Compress a synthetic recording of one device with every installed codec
+    # and print compression ratio and CPU cost
+    import tempfile
+    from pathlib import Path
+    from bench_framing import synthetic_recording
+    from decoder import decode_lines
+
+    lines = synthetic_recording(seconds).decode("utf-8").replace("\r", "").split("\n")
+    rows, _ = decode_lines(sorted(line for line in lines if line))
+    print(f"{len(rows)} samples, {seconds:.0f} seconds of one device")
+    with tempfile.TemporaryDirectory() as directory:
+        for codec in CODECS:
+            writers = {}
+            for stream in CSV_HEADERS:
+                writers[stream] = CompressedStreamWriter(Path(directory, stream + "." + codec), stream,
+                                                         codec, frame_size)
+            for stream, row in rows:
+                writers[stream].writerow(row)
+            for writer in writers.values():
+                writer.close()
+            raw = sum(writer.stats.raw_bytes for writer in writers.values())
+            written = sum(writer.stats.bytes_written for writer in writers.values())
+            cpu = sum(writer.stats.compress_seconds for writer in writers.values())
+            print(f"{codec:5s}: ratio {raw / written:5.1f}  {written / seconds:8.0f} bytes/s  "
+                  f"CPU {cpu / seconds * 3600:6.2f} s per device hour")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Read or benchmark compressed E4 stream files.")
+    parser.add_argument("file", nargs="?", help="compressed stream file to print as csv")
+    parser.add_argument("--benchmark", action="store_true")
+    parser.add_argument("--seconds", type=float, default=600, help="length of the benchmark recording")
+    args = parser.parse_args()
+    if args.benchmark:
+        benchmark(args.seconds)
+    elif args.file:
+        for data in read_frames(args.file):
+            sys.stdout.write(data.decode("utf-8"))
+    else:
+        parser.error("give a file or --benchmark")
+
+
+if __name__ == "__main__":
+    main()
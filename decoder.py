@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+# Table driven decoding of data lines from the E4 streaming server.
+#
+# A data line looks like "E4_Acc 1600000000,123 -12 3 60", using comma as the
+# decimal separator. Each line is tokenized once and converted by the
+# converter registered for its tag in DECODERS.
+
+
+ACC_MIN, ACC_MAX = -32768, 32767    # acc values are stored as int16
+
+
+def _decode_acc(fields):
+    # timestamp, x, y, z
+    x, y, z = int(fields[2]), int(fields[3]), int(fields[4])
+    if not (ACC_MIN <= x <= ACC_MAX and ACC_MIN <= y <= ACC_MAX and ACC_MIN <= z <= ACC_MAX):
+        raise ValueError("acc value out of the int16 range")
+    return [float(fields[1]), x, y, z]
+
+def _decode_scalar(fields):
+    # timestamp, value
+    return [float(fields[1]), float(fields[2])]
+
+
+# Tag sent by the server -> (stream name, converter)
+DECODERS = {
+    "E4_Acc":           ("acc", _decode_acc),
+    "E4_Bvp":           ("bvp", _decode_scalar),
+    "E4_Gsr":           ("gsr", _decode_scalar),
+    "E4_Ibi":           ("ibi", _decode_scalar),
+    "E4_Hr":            ("hr", _decode_scalar),
+    "E4_Temperature":   ("tmp", _decode_scalar),
+}
+
+# Stream name -> tag sent by the server
+STREAM_TAGS = {stream: tag for tag, (stream, _) in DECODERS.items()}
+
+
+def decode_line(line):
+    # Decode a single line.
+    # Returns (stream name, row) or None if the line is not a data line.
+    # Raises ValueError or IndexError for malformed data lines.
+    # Args:
+    #   line: string
+    fields = line.replace(",", ".").split()
+    if not fields:
+        return None
+    decoder = DECODERS.get(fields[0])
+    if decoder is None:
+        return None
+    stream, convert = decoder
+    return stream, convert(fields)
+
+
+def decode_lines(lines):
+    # Decode a list of lines, skipping lines that are not data lines.
+    # Returns (rows, n_malformed) where rows is a list of (stream name, row).
+    # Args:
+    #   lines: list of strings
+    rows = []
+    n_malformed = 0
+    decoders = DECODERS
+    for line in lines:
+        fields = line.replace(",", ".").split()
+        if not fields:
+            continue
+        decoder = decoders.get(fields[0])
+        if decoder is None:
+            continue
+        try:
+            rows.append((decoder[0], decoder[1](fields)))
+        except (ValueError, IndexError):
+            n_malformed += 1
+    return rows, n_malformed
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+# Export a recording session as one time-aligned table.
+#
+# The streams of a session, and of every device if the session has a
+# directory per device (async_recorder.py), are read in chunks with
+# session_reader.read_chunks(), so every storage backend works, and merged by
+# timestamp in one streaming pass and resampled to a common grid:
+#   acc, bvp, gsr, tmp:  linear interpolation, empty if the neighbouring
+#                        samples are more than MAX_GAP seconds apart
+#   ibi, hr:             last value, empty if older than HOLD_SECONDS
+# The grid is processed in chunks of CHUNK_SECONDS. Only the samples of the
+# chunks in flight are held in memory, so memory use does not grow with the
+# session length, and the chunks are resampled in parallel worker processes.
+# Gap markers are skipped. Needs numpy.
+#
+# Usage:
+#   python export.py data/Empatica_E4_<ID> [--rate HZ] [--output FILE] [--workers N]
+
+import argparse
+import bisect
+import collections
+import concurrent.futures
+import csv
+import heapq
+import math
+import sys
+from pathlib import Path
+
+from session_reader import detect_backend, read_chunks
+from storage import CSV_HEADERS
+
+
+STREAMS = ["acc", "bvp", "gsr", "ibi", "hr", "tmp"]
+HOLD_STREAMS = ["ibi", "hr"]    # Streams resampled by holding the last value
+
+RATE = 32.0             # Output rate in Hz
+CHUNK_SECONDS = 60.0    # Seconds of output per chunk
+LOOKAHEAD = 2.0         # Seconds read past the end of a chunk for interpolation
+MAX_GAP = 2.0           # Longest gap in seconds that is interpolated
+HOLD_SECONDS = 10.0     # Longest time in seconds a held value stays valid
+
+
+class Source(object):
+    # One stream of one device
+
+    def __init__(self, index, device, stream, directory, backend):
+        # Args:
+        #   directory: pathlib.Path, session or device directory
+        #   backend: string, storage backend of the stream
+        self.index = index
+        self.device = device
+        self.stream = stream
+        self.directory = directory
+        self.backend = backend
+        prefix = (device + "_" if device else "") + stream + "_"
+        self.columns = [prefix + name for name in CSV_HEADERS[stream][1:]]
+
+    def samples(self):
+        # Yields (timestamp, source index, values) in file order
+        for timestamps, values in read_chunks(self.directory, self.stream, backend=self.backend):
+            if values.ndim == 1:
+                values = values[:, None]
+            yield from zip(timestamps.tolist(), [self.index] * len(timestamps), values.tolist())
+
+
+def find_sources(session):
+    # Returns a Source for every stream with data in session or its device directories
+    directories = [session] + sorted(path for path in session.iterdir() if path.is_dir())
+    sources = []
+    for directory in directories:
+        device = "" if directory == session else directory.name
+        for stream in STREAMS:
+            backend = detect_backend(directory, stream)
+            if backend is not None:
+                sources.append(Source(len(sources), device, stream, directory, backend))
+    return sources
+
+
+def resample_chunk(grid, columns, hold):
+    # Resample one chunk, runs in a worker process.
+    # Returns a list of output rows.
+    # Args:
+    #   grid: list of grid timestamps
+    #   columns: list per source of (timestamps, values) covering the chunk
+    #   hold: list per source of bool, True to hold the last value
+    rows = [[t] for t in grid]
+    for (timestamps, values), hold_value in zip(columns, hold):
+        width = len(values[0]) if values else 1
+        empty = [""] * width
+        for row in rows:
+            t = row[0]
+            i = bisect.bisect_right(timestamps, t)
+            if hold_value:
+                if i > 0 and t - timestamps[i - 1] <= HOLD_SECONDS:
+                    row += values[i - 1]
+                else:
+                    row += empty
+            elif 0 < i < len(timestamps) and timestamps[i] - timestamps[i - 1] <= MAX_GAP:
+                t0, t1 = timestamps[i - 1], timestamps[i]
+                w = (t - t0) / (t1 - t0) if t1 > t0 else 0.0
+                row += [a + w * (b - a) for a, b in zip(values[i - 1], values[i])]
+            elif i > 0 and timestamps[i - 1] == t:
+                row += values[i - 1]
+            else:
+                row += empty
+    return rows
+
+
+def chunks(sources, rate, chunk_seconds):
+    # Merge all sources by timestamp and yield the arguments of
+    # resample_chunk() for every chunk of the grid
+    merged = heapq.merge(*[source.samples() for source in sources], key=lambda sample: sample[0])
+    carry = [None] * len(sources)           # Last sample before the current chunk
+    pending = collections.deque()
+    hold = [source.stream in HOLD_STREAMS for source in sources]
+    step = 1.0 / rate
+    per_chunk = max(1, int(round(chunk_seconds * rate)))
+    origin = None           # Time of grid point 0
+    first = 0               # Index of the first grid point of the current chunk
+    last_time = None
+
+    def make_chunk(n_points):
+        grid = [origin + (first + i) * step for i in range(n_points)]
+        columns = [([], []) for _ in sources]
+        for index, sample in enumerate(carry):
+            if sample is not None:
+                columns[index][0].append(sample[0])
+                columns[index][1].append(sample[2])
+        for t, index, values in pending:
+            columns[index][0].append(t)
+            columns[index][1].append(values)
+        return grid, columns, hold
+
+    def advance(end):
+        # Drop the samples before end, remembering the last one per source
+        while pending and pending[0][0] < end:
+            sample = pending.popleft()
+            carry[sample[1]] = sample
+
+    for sample in merged:
+        if origin is None:
+            origin = math.ceil(sample[0] * rate) / rate
+        pending.append(sample)
+        last_time = sample[0]
+        while last_time >= origin + (first + per_chunk) * step + LOOKAHEAD:
+            yield make_chunk(per_chunk)
+            first += per_chunk
+            advance(origin + first * step)
+
+    if origin is None:
+        return
+    n_left = int(math.floor((last_time - origin) * rate + 1e-9)) + 1 - first
+    while n_left > 0:
+        n_points = min(per_chunk, n_left)
+        yield make_chunk(n_points)
+        first += n_points
+        n_left -= n_points
+        advance(origin + first * step)
+
+
+def export(session, output, rate = RATE, chunk_seconds = CHUNK_SECONDS, workers = 1):
+    # Write the aligned table of session to output.
+    # Returns the number of rows written.
+    # Args:
+    #   session: pathlib.Path, session directory
+    #   output: file object opened for writing text
+    #   workers: int, number of worker processes, 1 to resample in this process
+    sources = find_sources(session)
+    if not sources:
+        raise FileNotFoundError("no stream files in " + str(session))
+    writer = csv.writer(output)
+    writer.writerow(["timestamp"] + [column for source in sources for column in source.columns])
+
+    n_rows = 0
+    if workers <= 1:
+        for chunk in chunks(sources, rate, chunk_seconds):
+            rows = resample_chunk(*chunk)
+            writer.writerows(rows)
+            n_rows += len(rows)
+        return n_rows
+
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        # Keep a bounded number of chunks in flight and write them in order
+        in_flight = collections.deque()
+        for chunk in chunks(sources, rate, chunk_seconds):
+            in_flight.append(executor.submit(resample_chunk, *chunk))
+            if len(in_flight) >= 2 * workers:
+                rows = in_flight.popleft().result()
+                writer.writerows(rows)
+                n_rows += len(rows)
+        while in_flight:
+            rows = in_flight.popleft().result()
+            writer.writerows(rows)
+            n_rows += len(rows)
+    return n_rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export a session as one time-aligned table.")
+    parser.add_argument("session", help="session directory, e.g. data/Empatica_E4_<ID>")
+    parser.add_argument("--rate", type=float, default=RATE, help="output rate in Hz")
+    parser.add_argument("--output", help="output .csv file, default stdout")
+    parser.add_argument("--chunk-seconds", type=float, default=CHUNK_SECONDS)
+    parser.add_argument("--workers", type=int, default=1, help="worker processes")
+    args = parser.parse_args()
+
+    if args.output:
+        with open(args.output, "w", newline="") as output:
+            n_rows = export(Path(args.session), output, args.rate, args.chunk_seconds, args.workers)
+        print(f"{n_rows} rows written to {args.output}")
+    else:
+        export(Path(args.session), sys.stdout, args.rate, args.chunk_seconds, args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+
+# Online feature extraction while recording.
+#
+# Features are updated with O(1) work per sample and written to their own
+# output, features_data.csv, with the columns timestamp, feature, value:
+#   rmssd, sdnn:     heart rate variability in seconds over the last
+#                    HRV_WINDOW seconds of E4_Ibi, after every beat
+#   scr_amplitude:   amplitude in microsiemens of a skin conductance response
+#                    detected in E4_Gsr, at the time of its peak
+#   scl:             tonic skin conductance level, once per SCL_INTERVAL seconds
+#   activity:        mean amplitude deviation of the E4_Acc magnitude in g,
+#                    once per ACTIVITY_EPOCH seconds
+#
+# FeatureStage.writers has a storage writer (see storage.py) for the acc,
+# gsr and ibi streams, to be teed next to the file writers with
+# storage.TeeWriter. Blocks from batch mode are processed vectorized.
+
+import collections
+import csv
+import math
+import threading
+
+from storage import DurableFile, FILE_BUFFER_SIZE, FLUSH_INTERVAL, FSYNC_INTERVAL
+
+
+HRV_WINDOW = 60.0           # Seconds of beats used for RMSSD and SDNN
+SCR_THRESHOLD = 0.01        # Minimum rise in microsiemens of a skin conductance response
+TONIC_TIME_CONSTANT = 10.0  # Seconds, smoothing of the tonic skin conductance level
+PHASIC_TIME_CONSTANT = 1.0  # Seconds, smoothing of the phasic component
+SCL_INTERVAL = 10.0         # Seconds between scl outputs
+ACTIVITY_EPOCH = 1.0        # Seconds per activity value
+ACC_SCALE = 64.0            # E4 acceleration units per g
+
+
+class HrvWindow(object):
+    # RMSSD and SDNN over the beats of the last window seconds, using running
+    # sums that are updated when a beat enters or leaves the window
+
+    def __init__(self, window = HRV_WINDOW):
+        self.window = window
+        self._beats = collections.deque()      # (timestamp, ibi, squared difference to previous)
+        self._sum = 0.0
+        self._sum_squares = 0.0
+        self._sum_differences = 0.0
+        self._previous = None
+
+    def add(self, timestamp, ibi):
+        # Returns (rmssd, sdnn), None while there are too few beats
+        difference = (ibi - self._previous) ** 2 if self._previous is not None else None
+        self._previous = ibi
+        self._beats.append((timestamp, ibi, difference))
+        self._sum += ibi
+        self._sum_squares += ibi * ibi
+        if difference is not None:
+            self._sum_differences += difference
+
+        while self._beats and self._beats[0][0] < timestamp - self.window:
+            _, old_ibi, old_difference = self._beats.popleft()
+            self._sum -= old_ibi
+            self._sum_squares -= old_ibi * old_ibi
+            if old_difference is not None:
+                self._sum_differences -= old_difference
+            if self._beats and self._beats[0][2] is not None:
+                # The oldest beat has no predecessor in the window any more
+                self._sum_differences -= self._beats[0][2]
+                first = self._beats[0]
+                self._beats[0] = (first[0], first[1], None)
+
+        n_beats = len(self._beats)
+        if n_beats < 3:
+            return None
+        mean = self._sum / n_beats
+        variance = max(self._sum_squares / n_beats - mean * mean, 0.0) * n_beats / (n_beats - 1)
+        rmssd = math.sqrt(max(self._sum_differences, 0.0) / (n_beats - 1))
+        return rmssd, math.sqrt(variance)
+
+
+class ScrDetector(object):
+    # Splits skin conductance into a tonic level (slow exponential average)
+    # and a phasic component, and reports a response when the phasic
+    # component has risen by more than threshold from its last trough and
+    # starts falling again
+
+    def __init__(self, threshold = SCR_THRESHOLD):
+        self.threshold = threshold
+        self.tonic = None
+        self.phasic = 0.0
+        self._previous_time = None
+        self._trough = 0.0
+        self._peak = None           # (timestamp, phasic) while rising
+
+    def add(self, timestamp, gsr):
+        # Returns (peak timestamp, amplitude) when a response ends, else None
+        if self.tonic is None:
+            self.tonic = gsr
+            self._previous_time = timestamp
+            return None
+        dt = max(timestamp - self._previous_time, 0.0)
+        self._previous_time = timestamp
+        self.tonic += (1.0 - math.exp(-dt / TONIC_TIME_CONSTANT)) * (gsr - self.tonic)
+        self.phasic += (1.0 - math.exp(-dt / PHASIC_TIME_CONSTANT)) * (gsr - self.tonic - self.phasic)
+
+        if self._peak is not None and self.phasic < self._peak[1]:
+            # Falling after a rise
+            peak_time, peak = self._peak
+            self._peak = None
+            amplitude = peak - self._trough
+            if amplitude >= self.threshold:
+                self._trough = self.phasic
+                return peak_time, amplitude
+            self._trough = min(self._trough, self.phasic)
+            return None
+
+        if self.phasic < self._trough:
+            self._trough = self.phasic
+        elif self.phasic > self._trough:
+            # Rising
+            self._peak = (timestamp, self.phasic)
+        return None
+
+
+class ActivityEpochs(object):
+    # Mean amplitude deviation of the acceleration magnitude per epoch
+
+    def __init__(self, epoch = ACTIVITY_EPOCH):
+        self.epoch = epoch
+        self._start = None
+        self._magnitudes = []
+
+    def add(self, timestamp, x, y, z):
+        # Returns (epoch start, activity) when an epoch is complete, else None
+        if self._start is None:
+            self._start = timestamp
+        result = None
+        if timestamp - self._start >= self.epoch and self._magnitudes:
+            result = (self._start, self._mean_amplitude_deviation())
+            self._start = timestamp
+            self._magnitudes = []
+        self._magnitudes.append(math.sqrt(x * x + y * y + z * z) / ACC_SCALE)
+        return result
+
+    def add_block(self, timestamps, values):
+        # Vectorized version of add() for batch mode blocks.
+        # Returns a list of (epoch start, activity).
+        import numpy as np
+        magnitudes = np.sqrt((values.astype(np.float64) ** 2).sum(axis=1)) / ACC_SCALE
+        results = []
+        if self._start is None and len(timestamps):
+            self._start = float(timestamps[0])
+        index = 0
+        while index < len(timestamps):
+            # Samples up to the end of the current epoch
+            end = int(np.searchsorted(timestamps, self._start + self.epoch, side="left"))
+            if end >= len(timestamps):
+                self._magnitudes.extend(magnitudes[index:].tolist())
+                break
+            self._magnitudes.extend(magnitudes[index:end].tolist())
+            if self._magnitudes:
+                results.append((self._start, self._mean_amplitude_deviation()))
+            self._magnitudes = []
+            self._start = float(timestamps[end])
+            index = end
+        return results
+
+    def _mean_amplitude_deviation(self):
+        mean = sum(self._magnitudes) / len(self._magnitudes)
+        return sum(abs(m - mean) for m in self._magnitudes) / len(self._magnitudes)
+
+
+class _FeatureWriter(object):
+    # Storage writer interface feeding one input stream into a FeatureStage
+
+    def __init__(self, add_row):
+        self.writerow = add_row
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def write_block(self, timestamps, values):
+        for timestamp, value in zip(timestamps.tolist(), values.tolist()):
+            self.writerow([timestamp] + value if isinstance(value, list) else [timestamp, value])
+
+    def write_gap(self, lost_at, duration):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FeatureStage(object):
+
+    def __init__(self, path, buffer_size = FILE_BUFFER_SIZE, flush_interval = FLUSH_INTERVAL,
+                 fsync_interval = FSYNC_INTERVAL):
+        # Args:
+        #   path: pathlib.Path of the features file
+        self.file = DurableFile(path, "w", buffer_size, flush_interval, fsync_interval)
+        self._writer = csv.writer(self.file)
+        self._writer.writerow(["timestamp", "feature", "value"])
+        # The streams may be written by different writer threads, while the
+        # feature state of a stream is only touched by the thread writing it
+        self._lock = threading.Lock()
+        self.hrv = HrvWindow()
+        self.scr = ScrDetector()
+        self.activity = ActivityEpochs()
+        self._last_scl = None
+
+        acc_writer = _FeatureWriter(self._add_acc)
+        acc_writer.write_block = self._add_acc_block
+        self.writers = {
+            "acc": acc_writer,
+            "gsr": _FeatureWriter(self._add_gsr),
+            "ibi": _FeatureWriter(self._add_ibi),
+        }
+
+    def _write(self, *rows):
+        with self._lock:
+            self._writer.writerows(rows)
+
+    def _add_ibi(self, row):
+        hrv = self.hrv.add(row[0], row[1])
+        if hrv is not None:
+            self._write([row[0], "rmssd", hrv[0]], [row[0], "sdnn", hrv[1]])
+
+    def _add_gsr(self, row):
+        response = self.scr.add(row[0], row[1])
+        if response is not None:
+            self._write([response[0], "scr_amplitude", response[1]])
+        if self._last_scl is None or row[0] - self._last_scl >= SCL_INTERVAL:
+            self._last_scl = row[0]
+            self._write([row[0], "scl", self.scr.tonic])
+
+    def _add_acc(self, row):
+        epoch = self.activity.add(row[0], row[1], row[2], row[3])
+        if epoch is not None:
+            self._write([epoch[0], "activity", epoch[1]])
+
+    def _add_acc_block(self, timestamps, values):
+        for start, activity in self.activity.add_block(timestamps, values):
+            self._write([start, "activity", activity])
+
+    def close(self):
+        with self._lock:
+            self.file.close()
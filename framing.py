@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+# Incremental framing of the byte stream sent by the E4 streaming server.
+#
+# The server sends newline terminated text lines, but a single recv() can end
+# anywhere inside a line. LineFramer keeps the unterminated tail between reads
+# so that only complete lines are handed on to the parser.
+
+
+INITIAL_SIZE = 4 * 4096     # Initial size of the receive buffer in bytes
+
+CONNECTION_LOST = "connection lost to device"     # Sent by the server when the device is gone
+
+
+def split_connection_lost(lines):
+    # Returns (lines before the connection lost message, True), or
+    # (lines, False) if lines do not contain it. The data lines received
+    # before the message are still valid.
+    for index, line in enumerate(lines):
+        if CONNECTION_LOST in line:
+            return lines[:index], True
+    return lines, False
+
+
+class LineFramer(object):
+
+    def __init__(self, size = INITIAL_SIZE):
+        # Args:
+        #   size: initial size of the receive buffer in bytes
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        self._end = 0           # Number of valid bytes in the buffer
+
+    def _reserve(self, n_bytes):
+        # Make sure there is room for at least n_bytes after the valid data.
+        # The buffer is doubled until it fits, keeping the pending tail.
+        if len(self._buffer) - self._end >= n_bytes:
+            return
+        new_size = len(self._buffer)
+        while new_size - self._end < n_bytes:
+            new_size *= 2
+        self._view.release()
+        self._buffer.extend(bytes(new_size - len(self._buffer)))
+        self._view = memoryview(self._buffer)
+
+    def recv_from(self, sock, n_bytes = 4096):
+        # Read at most n_bytes from sock straight into the buffer.
+        # Returns the number of bytes read, 0 means the connection is closed.
+        # Args:
+        #   sock: socket.socket (or any object with recv_into)
+        #   n_bytes: int
+        self._reserve(n_bytes)
+        received = sock.recv_into(self._view[self._end:self._end + n_bytes])
+        self._end += received
+        return received
+
+    def feed(self, data):
+        # Append already received bytes to the buffer.
+        # Args:
+        #   data: bytes-like object
+        self._reserve(len(data))
+        self._view[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def lines(self):
+        # Return all complete lines in the buffer as a list of strings without
+        # line terminators. Empty lines are skipped. The unterminated tail is
+        # kept for the next call.
+        last = self._buffer.rfind(b"\n", 0, self._end)
+        if last < 0:
+            return []
+        complete = self._buffer[:last + 1].decode("utf-8", errors="replace")
+
+        # Move the tail to the front of the buffer
+        tail = self._end - last - 1
+        self._view[:tail] = self._view[last + 1:self._end]
+        self._end = tail
+
+        return [line.rstrip("\r") for line in complete.split("\n") if line.strip()]
+
+    def pending(self):
+        # Number of bytes of an incomplete line currently held in the buffer
+        return self._end
@@ -38,6 +38,8 @@ This was created because of an stackoverflow question:
     
 """
 
+import time
+
 def use_tkinter_after(gui_element, wait_time, call_this):
     # the following line needs replacement depending on the GUI
     # it calls 'call_this' after a period of time 'wait_time' in ms
@@ -112,4 +114,87 @@ def stopLoop(generator):
     try: generator.throw(StopLoopException())
     except StopLoopException: pass
 
-__all__ = ['guiLoop', 'stopLoop', 'StopLoopException', 'tkLoop', 'qt4Loop']
\ No newline at end of file
+class FrameScheduler(object):
+    """run many loops on one shared timer at a target frame rate
+
+    Every tick steps all generators that are due and then schedules the
+    next tick so that ticks are 1 / fps seconds apart, subtracting the time
+    the steps took. A generator yielding None is stepped once per frame,
+    a generator yielding seconds is stepped again after that time, rounded
+    to the next frame. Ticks taking longer than a frame are counted as
+    overruns.
+
+        scheduler = FrameScheduler(root, fps = 30)
+        generator = scheduler.start(function, *args)
+        ...
+        scheduler.stop(generator)
+        print(scheduler.stats())
+    """
+
+    timer_resolution = 0.001    # seconds, GUI timers count in milliseconds
+
+    def __init__(self, gui_element, fps = 30, start_in_gui = use_any_timer):
+        self.gui_element = gui_element
+        self.frame_time = 1.0 / fps
+        self.start_in_gui = start_in_gui
+        self.ticks = 0
+        self.overruns = 0
+        self._loops = []        # [generator, due time, step count, step seconds]
+        self._running = False
+
+    def start(self, function, *args, **kw):
+        """start function(*args, **kw) as a loop and return its generator"""
+        generator = function(*args, **kw)
+        self._loops.append([generator, 0.0, 0, 0.0])
+        if not self._running:
+            self._running = True
+            self.start_in_gui(self.gui_element, 0, self._tick)
+        return generator
+
+    def stop(self, generator):
+        """stop a loop started with start()"""
+        for loop in self._loops:
+            if loop[0] is generator:
+                self._loops.remove(loop)
+                stopLoop(generator)
+                return
+
+    def _tick(self):
+        tick_start = time.perf_counter()
+        self.ticks += 1
+        for loop in list(self._loops):
+            # due within the timer resolution counts as due now
+            if loop[1] - tick_start >= self.timer_resolution:
+                continue
+            step_start = time.perf_counter()
+            try:
+                wait_time = next(loop[0])
+            except (StopIteration, StopLoopException):
+                self._loops.remove(loop)
+                continue
+            step_end = time.perf_counter()
+            loop[2] += 1
+            loop[3] += step_end - step_start
+            loop[1] = step_end + (wait_time or 0)
+
+        elapsed = time.perf_counter() - tick_start
+        if elapsed > self.frame_time:
+            self.overruns += 1
+        if not self._loops:
+            self._running = False
+            return
+        # Sleep until the next frame, or longer if no loop is due before
+        next_due = min(loop[1] for loop in self._loops) - tick_start
+        delay = max(self.frame_time, next_due) - elapsed
+        self.start_in_gui(self.gui_element, max(0, int(round(delay * 1000))), self._tick)
+
+    def stats(self):
+        """return tick and overrun counts and the mean step time per loop"""
+        return {'ticks': self.ticks,
+                'overruns': self.overruns,
+                'loops': [{'name': getattr(loop[0], '__name__', repr(loop[0])),
+                           'steps': loop[2],
+                           'mean_step_seconds': loop[3] / loop[2] if loop[2] else 0.0}
+                          for loop in self._loops]}
+
+__all__ = ['guiLoop', 'stopLoop', 'StopLoopException', 'tkLoop', 'qt4Loop', 'FrameScheduler']
\ No newline at end of file
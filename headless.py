@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+
+# Record without any prompts, for unattended lab stations.
+#
+# Everything main() in stream.py asks for is taken from the command line or
+# from a config file, and the recording starts right away. Options given on
+# the command line override the config file. A config file looks like:
+#
+#   [recorder]
+#   subject = station3_session12
+#   host = 127.0.0.1
+#   port = 28000
+#   devices = A02DE7            ; several IDs separated by spaces or commas,
+#                               ; empty for the first device (or all, see --all)
+#   streams = acc, bvp, gsr, ibi, tmp
+#   backend = csvz              ; default csv, npz with workers
+#   duration = 3600             ; seconds, empty to record until stopped
+#   buffer_size = 65536
+#   flush_rows = 4096
+#   flush_interval = 5
+#   fsync_interval =            ; empty to never fsync
+#   features = no
+#   clock = yes
+#   metrics_interval = 10       ; seconds between metrics lines, 0 for none
+#   metrics_port = 9400         ; Prometheus endpoint, empty for none
+#   workers = 4                 ; worker processes for several devices, 0 for none
+#   publish = tcp:127.0.0.1:28100   ; send the samples to local subscribers,
+#                               ; or unix:PATH, empty for none (see publisher.py)
+#
+# One device is recorded with stream.py, including reconnects, features and
+# the clock file. Several devices are recorded with async_recorder.py, or
+# with a pool of worker processes (supervisor.py) if workers is set; features
+# and clock are not available for them, and the workers cannot write parquet.
+# Ctrl+C or SIGTERM stops the recording and closes the files.
+#
+# Exit status:
+#   0  recording finished (duration reached or stopped)
+#   2  invalid command line or config file, e.g. features or clock with
+#      several devices
+#   3  the streaming server could not be reached
+#   4  no device found, or connecting to a device failed
+#   5  subscribing or creating the output files failed
+#   6  the connection was lost and could not be restored
+#
+# Usage:
+#   python headless.py [--config FILE] [--subject ID] [--device ID ...] [--duration SECONDS] ...
+
+import argparse
+import configparser
+import signal
+import sys
+
+
+EXIT_OK = 0
+EXIT_USAGE = 2
+EXIT_SERVER = 3
+EXIT_DEVICE = 4
+EXIT_SETUP = 5
+EXIT_CONNECTION_LOST = 6
+
+SUBSCRIPTIONS = ["acc", "bvp", "gsr", "ibi", "tmp"]
+
+# Option name -> (type, default). Types are converted from the config file
+# strings, None values mean "not set".
+OPTIONS = {
+    "subject": (str, None),
+    "host": (str, "127.0.0.1"),
+    "port": (int, 28000),
+    "devices": (str, ""),
+    "streams": (str, ",".join(SUBSCRIPTIONS)),
+    "backend": (str, None),
+    "duration": (float, None),
+    "buffer_size": (int, 64 * 1024),
+    "flush_rows": (int, 4096),
+    "flush_interval": (float, 5.0),
+    "fsync_interval": (float, None),
+    "features": (bool, False),
+    "clock": (bool, False),
+    "all": (bool, False),
+    "metrics_interval": (float, 10.0),
+    "metrics_port": (int, None),
+    "workers": (int, 0),
+    "publish": (str, None),
+}
+
+
+class ConfigError(Exception):
+    pass
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Record Empatica E4 devices without prompts.")
+    parser.add_argument("--config", help="config file with a [recorder] section")
+    parser.add_argument("--subject", help="data is saved under ./data/Empatica_E4_<subject>/")
+    parser.add_argument("--host")
+    parser.add_argument("--port", type=int)
+    parser.add_argument("--device", dest="devices", action="append",
+                        help="device ID, can be given several times")
+    parser.add_argument("--all", action=argparse.BooleanOptionalAction,
+                        help="record all devices of the server if no device is given")
+    parser.add_argument("--streams", help="comma separated subscriptions, default " + ",".join(SUBSCRIPTIONS))
+    parser.add_argument("--backend", help="output format, one of storage.BACKENDS, default csv (npz with --workers)")
+    parser.add_argument("--duration", type=float, help="seconds to record, default until stopped")
+    parser.add_argument("--buffer-size", type=int, help="file buffer size in bytes")
+    parser.add_argument("--flush-rows", type=int, help="rows buffered per stream by the binary backends")
+    parser.add_argument("--flush-interval", type=float, help="seconds between flushes")
+    parser.add_argument("--fsync-interval", type=float, help="seconds between fsyncs")
+    parser.add_argument("--features", action=argparse.BooleanOptionalAction, help="save features_data.csv")
+    parser.add_argument("--clock", action=argparse.BooleanOptionalAction, help="save clock_data.csv")
+    parser.add_argument("--metrics-interval", type=float, help="seconds between metrics lines, 0 for none")
+    parser.add_argument("--metrics-port", type=int, help="serve metrics on http://127.0.0.1:PORT/metrics")
+    parser.add_argument("--workers", type=int, help="record several devices with this many worker processes")
+    parser.add_argument("--publish", help="send the samples to subscribers on tcp:HOST:PORT or unix:PATH")
+    return parser
+
+
+def _convert(name, value):
+    type_ = OPTIONS[name][0]
+    if value is None or type_ is str:
+        return value
+    if isinstance(value, str):
+        value = value.strip()
+        if value == "":
+            return None
+        if type_ is bool:
+            if value.lower() not in configparser.ConfigParser.BOOLEAN_STATES:
+                raise ConfigError(f"{name}: not a boolean: {value}")
+            return configparser.ConfigParser.BOOLEAN_STATES[value.lower()]
+    try:
+        return type_(value)
+    except ValueError:
+        raise ConfigError(f"{name}: not a number: {value}")
+
+
+def load_config(args):
+    # Merge the defaults, the config file and the command line.
+    # Returns a dict of option name -> value.
+    # Args:
+    #   args: argparse.Namespace from build_parser()
+    config = {name: default for name, (type_, default) in OPTIONS.items()}
+    if args.config:
+        parser = configparser.ConfigParser(inline_comment_prefixes=(";", "#"))
+        try:
+            with open(args.config) as f:
+                parser.read_file(f)
+        except (OSError, configparser.Error) as e:
+            raise ConfigError(f"cannot read {args.config}: {e}")
+        if not parser.has_section("recorder"):
+            raise ConfigError(f"{args.config} has no [recorder] section")
+        for name, value in parser.items("recorder"):
+            if name not in OPTIONS:
+                raise ConfigError(f"{args.config}: unknown option {name}")
+            config[name] = _convert(name, value)
+
+    for name in OPTIONS:
+        value = getattr(args, name, None)
+        if value is not None:
+            config[name] = " ".join(value) if name == "devices" else value
+
+    if not config["subject"]:
+        raise ConfigError("no subject given")
+    config["devices"] = [device.upper() for device in config["devices"].replace(",", " ").split()]
+    config["streams"] = [stream.strip().lower() for stream in config["streams"].split(",") if stream.strip()]
+    for stream in config["streams"]:
+        if stream not in SUBSCRIPTIONS:
+            raise ConfigError("unknown stream " + stream)
+    if not config["streams"]:
+        raise ConfigError("no streams given")
+    several = len(config["devices"]) > 1 or config["all"]
+    if several and (config["features"] or config["clock"]):
+        raise ConfigError("features and clock need a single device")
+    if config["backend"] is None:
+        # The workers write binary files much faster than csv
+        config["backend"] = "npz" if several and config["workers"] else "csv"
+    if several and config["workers"] and config["backend"] == "parquet":
+        raise ConfigError("the workers cannot write parquet, use npz")
+    return config
+
+
+def _interrupt(signum, frame):
+    # Stop on SIGTERM the same way as on Ctrl+C
+    raise KeyboardInterrupt
+
+
+def record_one(config):
+    # Record config["devices"][0], or the first device of the server, with stream.py.
+    # Returns an exit status.
+    import threading
+    import stream
+
+    stream.HOST = config["host"]
+    stream.PORT = config["port"]
+    stream.SUBJECT_ID = config["subject"]
+    stream.STORAGE_BACKEND = config["backend"]
+    stream.STORAGE_BUFFER_SIZE = config["buffer_size"]
+    stream.STORAGE_FLUSH_ROWS = config["flush_rows"]
+    stream.STORAGE_FLUSH_INTERVAL = config["flush_interval"]
+    stream.STORAGE_FSYNC_INTERVAL = config["fsync_interval"]
+    stream.FEATURES = config["features"]
+    stream.CLOCK = config["clock"]
+    stream.METRICS_INTERVAL = config["metrics_interval"] or 0
+    stream.METRICS_PORT = config["metrics_port"]
+    stream.PUBLISH_ADDRESS = config["publish"]
+    for subscription in SUBSCRIPTIONS:
+        setattr(stream, subscription.upper(), subscription in config["streams"])
+
+    if not stream.connect_server():
+        print(f"ERROR: cannot connect to the streaming server at {stream.HOST}:{stream.PORT}", file=sys.stderr)
+        return EXIT_SERVER
+    if config["devices"]:
+        device = config["devices"][0]
+    else:
+        if not stream.update_device_list() or not stream.DEVICE_LIST:
+            print("ERROR: the streaming server has no devices", file=sys.stderr)
+            return EXIT_DEVICE
+        device = stream.DEVICE_LIST[0].upper()
+    if not stream.connect_device(device):
+        print("ERROR: cannot connect to device " + device, file=sys.stderr)
+        return EXIT_DEVICE
+    if not stream.setup_subscribers() or not stream.setup_files():
+        print("ERROR: cannot set up the subscriptions and files", file=sys.stderr)
+        return EXIT_SETUP
+
+    print(f"\tRecording device {device} as {stream.SUBJECT_ID}")
+    stream.STREAMING = True
+    thread = threading.Thread(target=stream.stream_pipelined if stream.PIPELINED else stream.stream)
+    thread.start()
+    try:
+        thread.join(config["duration"])
+    except KeyboardInterrupt:
+        print("\tStopping")
+    # The stream thread only ends by itself if reconnecting failed
+    lost = not thread.is_alive()
+    stream.STREAMING = False
+    thread.join()
+    return EXIT_CONNECTION_LOST if lost else EXIT_OK
+
+
+def record_many(config):
+    # Record several devices, or all devices of the server, with async_recorder.py.
+    # Returns an exit status.
+    import asyncio
+    import async_recorder
+    from metrics import MetricsRegistry
+
+    try:
+        publisher = _start_publisher(config)
+    except OSError as e:
+        print(f"ERROR: cannot publish on {config['publish']}: {e}", file=sys.stderr)
+        return EXIT_SETUP
+    registry = MetricsRegistry()
+    reporter = _start_reporter(config, registry)
+    try:
+        results = asyncio.run(async_recorder.record(
+            config["subject"], config["devices"], config["streams"], config["duration"],
+            config["backend"], config["host"], config["port"], metrics=registry, publisher=publisher,
+            buffer_size=config["buffer_size"], flush_rows=config["flush_rows"],
+            flush_interval=config["flush_interval"], fsync_interval=config["fsync_interval"]))
+    except KeyboardInterrupt:
+        print("\tStopping")
+        return EXIT_OK
+    except OSError as e:
+        print(f"ERROR: cannot connect to the streaming server at {config['host']}:{config['port']}: {e}",
+              file=sys.stderr)
+        return EXIT_SERVER
+    finally:
+        _stop_reporter(reporter)
+        if publisher is not None:
+            publisher.stop()
+    if not results:
+        print("ERROR: the streaming server has no devices", file=sys.stderr)
+        return EXIT_DEVICE
+
+    status = EXIT_OK
+    for device_id, result in results.items():
+        if isinstance(result, async_recorder.ConnectionLost):
+            # Ended before the duration
+            print(f"\t{device_id}: {result}, {result.n_rows} rows")
+            status = max(status, EXIT_CONNECTION_LOST)
+        elif isinstance(result, Exception):
+            print(f"ERROR: {device_id}: {result}", file=sys.stderr)
+            status = max(status, EXIT_DEVICE)
+        else:
+            print(f"\t{device_id}: stopped, {result} rows")
+    return status
+
+
+def record_pool(config):
+    # Record several devices, or all devices of the server, with
+    # config["workers"] worker processes, see supervisor.py.
+    # Returns an exit status.
+    import asyncio
+    import async_recorder
+    from supervisor import Supervisor
+
+    devices = config["devices"]
+    try:
+        if not devices:
+            devices = asyncio.run(async_recorder.list_devices(config["host"], config["port"]))
+    except OSError as e:
+        print(f"ERROR: cannot connect to the streaming server at {config['host']}:{config['port']}: {e}",
+              file=sys.stderr)
+        return EXIT_SERVER
+    if not devices:
+        print("ERROR: the streaming server has no devices", file=sys.stderr)
+        return EXIT_DEVICE
+
+    try:
+        publisher = _start_publisher(config)
+    except OSError as e:
+        print(f"ERROR: cannot publish on {config['publish']}: {e}", file=sys.stderr)
+        return EXIT_SETUP
+    supervisor = Supervisor(config["subject"], devices, config["workers"], config["streams"], config["backend"],
+                            config["host"], config["port"], publisher=publisher,
+                            buffer_size=config["buffer_size"], flush_rows=config["flush_rows"],
+                            flush_interval=config["flush_interval"], fsync_interval=config["fsync_interval"])
+    reporter = _start_reporter(config, supervisor.metrics)
+    supervisor.start()
+    try:
+        supervisor.run(config["duration"])
+    except KeyboardInterrupt:
+        print("\tStopping")
+    finally:
+        supervisor.stop()
+        _stop_reporter(reporter)
+        if publisher is not None:
+            publisher.stop()
+    failed = [device_id for device_id, state in supervisor.health().items() if state == "failed"]
+    if failed:
+        print("ERROR: lost devices " + ", ".join(failed), file=sys.stderr)
+        return EXIT_CONNECTION_LOST
+    return EXIT_OK
+
+
+def _start_reporter(config, registry):
+    # Returns a started metrics.MetricsReporter for registry, or None
+    from metrics import INTERVAL, MetricsReporter
+    if not config["metrics_interval"] and config["metrics_port"] is None:
+        return None
+    try:
+        reporter = MetricsReporter(registry, config["metrics_interval"] or INTERVAL, config["metrics_port"],
+                                   log=bool(config["metrics_interval"]))
+    except OSError as e:
+        print(f"WARNING: cannot serve metrics on port {config['metrics_port']}: {e}", file=sys.stderr)
+        return None
+    reporter.start()
+    return reporter
+
+
+def _start_publisher(config):
+    # Returns a started publisher.Publisher on config["publish"], or None
+    if not config["publish"]:
+        return None
+    from publisher import Publisher
+    publisher = Publisher(config["publish"])
+    publisher.start()
+    print(f"\tPublishing samples on {publisher.address}")
+    return publisher
+
+
+def _stop_reporter(reporter):
+    if reporter is not None:
+        reporter.stop()
+        if reporter.log:
+            reporter.report()
+
+
+def main(argv = None):
+    # Returns an exit status
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    try:
+        config = load_config(args)
+        from storage import BACKENDS
+        if config["backend"] not in BACKENDS:
+            raise ConfigError("unknown backend " + config["backend"])
+    except ConfigError as e:
+        parser.print_usage(sys.stderr)
+        print(f"{parser.prog}: error: {e}", file=sys.stderr)
+        return EXIT_USAGE
+
+    signal.signal(signal.SIGTERM, _interrupt)
+    if len(config["devices"]) <= 1 and not config["all"]:
+        return record_one(config)
+    return record_pool(config) if config["workers"] else record_many(config)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
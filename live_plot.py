@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+# Tk monitor plotting the live signals of one or more devices.
+#
+# The monitor reads from ring_buffer.LiveBuffers, so nothing is parsed twice
+# and the socket reader is never blocked by drawing. The plots of every device
+# are redrawn by their own loop on a shared guiLoop.FrameScheduler at a fixed
+# frame rate. Each trace is reduced to the minimum
+# and maximum per pixel column before drawing, so the cost of a frame only
+# depends on the width of the plots, not on how long the recording runs.
+# Needs numpy.
+
+import tkinter as tk
+
+import numpy as np
+
+from guiLoop import FrameScheduler, use_tkinter_after
+
+
+STREAMS = ["acc", "bvp", "gsr", "ibi", "hr", "tmp"]
+TITLES = {"acc": "ACC", "bvp": "BVP", "gsr": "GSR", "ibi": "IBI", "hr": "HR", "tmp": "TMP"}
+COLORS = ["#1f77b4", "#d62728", "#2ca02c"]
+
+WIDTH = 400             # Width of a plot in pixels
+HEIGHT = 90             # Height of a plot in pixels
+FPS = 10                # Frames per second
+WINDOW_SECONDS = 30     # Seconds shown in a plot
+
+
+def min_max_decimate(values, n_columns):
+    # Reduce values to a minimum and maximum per column.
+    # Returns an array of 2 * n_columns values (or values itself if it is
+    # short enough), alternating minimum and maximum.
+    # Args:
+    #   values: np.ndarray (n,)
+    #   n_columns: int
+    n_samples = len(values)
+    if n_samples <= 2 * n_columns:
+        return values
+    per_column = n_samples // n_columns
+    trimmed = values[n_samples - per_column * n_columns:].reshape(n_columns, per_column)
+    decimated = np.empty(2 * n_columns, dtype=values.dtype)
+    decimated[0::2] = trimmed.min(axis=1)
+    decimated[1::2] = trimmed.max(axis=1)
+    return decimated
+
+
+class Plot(object):
+    # One canvas showing one stream of one device
+
+    def __init__(self, parent, title, n_traces):
+        self.title = title
+        self.canvas = tk.Canvas(parent, width=WIDTH, height=HEIGHT, background="white",
+                                highlightthickness=1, highlightbackground="#cccccc")
+        self.label = self.canvas.create_text(4, 2, anchor="nw", text=title)
+        self.traces = [self.canvas.create_line(0, 0, 0, 0, fill=COLORS[i % len(COLORS)])
+                       for i in range(n_traces)]
+
+    def draw(self, values):
+        # Args:
+        #   values: np.ndarray (n,) or (n, n_traces)
+        if values.ndim == 1:
+            values = values.reshape(-1, 1)
+        if len(values) < 2:
+            return
+        low = float(values.min())
+        high = float(values.max())
+        scale = (HEIGHT - 16) / (high - low) if high > low else 0.0
+        for trace, column in zip(self.traces, values.T):
+            points = min_max_decimate(column.astype(np.float64), WIDTH // 2)
+            x = np.linspace(0, WIDTH, len(points))
+            y = HEIGHT - 4 - (points - low) * scale
+            coordinates = np.empty(2 * len(points))
+            coordinates[0::2] = x
+            coordinates[1::2] = y
+            self.canvas.coords(trace, *coordinates.tolist())
+        self.canvas.itemconfigure(self.label, text="%s  %.3g .. %.3g" % (self.title, low, high))
+
+
+class LiveMonitor(object):
+
+    def __init__(self, root, buffers, seconds = WINDOW_SECONDS):
+        # Args:
+        #   root: tk.Tk
+        #   buffers: dict of device ID -> ring_buffer.LiveBuffers
+        #   seconds: float, seconds shown in the plots
+        self.root = root
+        self.buffers = buffers
+        self.seconds = seconds
+        self.plots = {}
+        for column, (device, live) in enumerate(buffers.items()):
+            tk.Label(root, text=device).grid(row=0, column=column)
+            for row, stream in enumerate(STREAMS):
+                if stream not in live.buffers:
+                    continue
+                n_traces = 3 if stream == "acc" else 1
+                plot = Plot(root, TITLES[stream], n_traces)
+                plot.canvas.grid(row=row + 1, column=column, padx=2, pady=2)
+                self.plots[(device, stream)] = plot
+
+    def draw(self, device):
+        for stream in STREAMS:
+            plot = self.plots.get((device, stream))
+            if plot is not None:
+                timestamps, values = self.buffers[device].latest(stream, self.seconds)
+                plot.draw(values)
+
+
+def redraw(monitor, device):
+    # Redraw the plots of device once per frame
+    while True:
+        monitor.draw(device)
+        yield
+
+
+def run_monitor(buffers, title = "Empatica E4 live data", fps = FPS):
+    # Open the monitor and run the Tk main loop until the window is closed.
+    # Must be called from the main thread.
+    # Returns the frame statistics of guiLoop.FrameScheduler.stats().
+    # Args:
+    #   buffers: dict of device ID -> ring_buffer.LiveBuffers
+    root = tk.Tk()
+    root.title(title)
+    monitor = LiveMonitor(root, buffers)
+    scheduler = FrameScheduler(root, fps, use_tkinter_after)
+    for device in buffers:
+        scheduler.start(redraw, monitor, device)
+    root.mainloop()
+    return scheduler.stats()
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+
+# Runtime metrics of a recording.
+#
+# Per device and stream:
+#   samples received, expected and observed sample rate in Hz
+# Per device:
+#   bytes received and bytes per second from recv, decode time and writer
+#   lag histograms, writer queue depth, malformed lines, dropped lines and
+#   reconnects
+#
+# Writer lag is the time from receiving a chunk to having written all of its
+# rows. The hot paths only add to counters once per received chunk, under
+# one lock per chunk, so the metrics can stay on while recording.
+#
+# MetricsReporter updates the observed rates every interval seconds, prints
+# them as one line per device and optionally serves all metrics in the
+# Prometheus text format on http://127.0.0.1:<port>/metrics.
+
+import bisect
+import http.server
+import threading
+import time
+
+
+# Nominal sample rates of the E4 streams, None for streams that follow the heart beat
+EXPECTED_RATES = {"acc": 32.0, "bvp": 64.0, "gsr": 4.0, "tmp": 4.0, "ibi": None, "hr": None}
+
+DECODE_BUCKETS = [1e-5, 3e-5, 1e-4, 3e-4, 1e-3, 3e-3, 0.01, 0.03, 0.1]     # Seconds
+LAG_BUCKETS = [1e-4, 1e-3, 0.01, 0.03, 0.1, 0.3, 1.0, 3.0, 10.0]           # Seconds
+
+INTERVAL = 10.0         # Seconds between reports
+
+
+class Histogram(object):
+    # Counts per bucket of cumulative upper bounds, like a Prometheus histogram
+
+    def __init__(self, bounds):
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)     # The last bucket is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding quantile q, inf if beyond the
+        # last bound, None without observations
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(self.bounds + [float("inf")], self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return float("inf")
+
+
+class DeviceMetrics(object):
+
+    def __init__(self, device):
+        self.device = device
+        self.samples = {}               # stream -> samples received
+        self.observed_rates = {}        # stream -> Hz over the last report interval
+        self.bytes_received = 0
+        self.bytes_per_second = 0.0
+        self.malformed_lines = 0
+        self.dropped_lines = 0
+        self.reconnects = 0
+        self.queue_depth = 0            # Largest writer queue depth in the last report interval
+        self._queue_depth = 0
+        self.decode_seconds = Histogram(DECODE_BUCKETS)
+        self.writer_lag_seconds = Histogram(LAG_BUCKETS)
+        self._lock = threading.Lock()
+        self._last_update = time.monotonic()
+        self._last_samples = {}
+        self._last_bytes = 0
+
+    def add_bytes(self, n_bytes):
+        # Called by the receiving thread only
+        self.bytes_received += n_bytes
+
+    def add_chunk(self, counts, n_malformed, decode_seconds, receive_ns, written_ns = None):
+        # Record one decoded and written chunk.
+        # Args:
+        #   counts: dict of stream -> number of samples in the chunk
+        #   n_malformed: int
+        #   decode_seconds: float
+        #   receive_ns: int, time.monotonic_ns() when the chunk was received
+        #   written_ns: int, time.monotonic_ns() when it was written, None for now
+        lag = ((written_ns if written_ns is not None else time.monotonic_ns()) - receive_ns) / 1e9
+        with self._lock:
+            for stream, count in counts.items():
+                self.samples[stream] = self.samples.get(stream, 0) + count
+            self.malformed_lines += n_malformed
+            self.decode_seconds.observe(decode_seconds)
+            self.writer_lag_seconds.observe(lag)
+
+    def add_dropped(self, n_lines):
+        with self._lock:
+            self.dropped_lines += n_lines
+
+    def set_queue_depth(self, depth):
+        if depth > self._queue_depth:
+            self._queue_depth = depth
+
+    def update_rates(self):
+        # Compute the observed rates since the last call, keeping the
+        # previous rates if less than a second has passed
+        now = time.monotonic()
+        elapsed = now - self._last_update
+        if elapsed < 1.0:
+            return
+        with self._lock:
+            samples = dict(self.samples)
+        self.observed_rates = {stream: (count - self._last_samples.get(stream, 0)) / elapsed
+                               for stream, count in samples.items()}
+        self.bytes_per_second = (self.bytes_received - self._last_bytes) / elapsed
+        self._last_samples = samples
+        self._last_bytes = self.bytes_received
+        self._last_update = now
+        self.queue_depth, self._queue_depth = self._queue_depth, 0
+
+    def summary(self):
+        # One line with the rates of the last interval and the error counters
+        rates = []
+        for stream in sorted(self.observed_rates):
+            expected = EXPECTED_RATES.get(stream)
+            rate = "%s %.1f" % (stream, self.observed_rates[stream])
+            rates.append(rate + ("/%g Hz" % expected if expected else " Hz"))
+        decode = self.decode_seconds.quantile(0.99)
+        lag = self.writer_lag_seconds.quantile(0.99)
+        line = "%s: %.1f kB/s, %s" % (self.device, self.bytes_per_second / 1000, ", ".join(rates) or "no samples")
+        line += ", decode p99 %s, lag p99 %s" % (_format_seconds(decode), _format_seconds(lag))
+        line += ", queue %d, malformed %d, dropped %d, reconnects %d" % (
+            self.queue_depth, self.malformed_lines, self.dropped_lines, self.reconnects)
+        return line
+
+
+def _format_seconds(seconds):
+    if seconds is None:
+        return "-"
+    if seconds == float("inf"):
+        return "inf"
+    return "<%g ms" % (seconds * 1000)
+
+
+class MetricsRegistry(object):
+    # DeviceMetrics of every recorded device
+
+    def __init__(self):
+        self.devices = {}
+        self._lock = threading.Lock()
+
+    def device(self, device):
+        # Returns the DeviceMetrics of device, created on first use
+        with self._lock:
+            metrics = self.devices.get(device)
+            if metrics is None:
+                metrics = self.devices[device] = DeviceMetrics(device)
+            return metrics
+
+    def prometheus(self):
+        # Returns all metrics in the Prometheus text exposition format
+        lines = []
+
+        def family(name, type_, help_text, samples):
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s %s" % (name, type_))
+            for labels, value in samples:
+                label_text = ",".join('%s="%s"' % item for item in labels)
+                lines.append("%s{%s} %s" % (name, label_text, _format_value(value)))
+
+        devices = list(self.devices.values())
+        family("e4_samples_total", "counter", "Samples received",
+               [((("device", m.device), ("stream", stream)), count)
+                for m in devices for stream, count in sorted(dict(m.samples).items())])
+        family("e4_expected_hz", "gauge", "Nominal sample rate of the stream",
+               [((("stream", stream),), rate) for stream, rate in EXPECTED_RATES.items() if rate])
+        family("e4_observed_hz", "gauge", "Sample rate over the last report interval",
+               [((("device", m.device), ("stream", stream)), rate)
+                for m in devices for stream, rate in sorted(m.observed_rates.items())])
+        for name, help_text, attribute in [
+                ("e4_received_bytes_total", "Bytes received from the streaming server", "bytes_received"),
+                ("e4_malformed_lines_total", "Lines that could not be decoded", "malformed_lines"),
+                ("e4_dropped_lines_total", "Lines dropped because a writer queue was full", "dropped_lines"),
+                ("e4_reconnects_total", "Successful reconnects after a lost connection", "reconnects")]:
+            family(name, "counter", help_text, [((("device", m.device),), getattr(m, attribute)) for m in devices])
+        family("e4_queue_depth", "gauge", "Largest writer queue depth in the last report interval",
+               [((("device", m.device),), m.queue_depth) for m in devices])
+
+        for name, help_text, attribute in [
+                ("e4_decode_seconds", "Time to decode one received chunk", "decode_seconds"),
+                ("e4_writer_lag_seconds", "Time from receiving a chunk to having written it", "writer_lag_seconds")]:
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s histogram" % name)
+            for m in devices:
+                histogram = getattr(m, attribute)
+                total = 0
+                for bound, count in zip(histogram.bounds + ["+Inf"], histogram.counts):
+                    total += count
+                    lines.append('%s_bucket{device="%s",le="%s"} %d' % (name, m.device, bound, total))
+                lines.append('%s_sum{device="%s"} %s' % (name, m.device, _format_value(histogram.sum)))
+                lines.append('%s_count{device="%s"} %d' % (name, m.device, histogram.count))
+        return "\n".join(lines) + "\n"
+
+
+def _format_value(value):
+    return "%d" % value if isinstance(value, int) else "%.6g" % value
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = self.server.registry.prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsReporter(object):
+    # Background thread updating the rates and printing a line per device
+    # every interval seconds, and an optional HTTP endpoint
+
+    def __init__(self, registry, interval = INTERVAL, port = None, log = True, host = "127.0.0.1"):
+        # Args:
+        #   registry: MetricsRegistry
+        #   interval: float, seconds between updates
+        #   port: int, port of the HTTP endpoint, None for no endpoint
+        #   log: bool, print a line per device every interval
+        self.registry = registry
+        self.interval = interval
+        self.log = log
+        self.server = None
+        if port is not None:
+            self.server = http.server.ThreadingHTTPServer((host, port), _MetricsHandler)
+            self.server.daemon_threads = True
+            self.server.registry = registry
+        self._stopped = threading.Event()
+        self._threads = [threading.Thread(target=self._report_loop, name="e4-metrics", daemon=True)]
+        if self.server is not None:
+            self._threads.append(threading.Thread(target=self.server.serve_forever, name="e4-metrics-http",
+                                                  daemon=True))
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        for thread in self._threads:
+            thread.join()
+
+    def report(self):
+        for metrics in list(self.registry.devices.values()):
+            metrics.update_rates()
+            if self.log:
+                print("\tmetrics " + metrics.summary())
+
+    def _report_loop(self):
+        while not self._stopped.wait(self.interval):
+            self.report()
@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+
+# Stand-in for the E4 streaming server, for load testing without wristbands.
+#
+# Implements the commands used by stream.py:
+#   device_list, device_connect <ID>, pause ON/OFF,
+#   device_subscribe <stream> ON/OFF, device_disconnect
+# After "pause OFF" every connection receives E4_* data lines for its
+# subscribed streams, either synthetic at the E4 sample rates (multiplied by
+# rate_scale) or replayed from a recording of real server output.
+#
+# Faults that can be injected:
+#   lose_after:     send "connection lost to device" after this many seconds
+#   fragment:       split every write into pieces of at most this many bytes
+#   burst:          hold back data and send it in bursts this many seconds apart
+#   send_buffer:    small SO_SNDBUF so slow consumers back up quickly
+#   client_timeout: give up on a client that has not accepted data for this
+#                   many seconds, see slow_client
+#   slow_client:    "drop" discards the data lines a stalled client could not
+#                   take (whole lines, counted in lines_dropped) and keeps
+#                   streaming, "close" ends the connection
+#
+# Usage:
+#   python mock_server.py [--devices N] [--rate-scale X] [--recording FILE] ...
+
+import argparse
+import random
+import socket
+import socketserver
+import threading
+import time
+
+
+# Subscription -> list of (tag, sample rate in Hz, number of values)
+STREAMS = {
+    "acc": [("E4_Acc", 32, 3)],
+    "bvp": [("E4_Bvp", 64, 1)],
+    "gsr": [("E4_Gsr", 4, 1)],
+    "ibi": [("E4_Ibi", 1, 1), ("E4_Hr", 1, 1)],
+    "tmp": [("E4_Temperature", 4, 1)],
+}
+
+TICK = 0.01     # Seconds between data writes of a connection
+
+
+def device_ids(n_devices):
+    # Device IDs like the ones shown by the E4 streaming server
+    return ["%06X" % (0xA00000 + i) for i in range(n_devices)]
+
+
+def format_value(tag, rnd):
+    if tag == "E4_Acc":
+        return "%d %d %d" % (rnd.randint(-128, 127), rnd.randint(-128, 127), rnd.randint(-128, 127))
+    if tag == "E4_Ibi":
+        return "%.6f" % rnd.uniform(0.6, 1.2)
+    if tag == "E4_Hr":
+        return "%.6f" % rnd.uniform(50, 100)
+    if tag == "E4_Temperature":
+        return "%.2f" % rnd.uniform(30, 34)
+    return "%.6f" % rnd.uniform(-100, 100)
+
+
+def read_recording(path):
+    # Returns the E4_* data lines of a recording of server output
+    with open(path, "rb") as f:
+        lines = f.read().decode("utf-8").splitlines()
+    return [line for line in lines if line.startswith("E4_")]
+
+
+class MockE4Handler(socketserver.BaseRequestHandler):
+
+    def setup(self):
+        self.options = self.server.options
+        self.device = None
+        self.subscriptions = set()
+        self.paused = True
+        self.closed = threading.Event()
+        self.send_lock = threading.Lock()
+        self.sender = None
+        self.carry = b""            # Rest of a data line cut short by client_timeout
+        self.rnd = random.Random(self.options.seed)
+        if self.options.send_buffer:
+            self.request.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.options.send_buffer)
+        if self.options.client_timeout:
+            self.request.settimeout(self.options.client_timeout)
+
+    def send(self, text):
+        data = text.encode("utf-8")
+        with self.send_lock:
+            if self.send_bytes(data) < len(data):
+                raise socket.timeout("client stalled")
+
+    def send_bytes(self, data):
+        # Send data in fragments of at most options.fragment bytes.
+        # Returns the number of bytes sent, less than len(data) if the client
+        # did not accept any data for client_timeout seconds.
+        fragment = self.options.fragment or len(data)
+        view = memoryview(data)
+        sent = 0
+        while sent < len(data):
+            try:
+                sent += self.request.send(view[sent:sent + fragment])
+            except socket.timeout:
+                return sent
+            if self.options.fragment:
+                # Give the receiver a chance to see the fragment on its own
+                time.sleep(0)
+        return sent
+
+    def send_lines(self, lines):
+        # Send data lines, dropping what a stalled client cannot take if
+        # slow_client is "drop". A line cut short is finished first the
+        # next time, so the client never sees a partial line.
+        data = self.carry + "".join(lines).encode("utf-8")
+        with self.send_lock:
+            sent = self.send_bytes(data)
+        if sent == len(data):
+            self.carry = b""
+            self.server.count_lines(len(lines))
+            return
+        if self.options.slow_client != "drop":
+            raise socket.timeout("client stalled")
+        end = sent if sent == 0 or data[sent - 1:sent] == b"\n" else data.find(b"\n", sent) + 1
+        self.carry = data[sent:end]
+        n_dropped = data.count(b"\n", end)
+        self.server.count_lines(len(lines) - n_dropped, n_dropped)
+
+    def reply(self, text):
+        self.send("R " + text + "\n")
+
+    def handle(self):
+        buffer = b""
+        try:
+            while not self.closed.is_set():
+                try:
+                    data = self.request.recv(4096)
+                except socket.timeout:
+                    # Only sending gives up on a client, see client_timeout
+                    continue
+                if not data:
+                    break
+                buffer += data
+                while b"\n" in buffer:
+                    line, buffer = buffer.split(b"\n", 1)
+                    self.command(line.decode("utf-8").strip())
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.closed.set()
+
+    def command(self, line):
+        fields = line.split()
+        if not fields:
+            return
+        name = fields[0]
+        devices = self.server.devices
+        if name == "device_list":
+            self.reply("device_list %d" % len(devices) + "".join(" | %s Empatica_E4" % d for d in devices))
+        elif name == "device_connect":
+            if len(fields) > 1 and fields[1].upper() in devices:
+                self.device = fields[1].upper()
+                self.reply("device_connect OK")
+            else:
+                self.reply("device_connect ERR The requested device is not available")
+        elif name == "pause":
+            self.paused = len(fields) < 2 or fields[1].upper() != "OFF"
+            self.reply("pause " + ("ON" if self.paused else "OFF"))
+            if not self.paused and self.sender is None and self.device is not None:
+                self.sender = threading.Thread(target=self.stream_data, daemon=True)
+                self.sender.start()
+        elif name == "device_subscribe":
+            if len(fields) > 2 and fields[1].lower() in STREAMS:
+                if fields[2].upper() == "ON":
+                    self.subscriptions.add(fields[1].lower())
+                else:
+                    self.subscriptions.discard(fields[1].lower())
+                self.reply("device_subscribe %s OK" % fields[1].lower())
+            else:
+                self.reply("device_subscribe ERR unknown stream")
+        elif name == "device_disconnect":
+            self.device = None
+            self.reply("device_disconnect OK")
+        else:
+            self.reply(name + " ERR unknown command")
+
+    def stream_data(self):
+        options = self.options
+        start = time.time()
+        sent = {}           # tag -> number of samples sent
+        last_send = start
+        replay = self.server.recording
+        replay_position = 0
+        replay_rate = options.replay_rate * options.rate_scale
+        pending = []
+        try:
+            while not self.closed.is_set() and self.device is not None:
+                time.sleep(TICK)
+                now = time.time()
+                if options.lose_after is not None and now - start >= options.lose_after:
+                    self.send("R connection lost to device %s\n" % self.device)
+                    return
+                if self.paused:
+                    continue
+
+                if replay:
+                    due = int((now - start) * replay_rate)
+                    while replay_position < due:
+                        pending.append(replay[replay_position % len(replay)] + "\n")
+                        replay_position += 1
+                else:
+                    for subscription in self.subscriptions:
+                        for tag, rate, _ in STREAMS[subscription]:
+                            rate *= options.rate_scale
+                            due = int((now - start) * rate)
+                            for i in range(sent.get(tag, 0), due):
+                                timestamp = "%.3f" % (start + i / rate)
+                                if options.decimal_comma:
+                                    line = tag + " " + timestamp.replace(".", ",") + " " + format_value(tag, self.rnd).replace(".", ",")
+                                else:
+                                    line = tag + " " + timestamp + " " + format_value(tag, self.rnd)
+                                pending.append(line + "\n")
+                            sent[tag] = due
+
+                if pending and now - last_send >= options.burst:
+                    self.send_lines(pending)
+                    pending = []
+                    last_send = now
+        except (ConnectionError, OSError):
+            self.closed.set()
+
+
+class MockE4Server(socketserver.ThreadingTCPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, options, host = "127.0.0.1", port = 28000):
+        # Args:
+        #   options: argparse.Namespace as returned by parse_args(), use
+        #       parse_args([]) for the defaults
+        #   port: int, 0 picks a free port (see server_address)
+        self.options = options
+        self.devices = device_ids(options.devices)
+        self.recording = read_recording(options.recording) if options.recording else None
+        self.lines_sent = 0
+        self.lines_dropped = 0          # Data lines a stalled client could not take
+        self._count_lock = threading.Lock()
+        socketserver.ThreadingTCPServer.__init__(self, (host, port), MockE4Handler)
+
+    def count_lines(self, n_lines, n_dropped = 0):
+        with self._count_lock:
+            self.lines_sent += n_lines
+            self.lines_dropped += n_dropped
+
+    def start(self):
+        # Serve on a background thread, stop with shutdown()
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Mock Empatica E4 streaming server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=28000)
+    parser.add_argument("--devices", type=int, default=1, help="number of devices in the device list")
+    parser.add_argument("--rate-scale", type=float, default=1.0, help="multiply all sample rates")
+    parser.add_argument("--recording", help="replay E4_* lines from this file instead of synthetic data")
+    parser.add_argument("--replay-rate", type=float, default=110.0, help="lines per second when replaying")
+    parser.add_argument("--decimal-comma", action="store_true", help="use comma as decimal separator")
+    parser.add_argument("--lose-after", type=float, default=None, help="seconds until the device connection is lost")
+    parser.add_argument("--fragment", type=int, default=0, help="maximum bytes per TCP write, 0 for no limit")
+    parser.add_argument("--burst", type=float, default=0.0, help="seconds between bursts of data")
+    parser.add_argument("--send-buffer", type=int, default=0, help="SO_SNDBUF in bytes, 0 for the default")
+    parser.add_argument("--client-timeout", type=float, default=None,
+                        help="seconds a client may not accept data before slow-client applies")
+    parser.add_argument("--slow-client", choices=["drop", "close"], default="drop",
+                        help="drop the lines a stalled client cannot take, or close its connection")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser
+
+
+def parse_args(args = None):
+    return build_parser().parse_args(args)
+
+
+def main():
+    options = parse_args()
+    server = MockE4Server(options, options.host, options.port)
+    print(f"Mock E4 streaming server on {options.host}:{server.server_address[1]} "
+          f"with devices {', '.join(server.devices)}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+
+# Producer/consumer pipeline decoupling the socket from the disk.
+#
+# A reader thread only receives and frames data from the E4 streaming server
+# and puts lists of complete lines, together with the time.monotonic_ns() at
+# which they were received, on bounded queues. One or more writer
+# threads take the lines off the queues, decode them and write the rows.
+# Each stream is owned by exactly one writer thread, so rows of a stream are
+# written in the order they were received.
+#
+# In batch mode a writer decodes the chunks waiting in its queue together,
+# up to BATCH_LINES lines, so batches grow when it falls behind.
+#
+# When a queue is full the reader drops the chunk instead of blocking, so a
+# slow disk never stalls recv(). Drops and queue high-water marks are counted
+# in PipelineMetrics, and rates, decode time and writer lag in a
+# metrics.DeviceMetrics if one is given.
+
+import queue
+import socket
+import threading
+import time
+
+from decoder import DECODERS, decode_lines
+from framing import LineFramer, split_connection_lost
+
+
+BATCH_LINES = 4096      # Most lines of waiting chunks decoded together in batch mode
+
+
+class PipelineMetrics(object):
+
+    def __init__(self, n_queues):
+        self.bytes_received = 0
+        self.chunks_queued = 0
+        self.dropped_chunks = 0
+        self.dropped_lines = 0
+        self.malformed_lines = 0
+        self.rows_written = 0
+        self.queue_high_water = [0] * n_queues
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+
+class StreamPipeline(object):
+
+    def __init__(self, sock, writers, is_streaming, n_writers = 1, queue_size = 256,
+                 recv_size = 4096, batch_mode = False, on_connection_lost = None, clock = None,
+                 device_metrics = None):
+        # Args:
+        #   sock: connected socket.socket, already subscribed
+        #   writers: dict of stream name -> storage writer (see storage.py)
+        #   is_streaming: callable returning False when the pipeline should stop
+        #   n_writers: int, number of writer threads
+        #   queue_size: int, maximum number of chunks waiting per writer
+        #   recv_size: int, maximum number of bytes per recv
+        #   batch_mode: bool, decode with batch.BlockDecoder (requires numpy)
+        #   on_connection_lost: callable, called by the reader when the device
+        #       or server connection is lost. The pipeline stops afterwards.
+        #   clock: clock.ClockRecorder receiving the time.monotonic_ns() of
+        #       every received chunk, or None
+        #   device_metrics: metrics.DeviceMetrics, or None
+        self.sock = sock
+        self.writers = writers
+        self.is_streaming = is_streaming
+        self.recv_size = recv_size
+        self.batch_mode = batch_mode
+        self.on_connection_lost = on_connection_lost
+        self.clock = clock
+        self.device_metrics = device_metrics
+        self.metrics = PipelineMetrics(n_writers)
+
+        self._queues = [queue.Queue(queue_size) for _ in range(n_writers)]
+        # Tag -> index of the writer owning that stream
+        self._routes = {tag: i % n_writers for i, tag in enumerate(DECODERS)}
+        self._stopped = threading.Event()
+        self._metrics_lock = threading.Lock()
+
+        self._reader = threading.Thread(target=self._read_loop, name="e4-reader")
+        self._writers = [threading.Thread(target=self._write_loop, args=(q,), name="e4-writer-%d" % i)
+                         for i, q in enumerate(self._queues)]
+
+    def start(self):
+        for thread in self._writers:
+            thread.start()
+        self._reader.start()
+
+    def stop(self):
+        # Ask both stages to stop. Pending chunks are still written.
+        self._stopped.set()
+
+    def join(self, timeout = None):
+        self._reader.join(timeout)
+        for thread in self._writers:
+            thread.join(timeout)
+
+    def _running(self):
+        return self.is_streaming() and not self._stopped.is_set()
+
+    def _read_loop(self):
+        framer = LineFramer()
+        previous_timeout = self.sock.gettimeout()
+        # Wake up regularly to notice when streaming is stopped
+        self.sock.settimeout(0.5)
+        try:
+            while self._running():
+                try:
+                    n_bytes = framer.recv_from(self.sock, self.recv_size)
+                except socket.timeout:
+                    continue
+                receive_ns = time.monotonic_ns()
+                if n_bytes == 0:
+                    print("\tConnection closed by the streaming server")
+                    self._connection_lost()
+                    break
+                self.metrics.bytes_received += n_bytes
+                if self.device_metrics is not None:
+                    self.device_metrics.add_bytes(n_bytes)
+
+                lines, lost = split_connection_lost(framer.lines())
+                if lines:
+                    self._dispatch(receive_ns, lines)
+                if lost:
+                    self._connection_lost()
+                    break
+        finally:
+            self.sock.settimeout(previous_timeout)
+            self._stopped.set()
+            for q in self._queues:
+                # Sentinel, blocks until the writer has room so it is never lost
+                q.put(None)
+
+    def _connection_lost(self):
+        if self.on_connection_lost is not None:
+            self.on_connection_lost()
+
+    def _dispatch(self, receive_ns, lines):
+        if len(self._queues) == 1:
+            self._put(0, receive_ns, lines)
+            return
+        shards = [[] for _ in self._queues]
+        routes = self._routes
+        for line in lines:
+            index = routes.get(line.partition(" ")[0])
+            if index is not None:
+                shards[index].append(line)
+        for index, shard in enumerate(shards):
+            if shard:
+                self._put(index, receive_ns, shard)
+
+    def _put(self, index, receive_ns, lines):
+        q = self._queues[index]
+        try:
+            q.put_nowait((receive_ns, lines))
+        except queue.Full:
+            self.metrics.dropped_chunks += 1
+            self.metrics.dropped_lines += len(lines)
+            if self.device_metrics is not None:
+                self.device_metrics.add_dropped(len(lines))
+            return
+        self.metrics.chunks_queued += 1
+        depth = q.qsize()
+        if self.device_metrics is not None:
+            self.device_metrics.set_queue_depth(depth)
+        if depth > self.metrics.queue_high_water[index]:
+            self.metrics.queue_high_water[index] = depth
+
+    def _write_loop(self, q):
+        if self.batch_mode:
+            from batch import BlockDecoder
+            block_decoder = BlockDecoder()
+        stop = False
+        while not stop:
+            item = q.get()
+            if item is None:
+                break
+            receive_ns, lines = item
+            if self.batch_mode:
+                # Decode the chunks that are already waiting together, with
+                # the receive time of the newest
+                batch = None
+                while len(batch or lines) < BATCH_LINES:
+                    try:
+                        item = q.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        stop = True
+                        break
+                    if batch is None:
+                        batch = list(lines)
+                    receive_ns, more = item
+                    batch.extend(more)
+                if batch is not None:
+                    lines = batch
+            n_rows = 0
+            counts = {}
+            decode_start = time.perf_counter()
+            if self.batch_mode:
+                blocks, n_malformed = block_decoder.decode(lines)
+                decode_seconds = time.perf_counter() - decode_start
+                if self.clock is not None:
+                    self.clock.observe_blocks(receive_ns, blocks)
+                for stream_name, (timestamps, values) in blocks.items():
+                    writer = self.writers.get(stream_name)
+                    if writer is not None:
+                        writer.write_block(timestamps, values)
+                        n_rows += len(timestamps)
+                    counts[stream_name] = len(timestamps)
+            else:
+                rows, n_malformed = decode_lines(lines)
+                decode_seconds = time.perf_counter() - decode_start
+                if self.clock is not None:
+                    self.clock.observe_rows(receive_ns, rows)
+                for stream_name, row in rows:
+                    writer = self.writers.get(stream_name)
+                    if writer is not None:
+                        writer.writerow(row)
+                        n_rows += 1
+                    counts[stream_name] = counts.get(stream_name, 0) + 1
+            if self.device_metrics is not None:
+                self.device_metrics.add_chunk(counts, n_malformed, decode_seconds, receive_ns)
+            with self._metrics_lock:
+                self.metrics.rows_written += n_rows
+                self.metrics.malformed_lines += n_malformed
@@ -0,0 +1,507 @@
+#!/usr/bin/env python3
+
+# Re-broadcast the live samples to local subscribers.
+#
+# A Publisher listens on a local TCP port or UNIX socket and sends every
+# published block of samples to all connected subscribers as one binary
+# frame:
+#   header:   FRAME, little endian
+#     magic        2 bytes, b"E4"
+#     kind         uint8, BLOCK or GAP
+#     stream       uint8, index in STREAMS
+#     device       8 bytes, ASCII device ID padded with zeros
+#     sequence     uint32, frame number of the publisher
+#     n_samples    uint32
+#   BLOCK payload:  n_samples float64 timestamps, then the values in
+#                   COLUMN_TYPES (storage.py) order, row by row: three int16
+#                   per sample for acc, one float32 for the other streams
+#   GAP payload:    float64 time the connection was lost, float64 outage in seconds
+# With numpy, np.frombuffer(payload, "<f8", n_samples) gives the timestamps.
+#
+# Publishing never blocks the recording: frames are queued per subscriber
+# and sent by one background thread with non-blocking sockets. When a
+# subscriber has more than max_queue_bytes queued, it is disconnected
+# (slow = "drop") or its oldest queued frames are discarded (slow =
+# "coalesce"), so it keeps receiving the newest data. Subscribers see the
+# discarded frames as jumps in the sequence numbers.
+#
+# PublishWriter has the writer methods of storage.py, so it can be added to
+# a recorder with storage.TeeWriter. Rows written one at a time are sent in
+# blocks of up to PUBLISH_ROWS rows, at most PUBLISH_DELAY seconds late:
+# the send loop of the publisher flushes the rows that waited that long.
+# Publisher.stop() publishes the rows still waiting and sends the queued
+# frames for up to STOP_DRAIN seconds before disconnecting.
+#
+# Usage:
+#   publisher = Publisher("tcp:127.0.0.1:28100")    # or "unix:/tmp/e4.sock"
+#   publisher.start()
+#   writer = TeeWriter(storage.writers["bvp"], publisher.writer(device_id, "bvp"))
+#   ...
+#   for frame in Subscriber("tcp:127.0.0.1:28100").frames():
+#       print(frame.device, frame.stream, len(frame.timestamps))
+
+import collections
+import selectors
+import socket
+import struct
+import threading
+import time
+import weakref
+
+
+STREAMS = ["acc", "bvp", "gsr", "ibi", "hr", "tmp"]
+VALUE_FORMATS = {"acc": "hhh", "bvp": "f", "gsr": "f", "ibi": "f", "hr": "f", "tmp": "f"}
+
+FRAME = struct.Struct("<2sBB8sII")
+MAGIC = b"E4"
+BLOCK = 1
+GAP = 2
+GAP_PAYLOAD = struct.Struct("<dd")
+
+MAX_QUEUE_BYTES = 1024 * 1024   # Bytes queued per subscriber before it counts as slow
+SLOW = "coalesce"               # "coalesce" or "drop", see above
+PUBLISH_ROWS = 64               # Rows collected by PublishWriter per frame
+PUBLISH_DELAY = 0.05            # Seconds a row may wait in PublishWriter
+SEND_SIZE = 64 * 1024           # Bytes passed to one send()
+STOP_DRAIN = 1.0                # Seconds stop() waits for the queued frames to be sent
+
+
+Frame = collections.namedtuple("Frame", ["kind", "sequence", "device", "stream", "timestamps", "values"])
+# For GAP frames timestamps is [lost_at] and values is [duration]
+
+
+def parse_address(address):
+    # Returns (socket family, socket address) of "tcp:HOST:PORT", "PORT" or "unix:PATH"
+    if address.startswith("unix:"):
+        return socket.AF_UNIX, address[len("unix:"):]
+    if address.startswith("tcp:"):
+        address = address[len("tcp:"):]
+    host, _, port = address.rpartition(":")
+    return socket.AF_INET, (host or "127.0.0.1", int(port))
+
+
+def encode_block(sequence, device, stream, timestamps, values):
+    # Returns the frame of a block given as np.ndarray
+    n_samples = len(timestamps)
+    header = FRAME.pack(MAGIC, BLOCK, STREAMS.index(stream), (device or "").encode("ascii"), sequence, n_samples)
+    value_type = "<i2" if stream == "acc" else "<f4"
+    return b"".join([header, timestamps.astype("<f8").tobytes(), values.astype(value_type).tobytes()])
+
+
+def encode_rows(sequence, device, stream, rows):
+    # Returns the frame of a list of rows [timestamp, value ...]
+    n_samples = len(rows)
+    columns = list(zip(*rows))
+    header = FRAME.pack(MAGIC, BLOCK, STREAMS.index(stream), (device or "").encode("ascii"), sequence, n_samples)
+    timestamps = struct.pack("<%dd" % n_samples, *columns[0])
+    values = [value for row in rows for value in row[1:]]
+    return header + timestamps + struct.pack("<%d%s" % (len(values), VALUE_FORMATS[stream][0]), *values)
+
+
+def encode_gap(sequence, device, stream, lost_at, duration):
+    return (FRAME.pack(MAGIC, GAP, STREAMS.index(stream), (device or "").encode("ascii"), sequence, 0)
+            + GAP_PAYLOAD.pack(lost_at, duration))
+
+
+def payload_size(kind, stream, n_samples):
+    if kind == GAP:
+        return GAP_PAYLOAD.size
+    return n_samples * (8 + struct.calcsize("<" + VALUE_FORMATS[stream]))
+
+
+def decode_frame(header, payload):
+    # Returns the Frame of a header and its payload
+    _, kind, stream_index, device, sequence, n_samples = FRAME.unpack(header)
+    stream = STREAMS[stream_index]
+    device = device.rstrip(b"\0").decode("ascii")
+    if kind == GAP:
+        lost_at, duration = GAP_PAYLOAD.unpack(payload)
+        return Frame(kind, sequence, device, stream, [lost_at], [duration])
+    timestamps = list(struct.unpack_from("<%dd" % n_samples, payload))
+    value_format = VALUE_FORMATS[stream]
+    values = list(struct.unpack_from("<%d%s" % (n_samples * len(value_format), value_format[0]),
+                                     payload, 8 * n_samples))
+    if len(value_format) > 1:
+        width = len(value_format)
+        values = [values[i:i + width] for i in range(0, len(values), width)]
+    return Frame(kind, sequence, device, stream, timestamps, values)
+
+
+class _Subscriber(object):
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.frames = collections.deque()
+        self.queued_bytes = 0
+        self.offset = 0                 # Bytes of frames[0] already sent
+        self.coalesced_frames = 0
+        self.closed = False
+        self.slow = False               # Disconnected for being too slow
+
+
+class PublisherStats(object):
+
+    def __init__(self):
+        self.frames_published = 0
+        self.subscribers_connected = 0
+        self.subscribers_dropped = 0
+        self.frames_coalesced = 0
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+
+class Publisher(object):
+
+    def __init__(self, address, max_queue_bytes = MAX_QUEUE_BYTES, slow = SLOW):
+        # Args:
+        #   address: "tcp:HOST:PORT", "PORT" or "unix:PATH", see parse_address()
+        #   max_queue_bytes: int, bytes queued per subscriber before it counts as slow
+        #   slow: "coalesce" or "drop"
+        if slow not in ("coalesce", "drop"):
+            raise ValueError("unknown slow subscriber policy " + str(slow))
+        self.max_queue_bytes = max_queue_bytes
+        self.slow = slow
+        self.stats = PublisherStats()
+        self.subscribers = []
+        self._sequence = 0
+        self._lock = threading.Lock()
+        self._running = False
+        self._drain_until = 0.0
+        self._thread = None
+        self._writers = weakref.WeakSet()
+        family, sockaddr = parse_address(address)
+        self._unix_path = sockaddr if family == socket.AF_UNIX else None
+        self.listener = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            if family == socket.AF_INET:
+                self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.listener.bind(sockaddr)
+            self.listener.listen()
+        except:
+            self.listener.close()
+            raise
+        self.listener.setblocking(False)
+        # The actual address, e.g. the port chosen for port 0
+        if family == socket.AF_UNIX:
+            self.address = "unix:" + sockaddr
+        else:
+            self.address = "tcp:%s:%d" % self.listener.getsockname()[:2]
+        self._wakeup_receive, self._wakeup_send = socket.socketpair()
+        self._wakeup_receive.setblocking(False)
+        self._wakeup_send.setblocking(False)
+        self._wakeup_pending = False
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._send_loop, name="e4-publisher", daemon=True)
+        self._thread.start()
+
+    def stop(self, drain = STOP_DRAIN):
+        # Publish the rows waiting in the writers, send the queued frames for
+        # at most drain seconds and disconnect all subscribers
+        self.flush_writers()
+        self._drain_until = time.monotonic() + drain
+        self._running = False
+        self._wakeup()
+        if self._thread is not None:
+            self._thread.join()
+        for subscriber in self.subscribers:
+            subscriber.sock.close()
+        self.subscribers = []
+        self.listener.close()
+        self._wakeup_receive.close()
+        self._wakeup_send.close()
+        if self._unix_path is not None:
+            import os
+            try:
+                os.unlink(self._unix_path)
+            except OSError:
+                pass
+
+    def writer(self, device, stream):
+        # Returns a PublishWriter of the stream of a device
+        writer = PublishWriter(self, device, stream)
+        with self._lock:
+            self._writers.add(writer)
+        self._wakeup()          # The send loop shortens its select timeout for the writer
+        return writer
+
+    def flush_writers(self):
+        # Publish the rows waiting in the writers of this publisher
+        for writer in self._writer_list():
+            writer.flush()
+
+    def _writer_list(self):
+        with self._lock:
+            return list(self._writers)
+
+    def _flush_due_writers(self):
+        # Publish the rows that waited max_delay in the writers.
+        # Returns the seconds until the next rows are due, at most 1.
+        timeout = 1.0
+        now = time.monotonic()
+        for writer in self._writer_list():
+            timeout = min(timeout, writer.flush_due(now))
+        return timeout
+
+    def publish_block(self, device, stream, timestamps, values):
+        # Publish a block of samples given as np.ndarray
+        if len(timestamps) and self.subscribers:
+            self._publish(encode_block, device, stream, timestamps, values)
+
+    def publish_rows(self, device, stream, rows):
+        # Publish a list of rows [timestamp, value ...]
+        if rows and self.subscribers:
+            self._publish(encode_rows, device, stream, rows)
+
+    def publish_gap(self, device, stream, lost_at, duration):
+        if self.subscribers:
+            self._publish(encode_gap, device, stream, lost_at, duration)
+
+    def _publish(self, encode, device, stream, *data):
+        # Called by the recording threads, only takes the lock to queue the frame
+        with self._lock:
+            frame = encode(self._sequence, device, stream, *data)
+            self._sequence = (self._sequence + 1) & 0xFFFFFFFF
+            self.stats.frames_published += 1
+            for subscriber in self.subscribers:
+                if subscriber.closed:
+                    continue
+                if subscriber.queued_bytes + len(frame) > self.max_queue_bytes:
+                    if self.slow == "drop":
+                        subscriber.closed = subscriber.slow = True
+                        continue
+                    self._coalesce(subscriber, len(frame))
+                subscriber.frames.append(frame)
+                subscriber.queued_bytes += len(frame)
+            wakeup = not self._wakeup_pending
+            self._wakeup_pending = True
+        if wakeup:
+            self._wakeup()
+
+    def _coalesce(self, subscriber, n_bytes):
+        # Discard the oldest frames until n_bytes fit. The first frame may be
+        # in the middle of being sent and is kept.
+        while len(subscriber.frames) > 1 and subscriber.queued_bytes + n_bytes > self.max_queue_bytes:
+            frame = subscriber.frames[1]
+            del subscriber.frames[1]
+            subscriber.queued_bytes -= len(frame)
+            subscriber.coalesced_frames += 1
+            self.stats.frames_coalesced += 1
+
+    def _wakeup(self):
+        try:
+            self._wakeup_send.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass
+
+    def _send_loop(self):
+        selector = selectors.DefaultSelector()
+        selector.register(self.listener, selectors.EVENT_READ, "accept")
+        selector.register(self._wakeup_receive, selectors.EVENT_READ, "wakeup")
+        try:
+            while self._running or self._draining():
+                for key, events in selector.select(self._flush_due_writers()):
+                    if key.data == "accept":
+                        self._accept(selector)
+                    elif key.data == "wakeup":
+                        try:
+                            while self._wakeup_receive.recv(4096):
+                                pass
+                        except BlockingIOError:
+                            pass
+                    elif events & selectors.EVENT_READ and not self._receive(key.data):
+                        key.data.closed = True
+                    elif events & selectors.EVENT_WRITE:
+                        self._send(key.data)
+                self._update(selector)
+        finally:
+            selector.close()
+
+    def _draining(self):
+        # True while stop() waits for queued frames to be sent
+        with self._lock:
+            waiting = any(subscriber.frames and not subscriber.closed for subscriber in self.subscribers)
+        return waiting and time.monotonic() < self._drain_until
+
+    def _accept(self, selector):
+        try:
+            sock, address = self.listener.accept()
+        except BlockingIOError:
+            return
+        sock.setblocking(False)
+        subscriber = _Subscriber(sock, address)
+        selector.register(sock, selectors.EVENT_READ, subscriber)
+        with self._lock:
+            self.subscribers = self.subscribers + [subscriber]
+        self.stats.subscribers_connected += 1
+        print(f"\tPublisher: subscriber {address or 'local'} connected")
+
+    def _receive(self, subscriber):
+        # Subscribers do not send anything, returns False when it disconnected
+        try:
+            return bool(subscriber.sock.recv(4096))
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+
+    def _send(self, subscriber):
+        while subscriber.frames:
+            with self._lock:
+                frame = subscriber.frames[0]
+                offset = subscriber.offset
+            try:
+                n_bytes = subscriber.sock.send(memoryview(frame)[offset:offset + SEND_SIZE])
+            except BlockingIOError:
+                return
+            except OSError:
+                subscriber.closed = True
+                return
+            with self._lock:
+                subscriber.offset += n_bytes
+                if subscriber.offset == len(frame):
+                    subscriber.frames.popleft()
+                    subscriber.queued_bytes -= len(frame)
+                    subscriber.offset = 0
+
+    def _update(self, selector):
+        # Remove closed subscribers and watch the sockets with queued frames for writing
+        with self._lock:
+            self._wakeup_pending = False
+            closed = [subscriber for subscriber in self.subscribers if subscriber.closed]
+            if closed:
+                self.subscribers = [subscriber for subscriber in self.subscribers if not subscriber.closed]
+            waiting = [subscriber for subscriber in self.subscribers if subscriber.frames]
+        for subscriber in closed:
+            selector.unregister(subscriber.sock)
+            subscriber.sock.close()
+            if subscriber.slow:
+                self.stats.subscribers_dropped += 1
+                print(f"\tPublisher: dropped slow subscriber {subscriber.address or 'local'}")
+            else:
+                print(f"\tPublisher: subscriber {subscriber.address or 'local'} disconnected")
+        for subscriber in self.subscribers:
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if subscriber in waiting else 0)
+            if selector.get_key(subscriber.sock).events != events:
+                selector.modify(subscriber.sock, events, subscriber)
+
+
+class PublishWriter(object):
+    # Storage writer interface publishing the samples of one stream of a device
+
+    def __init__(self, publisher, device, stream, max_rows = PUBLISH_ROWS, max_delay = PUBLISH_DELAY):
+        self.publisher = publisher
+        self.device = device
+        self.stream = stream
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self._rows = []
+        self._first_row = 0.0
+        # The rows are written by a recording thread and flushed by the send
+        # loop of the publisher as well
+        self._lock = threading.Lock()
+
+    def writerow(self, row):
+        with self._lock:
+            if not self._rows:
+                self._first_row = time.monotonic()
+            self._rows.append(row)
+            if len(self._rows) >= self.max_rows:
+                self._publish_rows()
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def write_block(self, timestamps, values):
+        with self._lock:
+            self._publish_rows()
+            self.publisher.publish_block(self.device, self.stream, timestamps, values)
+
+    def write_gap(self, lost_at, duration):
+        with self._lock:
+            self._publish_rows()
+            self.publisher.publish_gap(self.device, self.stream, lost_at, duration)
+
+    def flush(self):
+        with self._lock:
+            self._publish_rows()
+
+    def flush_due(self, now):
+        # Flush if the oldest row has waited max_delay at monotonic time now.
+        # Returns the seconds until the waiting rows are due.
+        with self._lock:
+            if self._rows:
+                wait = self._first_row + self.max_delay - now
+                if wait > 0:
+                    return wait
+                self._publish_rows()
+            return self.max_delay
+
+    def _publish_rows(self):
+        rows, self._rows = self._rows, []
+        self.publisher.publish_rows(self.device, self.stream, rows)
+
+    def close(self):
+        self.flush()
+
+
+class Subscriber(object):
+    # Client of a Publisher
+
+    def __init__(self, address, timeout = None):
+        family, sockaddr = parse_address(address)
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(sockaddr)
+        self._file = self.sock.makefile("rb")
+
+    def frames(self):
+        # Yields a Frame for every received frame until the publisher disconnects
+        while True:
+            header = self._file.read(FRAME.size)
+            if len(header) < FRAME.size:
+                return
+            magic, kind, stream_index, _, _, n_samples = FRAME.unpack(header)
+            if magic != MAGIC:
+                raise ValueError("not a publisher frame")
+            size = payload_size(kind, STREAMS[stream_index], n_samples)
+            payload = self._file.read(size)
+            if len(payload) < size:
+                return
+            yield decode_frame(header, payload)
+
+    def close(self):
+        self._file.close()
+        self.sock.close()
+
+
+def main():
+    # Print the frames of a publisher, e.g. python publisher.py tcp:127.0.0.1:28100
+    import argparse
+    parser = argparse.ArgumentParser(description="Print the frames sent by a publisher.")
+    parser.add_argument("address", help="tcp:HOST:PORT, PORT or unix:PATH")
+    args = parser.parse_args()
+    subscriber = Subscriber(args.address)
+    sequence = None
+    try:
+        for frame in subscriber.frames():
+            if sequence is not None and frame.sequence != (sequence + 1) & 0xFFFFFFFF:
+                print(f"\t{(frame.sequence - sequence - 1) & 0xFFFFFFFF} frames skipped")
+            sequence = frame.sequence
+            if frame.kind == GAP:
+                print(f"{frame.device} {frame.stream} gap at {frame.timestamps[0]} for {frame.values[0]:.1f} s")
+            else:
+                print(f"{frame.device} {frame.stream} {len(frame.timestamps)} samples, "
+                      f"{frame.timestamps[0]:.3f} {frame.values[-1]}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        subscriber.close()
+
+
+if __name__ == "__main__":
+    main()
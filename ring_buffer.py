@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+# Live in-memory ring buffers holding the most recent samples of each stream.
+#
+# Every buffer is a preallocated NumPy array of twice its capacity. Each
+# sample is written at position i and i + capacity, so the latest n samples
+# are always one contiguous slice and can be returned as a view without
+# copying. There is a single writer (the ingest thread) and the number of
+# samples is published after the data is written, so readers need no lock.
+#
+# A view returned by latest() stays valid until the writer has wrapped
+# around, i.e. for about the configured number of seconds. Copy it to keep it
+# longer. Needs numpy.
+#
+# Usage:
+#   buffers = LiveBuffers(seconds=60)
+#   ...  pass buffers.writers[stream] to the recorder, e.g. with storage.TeeWriter
+#   timestamps, values = buffers.latest("gsr", 10)
+
+import numpy as np
+
+from storage import COLUMN_TYPES
+
+
+# Nominal sample rate per stream. IBI and HR arrive once per beat, so they
+# use an upper bound.
+SAMPLE_RATES = {"acc": 32, "bvp": 64, "gsr": 4, "ibi": 4, "hr": 4, "tmp": 4}
+
+
+class RingBuffer(object):
+
+    def __init__(self, capacity, n_values = 1, dtype = np.float32):
+        # Args:
+        #   capacity: int, number of samples kept
+        #   n_values: int, values per sample besides the timestamp
+        #   dtype: dtype of the values
+        self.capacity = capacity
+        self.count = 0          # Number of samples written so far
+        self._timestamps = np.zeros(2 * capacity, dtype=np.float64)
+        shape = (2 * capacity, n_values) if n_values > 1 else (2 * capacity,)
+        self._values = np.zeros(shape, dtype=dtype)
+
+    def append(self, timestamp, values):
+        position = self.count % self.capacity
+        for offset in (position, position + self.capacity):
+            self._timestamps[offset] = timestamp
+            self._values[offset] = values
+        # Publish the sample after it has been written
+        self.count += 1
+
+    def extend(self, timestamps, values):
+        # Append a block of samples
+        # Args:
+        #   timestamps: np.ndarray (n,)
+        #   values: np.ndarray (n,) or (n, n_values)
+        n_samples = len(timestamps)
+        if n_samples > self.capacity:
+            timestamps = timestamps[-self.capacity:]
+            values = values[-self.capacity:]
+            skipped = n_samples - self.capacity
+        else:
+            skipped = 0
+        positions = (self.count + skipped + np.arange(len(timestamps))) % self.capacity
+        for offset in (0, self.capacity):
+            self._timestamps[positions + offset] = timestamps
+            self._values[positions + offset] = values
+        self.count += n_samples
+
+    def last(self, n_samples):
+        # Returns views (timestamps, values) of the latest n_samples samples
+        count = self.count
+        n_samples = min(n_samples, count, self.capacity)
+        end = count % self.capacity + self.capacity
+        return self._timestamps[end - n_samples:end], self._values[end - n_samples:end]
+
+    def latest(self, seconds):
+        # Returns views (timestamps, values) of the samples of the last
+        # seconds, counted from the newest timestamp
+        timestamps, values = self.last(self.capacity)
+        if len(timestamps) == 0:
+            return timestamps, values
+        start = np.searchsorted(timestamps, timestamps[-1] - seconds, side="left")
+        return timestamps[start:], values[start:]
+
+
+class RingBufferWriter(object):
+    # Storage writer interface (see storage.py) on top of a RingBuffer
+
+    def __init__(self, ring):
+        self.ring = ring
+
+    def writerow(self, row):
+        self.ring.append(row[0], row[1:] if len(row) > 2 else row[1])
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def write_block(self, timestamps, values):
+        self.ring.extend(timestamps, values)
+
+    def write_gap(self, lost_at, duration):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class LiveBuffers(object):
+    # Ring buffers for all streams of one device
+
+    def __init__(self, seconds = 60, streams = SAMPLE_RATES):
+        # Args:
+        #   seconds: float, seconds of data that latest() can return
+        #   streams: iterable of stream names
+        self.seconds = seconds
+        self.buffers = {}
+        self.writers = {}
+        for stream in streams:
+            types = COLUMN_TYPES[stream]
+            # Twice the requested length, so a view is not overwritten while it is read
+            capacity = int(2 * seconds * SAMPLE_RATES[stream]) + 1
+            self.buffers[stream] = RingBuffer(capacity, len(types) - 1, types[1])
+            self.writers[stream] = RingBufferWriter(self.buffers[stream])
+
+    def latest(self, stream, seconds):
+        # Returns zero-copy views (timestamps, values) of the last seconds of stream
+        # Args:
+        #   stream: string, one of acc, bvp, gsr, ibi, hr, tmp
+        #   seconds: float, at most the number of seconds given to __init__
+        return self.buffers[stream].latest(min(seconds, self.seconds))
+
+    def count(self, stream):
+        # Number of samples of stream received so far
+        return self.buffers[stream].count
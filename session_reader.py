@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+
+# Read time ranges of a recorded session.
+#
+# Storage (see storage.py) writes next to the data of every stream a sparse
+# index <stream>_index.csv and a manifest.json per session or device
+# directory. read_range() looks up the last index entry at or before the
+# start of the range, reads from there on and stops at the first sample
+# after the end, so reading a minute of a long session does not scan the
+# whole file. Without an index the stream is read from the beginning.
+# Works with all storage backends; gap rows and comments are skipped.
+# read_chunks() yields the same samples in chunks, so whole sessions can be
+# streamed without holding a stream in memory (see export.py).
+#
+# session_manifest() returns the manifests of the session and all of its
+# device directories. Directories without manifest.json, e.g. recorded
+# before it existed or after a crash, are scanned with build_manifest().
+#
+# Usage:
+#   python session_reader.py data/Empatica_E4_<ID> --manifest
+#   python session_reader.py data/Empatica_E4_<ID> --stream bvp --from 60 --to 120 [--device ID]
+#   --from and --to are seconds after the start of the session.
+
+import argparse
+import bisect
+import csv
+import json
+import sys
+from pathlib import Path
+
+from storage import COLUMN_TYPES, CSV_HEADERS
+
+
+CHUNK_ROWS = 65536      # Rows per chunk of the text backends in read_chunks()
+
+
+def read_manifest(directory):
+    # Returns the dict of directory/manifest.json, None if there is none
+    path = Path(directory, "manifest.json")
+    if not path.exists():
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def detect_backend(directory, stream = None):
+    # Returns the backend that wrote directory, or the stream if given,
+    # None if it has no data
+    manifest = read_manifest(directory)
+    if manifest is not None:
+        if stream is not None and stream not in manifest["streams"]:
+            return None
+        return manifest["backend"]
+    streams = [stream] if stream else list(CSV_HEADERS)
+    for stream in streams:
+        for backend, name in [("csv", "_data.csv"), ("csvz", "_data.csvz"), ("parquet", "_data.parquet")]:
+            if Path(directory, stream + name).exists():
+                return backend
+        if any(Path(directory).glob(stream + "_data.*.npz")):
+            return "npz"
+    return None
+
+
+def read_index(directory, stream):
+    # Returns the lists (timestamps, positions, samples) of the index of a
+    # stream, empty if it has no index
+    timestamps, positions, samples = [], [], []
+    path = Path(directory, stream + "_index.csv")
+    if path.exists():
+        with open(path, newline="") as f:
+            reader = csv.reader(f)
+            next(reader, None)
+            for row in reader:
+                if len(row) == 3:
+                    timestamps.append(float(row[0]))
+                    positions.append(int(row[1]))
+                    samples.append(int(row[2]))
+    return timestamps, positions, samples
+
+
+def start_position(directory, stream, start):
+    # Returns the position of the last index entry at or before start, 0
+    # without index or start
+    if start is None:
+        return 0
+    timestamps, positions, _ = read_index(directory, stream)
+    i = bisect.bisect_right(timestamps, start)
+    return positions[i - 1] if i > 0 else 0
+
+
+def _csv_lines(path, offset):
+    with open(path, "rb") as f:
+        f.seek(offset)
+        for line in f:
+            yield line.decode("ascii")
+
+
+def _csvz_lines(path, frame):
+    from compression import read_frames
+    for data in read_frames(path, frame):
+        yield from data.decode("ascii").splitlines()
+
+
+def _column_chunks(directory, stream, backend, position, end):
+    # Yields chunks of the stream as lists of columns, starting at the
+    # npz segment or parquet row group position
+    if backend == "npz":
+        import numpy as np
+        segments = sorted(Path(directory).glob(stream + "_data.*.npz"))
+        for segment in segments[position:]:
+            with np.load(segment) as data:
+                columns = [data[name] for name in CSV_HEADERS[stream]]
+            if end is not None and len(columns[0]) and columns[0][0] >= end:
+                return
+            yield columns
+    else:
+        import pyarrow.parquet as pq
+        parquet = pq.ParquetFile(Path(directory, stream + "_data.parquet"))
+        for group in range(position, parquet.num_row_groups):
+            table = parquet.read_row_group(group)
+            columns = [table.column(name).to_numpy() for name in CSV_HEADERS[stream]]
+            if end is not None and len(columns[0]) and columns[0][0] >= end:
+                return
+            yield columns
+
+
+def _text_chunks(lines, end, n_columns, chunk_rows):
+    # Yields the data rows of csv lines as float64 columns, chunk_rows rows
+    # at a time, until the first timestamp at or after end
+    import numpy as np
+
+    def parse(batch):
+        table = np.fromstring(",".join(batch), sep=",").reshape(-1, n_columns)
+        if end is not None and table[-1, 0] >= end:
+            table = table[:int(np.argmax(table[:, 0] >= end))]
+        return list(table.T)
+
+    batch = []
+    for line in lines:
+        if not line or line[0] in "#t\r\n":     # Gap, comment, header or empty
+            continue
+        batch.append(line.rstrip("\r\n"))
+        if len(batch) >= chunk_rows:
+            columns = parse(batch)
+            yield columns
+            if len(columns[0]) < len(batch):
+                return
+            batch = []
+    if batch:
+        yield parse(batch)
+
+
+def read_chunks(directory, stream, start = None, end = None, backend = None, chunk_rows = CHUNK_ROWS):
+    # Yields the samples of a stream with start <= timestamp < end as chunks
+    # (timestamps, values) of np.ndarray in file order, values as in
+    # read_range(). Values of the text backends are float64, as parsed.
+    # Args: see read_range()
+    #   chunk_rows: int, rows per chunk of the csv and csvz backends
+    import numpy as np
+    backend = backend or detect_backend(directory, stream)
+    position = start_position(directory, stream, start)
+
+    if backend == "csv":
+        lines = _csv_lines(Path(directory, stream + "_data.csv"), position)
+    elif backend == "csvz":
+        lines = _csvz_lines(Path(directory, stream + "_data.csvz"), position)
+    elif backend in ("npz", "parquet"):
+        lines = None
+    else:
+        raise ValueError("no data of %s in %s" % (stream, directory))
+    if lines is not None:
+        chunks = _text_chunks(lines, end, len(COLUMN_TYPES[stream]), chunk_rows)
+    else:
+        chunks = _column_chunks(directory, stream, backend, position, end)
+
+    try:
+        for columns in chunks:
+            timestamps = columns[0]
+            values = np.column_stack(columns[1:]) if len(columns) > 2 else columns[1]
+            if start is not None or end is not None:
+                keep = np.ones(len(timestamps), dtype=bool)
+                if start is not None:
+                    keep &= timestamps >= start
+                if end is not None:
+                    keep &= timestamps < end
+                timestamps, values = timestamps[keep], values[keep]
+            if len(timestamps):
+                yield timestamps, values
+    finally:
+        # Close the file when the caller stops early
+        chunks.close()
+        if lines is not None:
+            lines.close()
+
+
+def read_range(directory, stream, start = None, end = None, backend = None):
+    # Read the samples of a stream with start <= timestamp < end.
+    # Returns (timestamps, values) as np.ndarray, values has a column per
+    # axis for acc, like the arrays passed to write_block().
+    # Args:
+    #   directory: session or device directory
+    #   stream: string, stream name
+    #   start, end: float timestamps, None for the first or last sample
+    #   backend: string, detected from the files if None
+    import numpy as np
+    types = COLUMN_TYPES[stream]
+    chunks = list(read_chunks(directory, stream, start, end, backend))
+    timestamps = np.concatenate([chunk[0] for chunk in chunks]) if chunks else np.empty(0, dtype=types[0])
+    if len(types) > 2:
+        values = (np.concatenate([chunk[1] for chunk in chunks]) if chunks
+                  else np.empty((0, len(types) - 1), dtype=types[1]))
+    else:
+        values = np.concatenate([chunk[1] for chunk in chunks]) if chunks else np.empty(0, dtype=types[1])
+    return timestamps.astype(types[0], copy=False), values.astype(types[1], copy=False)
+
+
+def count_gaps(directory, stream, backend):
+    if backend in ("npz", "parquet"):
+        path = Path(directory, stream + "_gaps.csv")
+        if not path.exists():
+            return 0
+        with open(path) as f:
+            return max(sum(1 for _ in f) - 1, 0)
+    if backend == "csv":
+        lines = _csv_lines(Path(directory, stream + "_data.csv"), 0)
+    else:
+        lines = _csvz_lines(Path(directory, stream + "_data.csvz"), 0)
+    return sum(1 for line in lines if line.startswith("#gap"))
+
+
+def build_manifest(directory):
+    # Returns the manifest of directory by reading all of its data, None if
+    # it has no data
+    backend = detect_backend(directory)
+    if backend is None:
+        return None
+    streams = {}
+    for stream in CSV_HEADERS:
+        if detect_backend(directory, stream) is None:
+            continue
+        timestamps, _ = read_range(directory, stream, backend=backend)
+        streams[stream] = {"samples": len(timestamps),
+                           "first": float(timestamps[0]) if len(timestamps) else None,
+                           "last": float(timestamps[-1]) if len(timestamps) else None,
+                           "gaps": count_gaps(directory, stream, backend)}
+    return {"backend": backend, "streams": streams, "updated": None, "complete": False}
+
+
+def session_manifest(session):
+    # Returns a dict with the manifest of every directory of a session by
+    # device name ("" for the session directory itself) and the time bounds
+    # of the whole session
+    session = Path(session)
+    directories = [session] + sorted(path for path in session.iterdir() if path.is_dir())
+    devices = {}
+    for directory in directories:
+        manifest = read_manifest(directory) or build_manifest(directory)
+        if manifest is not None:
+            devices["" if directory == session else directory.name] = manifest
+    firsts = [s["first"] for m in devices.values() for s in m["streams"].values() if s["first"] is not None]
+    lasts = [s["last"] for m in devices.values() for s in m["streams"].values() if s["last"] is not None]
+    return {"session": session.name, "devices": devices,
+            "first": min(firsts) if firsts else None, "last": max(lasts) if lasts else None}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Read a time range of a recorded session.")
+    parser.add_argument("session", help="session directory, e.g. data/Empatica_E4_<ID>")
+    parser.add_argument("--manifest", action="store_true", help="print the session manifest as JSON")
+    parser.add_argument("--stream", choices=list(CSV_HEADERS), default="bvp")
+    parser.add_argument("--device", default="", help="device directory, for sessions with several devices")
+    parser.add_argument("--from", dest="start", type=float, help="seconds after the session start")
+    parser.add_argument("--to", dest="end", type=float, help="seconds after the session start")
+    args = parser.parse_args()
+
+    manifest = session_manifest(args.session)
+    if args.manifest:
+        json.dump(manifest, sys.stdout, indent=1)
+        print()
+        return
+    if args.device not in manifest["devices"]:
+        parser.error("no data for device %r, found %s" % (args.device, ", ".join(map(repr, manifest["devices"]))))
+    origin = manifest["first"] or 0.0
+    start = None if args.start is None else origin + args.start
+    end = None if args.end is None else origin + args.end
+    timestamps, values = read_range(Path(args.session, args.device), args.stream, start, end)
+    writer = csv.writer(sys.stdout)
+    writer.writerow(CSV_HEADERS[args.stream])
+    for t, value in zip(timestamps.tolist(), values.tolist()):
+        writer.writerow([t] + value if isinstance(value, list) else [t, value])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,718 @@
+#!/usr/bin/env python3
+
+# Storage backends for the streamed data.
+#
+# A backend opens one output per stream in a session directory and exposes a
+# writer per stream through its writers dict. Every writer has the methods
+#   writerow(row), writerows(rows), write_block(timestamps, values)
+# so it can be used wherever a csv.writer was used before.
+#
+# Backends:
+#   csv:      one .csv file per stream, the original layout
+#   npz:      segments <stream>_data.<n>.npz of up to SEGMENT_ROWS rows with
+#             one array per column. The open segment is replaced with all
+#             of its rows on every flush, so a new file starts only when a
+#             segment is full (requires numpy)
+#   parquet:  one .parquet file per stream with a row group per flush
+#             (requires pyarrow)
+#   csvz:     the csv rows in compressed frames, <stream>_data.csvz,
+#             compressed on a background thread (see compression.py)
+#
+# A reconnect is recorded with write_gap(lost_at, duration). The csv and csvz
+# backends write a row "#gap,<time connection was lost>,<outage in seconds>"
+# into the stream's file (skip it with pandas.read_csv(..., comment="#")). The binary
+# backends flush and append the gap to <stream>_gaps.csv.
+#
+# All backends write through file buffers of FILE_BUFFER_SIZE bytes, flush
+# at least every FLUSH_INTERVAL seconds and fsync every FSYNC_INTERVAL
+# seconds if set. Storage flushes every writer from a timer thread as well,
+# so a stream that stops receiving rows is still flushed; the writers lock
+# their buffers for it. Storage.close() flushes and closes every file, and
+# Storage.stats() reports bytes written and flush latency per stream.
+#
+# Storage wraps every writer in an IndexedWriter, which keeps a sparse time
+# index <stream>_index.csv with a row every INDEX_INTERVAL seconds of data:
+#   timestamp:  first timestamp written at position
+#   position:   where that sample starts, as returned by the writer's
+#               position(): byte offset (csv), frame number (csvz),
+#               segment number (npz) or row group (parquet)
+#   sample:     number of samples of the stream before it
+# Storage also keeps manifest.json up to date with the sample count, time
+# bounds and gaps of every stream. session_reader.py uses both to read time
+# ranges without scanning whole files.
+#
+# Storage(..., append=True) continues the files an earlier Storage left in
+# the directory, e.g. after its process was killed: a row or csvz frame cut
+# off at the end is dropped, the npz backend starts a new segment, and the
+# index and manifest count on from the samples already written. The parquet
+# backend cannot append, a parquet file needs its footer.
+
+import csv
+import json
+import os
+import threading
+import time
+
+
+# Header of the output of each stream
+CSV_HEADERS = {
+    "acc": ["timestamp","x","y","z"],
+    "bvp": ["timestamp","BVP"],
+    "gsr": ["timestamp","GSR"],
+    "ibi": ["timestamp","IBI"],
+    "hr":  ["timestamp","HR"],
+    "tmp": ["timestamp","Tmp"],
+}
+
+# Column types used by the binary backends
+COLUMN_TYPES = {
+    "acc": ["float64", "int16", "int16", "int16"],
+    "bvp": ["float64", "float32"],
+    "gsr": ["float64", "float32"],
+    "ibi": ["float64", "float32"],
+    "hr":  ["float64", "float32"],
+    "tmp": ["float64", "float32"],
+}
+
+FLUSH_ROWS = 4096       # Rows buffered per stream before writing a chunk
+SEGMENT_ROWS = 65536    # Rows per npz segment file
+FLUSH_INTERVAL = 5.0    # Seconds before buffered data is written and flushed anyway
+FILE_BUFFER_SIZE = 64 * 1024    # Size of the file buffer in bytes
+FSYNC_INTERVAL = None   # Seconds between os.fsync calls, None to never fsync
+INDEX_INTERVAL = 10.0   # Seconds of data between index entries, None for no index
+MANIFEST_INTERVAL = 10.0    # Seconds between updates of manifest.json while writing
+
+
+class WriterStats(object):
+    # Counters of a stream writer, used to tune the durability/throughput tradeoff
+
+    def __init__(self):
+        self.bytes_written = 0
+        self.flushes = 0
+        self.flush_seconds = 0.0        # Total time spent flushing
+        self.max_flush_seconds = 0.0
+        self.fsyncs = 0
+
+    def add_flush(self, seconds):
+        self.flushes += 1
+        self.flush_seconds += seconds
+        if seconds > self.max_flush_seconds:
+            self.max_flush_seconds = seconds
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+
+class DurableFile(object):
+    # File with an explicit buffer size that is flushed every flush_interval
+    # seconds and fsynced every fsync_interval seconds.
+
+    def __init__(self, path, mode = "w", buffer_size = FILE_BUFFER_SIZE,
+                 flush_interval = FLUSH_INTERVAL, fsync_interval = FSYNC_INTERVAL):
+        # Args:
+        #   path: pathlib.Path
+        #   mode: "w" for text, "wb" for binary
+        #   buffer_size: int, bytes
+        #   flush_interval: float, seconds
+        #   fsync_interval: float or None, seconds
+        newline = None if "b" in mode else ""
+        self.file = open(path, mode, buffering=buffer_size, newline=newline)
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.stats = WriterStats()
+        self._last_flush = self._last_fsync = time.monotonic()
+        # Written by one thread, flushed by the flush timer of Storage as well
+        self._lock = threading.Lock()
+
+    def write(self, data):
+        with self._lock:
+            self.file.write(data)
+            self.stats.bytes_written += len(data)
+            now = time.monotonic()
+            if now - self._last_flush >= self.flush_interval:
+                self._flush(now)
+
+    def flush(self, now = None, fsync = False):
+        # Flush the file buffer, and fsync if fsync is True or due
+        with self._lock:
+            self._flush(now, fsync)
+
+    def _flush(self, now = None, fsync = False):
+        if now is None:
+            now = time.monotonic()
+        start = time.perf_counter()
+        self.file.flush()
+        if fsync or (self.fsync_interval is not None and now - self._last_fsync >= self.fsync_interval):
+            os.fsync(self.file.fileno())
+            self.stats.fsyncs += 1
+            self._last_fsync = now
+        self.stats.add_flush(time.perf_counter() - start)
+        self._last_flush = now
+
+    def close(self):
+        with self._lock:
+            if self.file.closed:
+                return
+            try:
+                self._flush(fsync=self.fsync_interval is not None)
+            finally:
+                self.file.close()
+
+
+def _truncate_partial_line(path):
+    # Cut off a last line that was not written completely.
+    # Returns the length of the file.
+    with open(path, "rb+") as f:
+        end = f.seek(0, os.SEEK_END)
+        length = 0
+        while end > 0:
+            start = max(end - 4096, 0)
+            f.seek(start)
+            i = f.read(end - start).rfind(b"\n")
+            if i >= 0:
+                length = start + i + 1
+                break
+            end = start
+        f.truncate(length)
+    return length
+
+
+class CsvStreamWriter(object):
+
+    def __init__(self, path, stream, buffer_size = FILE_BUFFER_SIZE, flush_interval = FLUSH_INTERVAL,
+                 fsync_interval = FSYNC_INTERVAL, append = False, **policy):
+        self.stream = stream
+        # Bytes of an earlier file that is appended to
+        self._offset = _truncate_partial_line(path) if append and path.exists() else 0
+        self.file = DurableFile(path, "a" if self._offset else "w", buffer_size, flush_interval, fsync_interval)
+        self.stats = self.file.stats
+        self._writer = csv.writer(self.file)
+        self.writerow = self._writer.writerow
+        self.writerows = self._writer.writerows
+        if not self._offset:
+            self.writerow(CSV_HEADERS[stream])
+
+    def write_block(self, timestamps, values):
+        from batch import block_csv
+        self.file.write(block_csv(self.stream, timestamps, values))
+
+    def write_gap(self, lost_at, duration):
+        self.writerow(["#gap", lost_at, duration])
+        self.file.flush()
+
+    def position(self):
+        # Byte offset of the next row, the rows are ASCII
+        return self._offset + self.file.stats.bytes_written
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class BufferedStreamWriter(object):
+    # Buffers rows in memory and hands them to write_chunk() as a list of
+    # columns when flush_rows rows are buffered or flush_interval seconds
+    # have passed.
+
+    def __init__(self, stream, flush_rows = FLUSH_ROWS, flush_interval = FLUSH_INTERVAL,
+                 buffer_size = FILE_BUFFER_SIZE, fsync_interval = FSYNC_INTERVAL):
+        self.stream = stream
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.buffer_size = buffer_size
+        self.fsync_interval = fsync_interval
+        self.stats = WriterStats()
+        self.closed = False
+        self.gap_path = None        # Set by subclasses, see write_gap()
+        self.n_chunks = 0           # Chunks handed to write_chunk()
+        self._rows = []
+        self._blocks = []
+        self._n_buffered = 0
+        self._last_flush = self._last_fsync = time.monotonic()
+        # Written by one thread, flushed by the flush timer of Storage as well
+        self._lock = threading.Lock()
+
+    def writerow(self, row):
+        with self._lock:
+            self._rows.append(row)
+            self._n_buffered += 1
+            self._maybe_flush()
+
+    def writerows(self, rows):
+        rows = list(rows)
+        with self._lock:
+            self._rows.extend(rows)
+            self._n_buffered += len(rows)
+            self._maybe_flush()
+
+    def write_block(self, timestamps, values):
+        with self._lock:
+            if self._rows:
+                self._flush_rows()
+            self._blocks.append((timestamps.copy(), values.copy()))
+            self._n_buffered += len(timestamps)
+            self._maybe_flush()
+
+    def write_gap(self, lost_at, duration):
+        with self._lock:
+            self._flush()
+            new_file = not self.gap_path.exists()
+            with open(self.gap_path, "a", newline="") as f:
+                writer = csv.writer(f)
+                if new_file:
+                    writer.writerow(["lost_at", "duration"])
+                writer.writerow([lost_at, duration])
+
+    def _maybe_flush(self):
+        if (self._n_buffered >= self.flush_rows
+                or time.monotonic() - self._last_flush >= self.flush_interval):
+            self._flush()
+
+    def _flush_rows(self):
+        # Keep the order of rows and blocks by turning rows into a block
+        import numpy as np
+        columns = list(zip(*self._rows))
+        types = COLUMN_TYPES[self.stream]
+        timestamps = np.asarray(columns[0], dtype=types[0])
+        if len(columns) == 4:
+            values = np.column_stack([np.asarray(c, dtype=types[1]) for c in columns[1:]])
+        else:
+            values = np.asarray(columns[1], dtype=types[1])
+        self._blocks.append((timestamps, values))
+        self._rows = []
+
+    def _take_buffer(self):
+        # Returns the buffered rows and blocks as a list of columns and
+        # empties the buffer, None if nothing is buffered
+        if self._rows:
+            self._flush_rows()
+        if not self._blocks:
+            return None
+        import numpy as np
+        timestamps = np.concatenate([block[0] for block in self._blocks])
+        values = np.concatenate([block[1] for block in self._blocks])
+        self._blocks = []
+        self._n_buffered = 0
+        if values.ndim == 2:
+            return [timestamps] + [values[:, i] for i in range(values.shape[1])]
+        return [timestamps, values]
+
+    def flush(self, fsync = False):
+        with self._lock:
+            self._flush(fsync)
+
+    def _flush(self, fsync = False):
+        now = self._last_flush = time.monotonic()
+        columns = self._take_buffer()
+        if columns is not None:
+            self._write_timed(columns, fsync, now)
+
+    def _write_timed(self, columns, fsync, now):
+        # write_chunk() with fsync if asked for or due, counted in stats
+        fsync = fsync or (self.fsync_interval is not None and now - self._last_fsync >= self.fsync_interval)
+        start = time.perf_counter()
+        self.write_chunk(columns, fsync)
+        self.n_chunks += 1
+        self.stats.add_flush(time.perf_counter() - start)
+        if fsync:
+            self.stats.fsyncs += 1
+            self._last_fsync = now
+
+    def write_chunk(self, columns, fsync):
+        # Write one chunk of columns, fsync the output if fsync is True
+        raise NotImplementedError
+
+    def position(self):
+        # Number of the chunk (npz segment, parquet row group) the next row is written to
+        return self.n_chunks
+
+    def close(self):
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            self._flush(fsync=self.fsync_interval is not None)
+
+
+def _sync(f, fsync):
+    f.flush()
+    if fsync:
+        os.fsync(f.fileno())
+
+
+class NpzStreamWriter(BufferedStreamWriter):
+    # Every flush_rows rows the buffer is added to the open segment in
+    # memory. Every flush_interval seconds, on flush() and when the segment
+    # has segment_rows rows, the segment file is replaced with all rows of
+    # the segment, and a full segment is closed.
+
+    def __init__(self, directory, stream, segment_rows = SEGMENT_ROWS, append = False, **policy):
+        BufferedStreamWriter.__init__(self, stream, **policy)
+        self.directory = directory
+        self.segment_rows = segment_rows
+        self.gap_path = directory.joinpath(stream + "_gaps.csv")
+        self.n_segments = 0         # Segments closed so far
+        if append:
+            # Segments are only ever replaced whole, the last one is kept
+            # as it is and the new rows start the next one
+            for temporary in directory.glob(stream + "_data.*.npz.tmp"):
+                temporary.unlink()
+            self.n_segments = len(list(directory.glob(stream + "_data.*.npz")))
+        self._segment = None        # Columns of the open segment
+        self._segment_written = 0   # Rows of the open segment in its file
+
+    def _add_to_segment(self, columns):
+        if self._segment is None:
+            self._segment = columns
+        else:
+            import numpy as np
+            self._segment = [np.concatenate(pair) for pair in zip(self._segment, columns)]
+
+    def _segment_length(self):
+        return len(self._segment[0]) if self._segment is not None else 0
+
+    def _maybe_flush(self):
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self._flush()
+        elif self._n_buffered >= self.flush_rows:
+            self._add_to_segment(self._take_buffer())
+            if self._segment_length() >= self.segment_rows:
+                self._flush()
+
+    def _flush(self, fsync = False):
+        now = self._last_flush = time.monotonic()
+        columns = self._take_buffer()
+        if columns is not None:
+            self._add_to_segment(columns)
+        if self._segment_length() > self._segment_written:
+            self._write_timed(self._segment, fsync, now)
+            self._segment_written = self._segment_length()
+        if self._segment_length() >= self.segment_rows:
+            self.n_segments += 1
+            self._segment = None
+            self._segment_written = 0
+
+    def write_chunk(self, columns, fsync):
+        # Replace the file of the open segment in one step, so it is never
+        # read half written
+        import numpy as np
+        path = self.directory.joinpath("%s_data.%06d.npz" % (self.stream, self.n_segments))
+        temporary = path.with_name(path.name + ".tmp")
+        with open(temporary, "wb", buffering=self.buffer_size) as f:
+            np.savez(f, **dict(zip(CSV_HEADERS[self.stream], columns)))
+            _sync(f, fsync)
+            self.stats.bytes_written += f.tell()
+        os.replace(temporary, path)
+
+    def position(self):
+        # Number of the segment the next row is written to
+        return self.n_segments
+
+
+class ParquetStreamWriter(BufferedStreamWriter):
+
+    def __init__(self, path, stream, append = False, **policy):
+        if append and path.exists():
+            raise ValueError("the parquet backend cannot append to " + str(path))
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        BufferedStreamWriter.__init__(self, stream, **policy)
+        self._pa = pa
+        self._schema = pa.schema([(name, type_) for name, type_ in
+                                  zip(CSV_HEADERS[stream], COLUMN_TYPES[stream])])
+        self.gap_path = path.with_name(stream + "_gaps.csv")
+        self._file = open(path, "wb", buffering=self.buffer_size)
+        self._writer = pq.ParquetWriter(self._file, self._schema)
+
+    def write_chunk(self, columns, fsync):
+        self._writer.write_table(self._pa.Table.from_arrays(
+            [self._pa.array(column) for column in columns], schema=self._schema))
+        _sync(self._file, fsync)
+        self.stats.bytes_written = self._file.tell()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            BufferedStreamWriter.close(self)
+        finally:
+            # Writes the parquet footer
+            self._writer.close()
+            self._file.close()
+
+
+class TeeWriter(object):
+    # Passes everything written on to several writers, e.g. a file writer
+    # and a ring_buffer.RingBufferWriter
+
+    def __init__(self, *writers):
+        self.writers = writers
+        self.stats = writers[0].stats
+
+    def writerow(self, row):
+        for writer in self.writers:
+            writer.writerow(row)
+
+    def writerows(self, rows):
+        rows = list(rows)
+        for writer in self.writers:
+            writer.writerows(rows)
+
+    def write_block(self, timestamps, values):
+        for writer in self.writers:
+            writer.write_block(timestamps, values)
+
+    def write_gap(self, lost_at, duration):
+        for writer in self.writers:
+            writer.write_gap(lost_at, duration)
+
+    def flush(self):
+        for writer in self.writers:
+            writer.flush()
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+
+
+class IndexedWriter(object):
+    # Passes everything on to a backend writer and appends an entry to a
+    # time index file whenever interval seconds of data have been written
+    # since the last entry, and after every gap
+
+    def __init__(self, writer, path, interval = INDEX_INTERVAL, on_entry = None, buffer_size = FILE_BUFFER_SIZE,
+                 flush_interval = FLUSH_INTERVAL, fsync_interval = FSYNC_INTERVAL, append = False):
+        # Args:
+        #   writer: backend writer with a position() method
+        #   path: pathlib.Path of the index file
+        #   interval: float, seconds of data between entries
+        #   on_entry: callable called after every new entry, or None
+        #   append: bool, continue an existing index file, see resume()
+        self.writer = writer
+        self.stats = writer.stats
+        self.interval = interval
+        self.on_entry = on_entry
+        self.samples = 0
+        self.first = None
+        self.last = None
+        self.gaps = 0
+        self._next_entry = None
+        appending = append and path.exists() and _truncate_partial_line(path) > 0
+        self.file = DurableFile(path, "a" if appending else "w", buffer_size, flush_interval, fsync_interval)
+        self._index = csv.writer(self.file)
+        if not appending:
+            self._index.writerow(["timestamp", "position", "sample"])
+
+    def resume(self, summary):
+        # Count on from the samples already written, summary as returned by summary()
+        self.samples = summary["samples"]
+        self.first = summary["first"]
+        self.last = summary["last"]
+        self.gaps = summary["gaps"]
+
+    def _observe(self, first, last, n_samples):
+        if self.first is None:
+            self.first = first
+        if self._next_entry is None or first >= self._next_entry:
+            self._index.writerow([first, self.writer.position(), self.samples])
+            self._next_entry = first + self.interval
+            if self.on_entry is not None:
+                self.on_entry()
+        self.samples += n_samples
+        self.last = last
+
+    def writerow(self, row):
+        self._observe(row[0], row[0], 1)
+        self.writer.writerow(row)
+
+    def writerows(self, rows):
+        rows = list(rows)
+        if rows:
+            self._observe(rows[0][0], rows[-1][0], len(rows))
+        self.writer.writerows(rows)
+
+    def write_block(self, timestamps, values):
+        if len(timestamps):
+            self._observe(float(timestamps[0]), float(timestamps[-1]), len(timestamps))
+        self.writer.write_block(timestamps, values)
+
+    def write_gap(self, lost_at, duration):
+        self.gaps += 1
+        # Start a new entry with the first sample after the gap
+        self._next_entry = None
+        self.writer.write_gap(lost_at, duration)
+
+    def summary(self):
+        return {"samples": self.samples, "first": self.first, "last": self.last, "gaps": self.gaps}
+
+    def flush(self):
+        self.writer.flush()
+        self.file.flush()
+
+    def close(self):
+        try:
+            self.writer.close()
+        finally:
+            self.file.close()
+
+
+class Storage(object):
+    # A set of stream writers in one session directory
+
+    def __init__(self, directory, streams, backend = "csv", index_interval = INDEX_INTERVAL, append = False,
+                 **policy):
+        # Args:
+        #   directory: pathlib.Path, created if needed
+        #   streams: list of stream names (acc, bvp, gsr, ibi, hr, tmp)
+        #   backend: string, one of BACKENDS
+        #   index_interval: float, seconds between index entries, None for
+        #       no index and manifest
+        #   append: bool, continue the files of an earlier Storage instead
+        #       of replacing them
+        #   policy: buffer_size, flush_rows, flush_interval and fsync_interval
+        if backend not in BACKENDS:
+            raise ValueError("unknown storage backend " + str(backend))
+        directory.mkdir(parents=True, exist_ok=True)
+        self.directory = directory
+        self.backend = backend
+        self.writers = {}
+        self._indexes = {}
+        self._manifest_lock = threading.Lock()
+        self._last_manifest = time.monotonic()
+        self._closing = threading.Event()
+        self._flusher = None
+        file_policy = {name: policy[name] for name in ["buffer_size", "flush_interval", "fsync_interval"]
+                       if name in policy}
+        try:
+            for stream in streams:
+                writer = BACKENDS[backend](directory, stream, append=append, **policy)
+                if index_interval:
+                    writer = self._indexes[stream] = IndexedWriter(
+                        writer, directory.joinpath(stream + "_index.csv"), index_interval,
+                        self._index_updated, append=append, **file_policy)
+                    if append:
+                        writer.resume(_written_summary(directory, stream, backend))
+                self.writers[stream] = writer
+        except:
+            self.close()
+            raise
+        self._flush_interval = policy.get("flush_interval", FLUSH_INTERVAL)
+        self._flusher = threading.Thread(target=self._flush_loop, name="e4-storage-flush", daemon=True)
+        self._flusher.start()
+
+    def _flush_loop(self):
+        # Flush on time also while no rows arrive, e.g. for a stream that
+        # stopped or a device that is reconnecting
+        while not self._closing.wait(self._flush_interval):
+            try:
+                self.flush()
+            except (OSError, ValueError) as e:
+                print(f"\tWARNING: flushing {self.directory} failed: {e}")
+
+    def _index_updated(self):
+        # Called by the writers of several threads
+        if time.monotonic() - self._last_manifest >= MANIFEST_INTERVAL:
+            self.write_manifest()
+
+    def manifest(self):
+        # Returns a dict with the backend and the sample count, time bounds
+        # and number of gaps of every stream
+        return {"backend": self.backend,
+                "streams": {stream: writer.summary() for stream, writer in self._indexes.items()},
+                "updated": time.time()}
+
+    def write_manifest(self, complete = False):
+        # Replace manifest.json in one step, so it is never read half written
+        if not self._indexes:
+            return
+        with self._manifest_lock:
+            self._last_manifest = time.monotonic()
+            manifest = self.manifest()
+            manifest["complete"] = complete
+            path = self.directory.joinpath("manifest.json")
+            temporary = path.with_name("manifest.json.tmp")
+            with open(temporary, "w") as f:
+                json.dump(manifest, f, indent=1)
+            os.replace(temporary, path)
+
+    def flush(self):
+        for writer in self.writers.values():
+            writer.flush()
+        self.write_manifest()
+
+    def stats(self):
+        # Returns a dict of stream name -> dict of WriterStats counters
+        return {stream: writer.stats.as_dict() for stream, writer in self.writers.items()}
+
+    def close(self):
+        # Close every writer, even if closing one of them fails.
+        # Calling close() again does nothing.
+        self._closing.set()
+        if self._flusher is not None and self._flusher is not threading.current_thread():
+            self._flusher.join()
+        writers, self.writers = self.writers, {}
+        error = None
+        for writer in writers.values():
+            try:
+                writer.close()
+            except Exception as e:
+                error = e
+        if writers:
+            self.write_manifest(complete=True)
+        if error is not None:
+            raise error
+
+
+def _written_summary(directory, stream, backend):
+    # Returns the summary of the samples already in the files of a stream,
+    # read from the data itself, the manifest may be older than it
+    from session_reader import count_gaps, read_chunks
+    summary = {"samples": 0, "first": None, "last": None, "gaps": 0}
+    for timestamps, _ in read_chunks(directory, stream, backend=backend):
+        if summary["first"] is None:
+            summary["first"] = float(timestamps[0])
+        summary["samples"] += len(timestamps)
+        summary["last"] = float(timestamps[-1])
+    summary["gaps"] = count_gaps(directory, stream, backend)
+    return summary
+
+
+def _open_csv(directory, stream, **policy):
+    return CsvStreamWriter(directory.joinpath(stream + "_data.csv"), stream, **policy)
+
+def _open_npz(directory, stream, **policy):
+    return NpzStreamWriter(directory, stream, **policy)
+
+def _open_parquet(directory, stream, **policy):
+    return ParquetStreamWriter(directory.joinpath(stream + "_data.parquet"), stream, **policy)
+
+def _open_csvz(directory, stream, **policy):
+    from compression import CompressedStreamWriter
+    return CompressedStreamWriter(directory.joinpath(stream + "_data.csvz"), stream, **policy)
+
+
+BACKENDS = {
+    "csv": _open_csv,
+    "npz": _open_npz,
+    "parquet": _open_parquet,
+    "csvz": _open_csvz,
+}
+
+
+def load_npz(directory, stream):
+    # Load all segments of a stream written by the npz backend.
+    # Returns a dict of column name -> np.ndarray.
+    # Args:
+    #   directory: pathlib.Path
+    #   stream: string
+    import numpy as np
+    segments = sorted(directory.glob(stream + "_data.*.npz"))
+    columns = {name: [] for name in CSV_HEADERS[stream]}
+    for segment in segments:
+        with np.load(segment) as data:
+            for name in columns:
+                columns[name].append(data[name])
+    return {name: np.concatenate(parts) if parts else np.empty(0, dtype=type_)
+            for (name, parts), type_ in zip(columns.items(), COLUMN_TYPES[stream])}
@@ -8,18 +8,79 @@ import socket
 import threading
 
 import time
-from typing import Sized, Text
+
+from clock import ClockRecorder
+from commands import CommandChannel, CommandTimeout
+from decoder import decode_lines
+from features import FeatureStage
+from framing import LineFramer, split_connection_lost
+from metrics import INTERVAL, MetricsRegistry, MetricsReporter
+from pipeline import StreamPipeline
+from storage import Storage, TeeWriter
 
 
 HOST = '127.0.0.1'      # Localhost
 PORT = 28000            # The port that E4 streaming server is sending to
 BUFFER_SIZE = 4096      # Buffer size of messages
+COMMAND_TIMEOUT = 5.0   # Seconds to wait for the replies of the server to a group of commands
+BATCH_MODE = False      # Decode each received block into NumPy arrays (requires numpy)
+PIPELINED = True        # Receive and write on separate threads
+WRITER_THREADS = 1      # Number of writer threads when PIPELINED
+QUEUE_SIZE = 256        # Maximum number of received chunks waiting per writer thread
 
 # DEVICE_ID = '3BD111'    # Device A02DE7
+DEVICE_ID = None        # Device connected by connect_device(), used when reconnecting
+
+# Reconnecting after a lost connection
+RECONNECT_TIMEOUT = 60.0        # Give up reconnecting after this many seconds
+RECONNECT_INITIAL_DELAY = 0.5   # Seconds before the second attempt, doubled after every failure
+RECONNECT_MAX_DELAY = 8.0       # Maximum seconds between attempts
+CONNECT_TIMEOUT = 5.0           # Seconds to wait for the server during a reconnect attempt
+RECONNECT_POLL = 0.1            # Seconds between checks of STREAMING while waiting to retry
+RECONNECT_COUNT = 0             # Number of successful reconnects
+GAPS = []                       # (time.time() when the connection was lost, outage in seconds)
 
 # Devices
 DEVICE_LIST = []
 
+# Writer for each subscribed stream, keyed on stream name (acc, bvp, gsr, ibi, hr, tmp)
+DATA_WRITERS = {}
+
+# Output format, one of storage.BACKENDS ("csv", "npz", "parquet" or "csvz")
+STORAGE_BACKEND = "csv"
+STORAGE_FLUSH_ROWS = 4096       # Rows buffered per stream by the binary backends
+STORAGE_FLUSH_INTERVAL = 5.0    # Seconds before buffered data is written and flushed anyway
+STORAGE_BUFFER_SIZE = 64 * 1024 # Size of the file buffers in bytes
+STORAGE_FSYNC_INTERVAL = None   # Seconds between fsyncs of the files, None to never fsync
+
+# Keep the last LIVE_BUFFER_SECONDS of every stream in memory, see ring_buffer.py.
+# 0 disables the live buffers (they require numpy).
+LIVE_BUFFER_SECONDS = 0
+LIVE_PLOT = False       # Show the live buffers in a Tk window, see live_plot.py
+
+# Compute HRV, skin conductance responses and activity while recording and
+# save them in features_data.csv, see features.py
+FEATURES = False
+
+# Save the receive time of every batch and the estimated drift of the
+# device clock in clock_data.csv, see clock.py
+CLOCK = False
+
+
+# Print sample rates, decode time, writer lag and error counters of the
+# device every METRICS_INTERVAL seconds (0 to not print them), and serve them
+# for Prometheus on http://127.0.0.1:METRICS_PORT/metrics if METRICS_PORT is
+# set, see metrics.py
+METRICS_INTERVAL = 10.0
+METRICS_PORT = None
+METRICS = MetricsRegistry()
+
+# Re-broadcast the decoded samples to local subscribers on PUBLISH_ADDRESS,
+# "tcp:HOST:PORT" or "unix:PATH", None to not publish, see publisher.py
+PUBLISH_ADDRESS = None
+PUBLISHER = None
+
+
 # Select which data to stream
 ACC = True              # 3-axis acceleration
 BVP = True              # Blood volume pressure
@@ -38,15 +99,21 @@ STREAMING_INITIALIZED = False
 STATUS_STREAMING = False
 
 
-def connect_server():
+def connect_server(timeout = None):
     # Create a TCP connection with HOST on PORT
-    # Creates a global object s of type socket. 
+    # Creates a global object s of type socket and the global CHANNEL of
+    # type commands.CommandChannel used to send commands over it.
+    # Args:
+    #   timeout: float, seconds the socket waits for connecting and for every
+    #       recv and send, None to block
 
-    global s
+    global s, CHANNEL
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.settimeout(timeout)
     
     try:
         s.connect((HOST,PORT))
+        CHANNEL = CommandChannel(s, COMMAND_TIMEOUT, BUFFER_SIZE)
         return True
     except:
         return False
@@ -54,13 +121,13 @@ def connect_server():
 def update_device_list():
     global DEVICE_LIST
     try:
-        s.send("device_list\r\n".encode())
-        response = s.recv(BUFFER_SIZE).decode("utf-8")
+        response = CHANNEL.command("device_list")
+        # "R device_list 2 | 9ff167 Empatica_E4 | 7a3166 Empatica_E4"
         device_list = response.split("|")
         if (len(device_list)>1):
             device_list = device_list[1:]
             for i in range(len(device_list)):
-                device_list[i] = device_list[i].split(" ")[1]
+                device_list[i] = device_list[i].split()[0]
         else:
             device_list = []
 
@@ -85,19 +152,22 @@ def check_streaming_server_response(response):
 def connect_device(device_ID):
     # Create a connection to specified device.
     # Connection to server needed to run.
-    
+    # Connecting and pausing the stream are sent together, the pause is
+    # ignored by the server if the device cannot be connected.
+    global DEVICE_ID
     try:
-        s.send(("device_connect " + device_ID + "\r\n").encode())
-        response = s.recv(BUFFER_SIZE).decode("utf-8")
+        response, _ = CHANNEL.request(["device_connect " + device_ID, "pause ON"])
         if(not check_streaming_server_response(response)):
             print("\tFailed to connect to device!")
             return False
 
-        s.send("pause ON \r\n".encode())
-        response = s.recv(BUFFER_SIZE)
+        DEVICE_ID = device_ID
         return True
     except TypeError:
         print("\tSYSTEM_ERROR: got wrong type!")
+    except CommandTimeout as e:
+        print("\tERROR: " + str(e))
+        return False
     except:
         return False
 
@@ -106,128 +176,158 @@ def connect_device(device_ID):
 def disconnect():
     try:
         print("Trying to disconnect")
-        s.send(("device_disconnect" + "\r\n").encode())
-        print("Now I am here!")
-        response = s.recv(BUFFER_SIZE)
-
+        CHANNEL.command("device_disconnect")
         return True
     except:
         return False
 
 def setup_subscribers():
-    # Create subscribers for the data to be streamed
-    global ACC, BVP, GSR, IBI, TMP
+    # Create subscribers for the data to be streamed.
+    # All subscriptions are sent at once and their replies collected
+    # afterwards, so this takes one round trip to the server.
+    subscriptions = [name for name, enabled in
+                     [("acc", ACC), ("bvp", BVP), ("gsr", GSR), ("ibi", IBI), ("tmp", TMP)] if enabled]
     try:
-        if ACC:
-            s.send(("device_subscribe acc ON \r\n").encode())
-            response = s.recv(BUFFER_SIZE).decode("utf-8")
-            if(not check_streaming_server_response(response)):
-                print("\tFailed to subscribe to ACC\n")
-                print("response\n" + response)
-
-        if BVP:
-            s.send(("device_subscribe bvp ON \r\n").encode())
-            response = s.recv(BUFFER_SIZE).decode("utf-8")
-            if(not check_streaming_server_response(response)):
-                print("\tFailed to subscribe to BVP\n")
-                print("\tresponse\n" + response)
+        responses = CHANNEL.request(["device_subscribe " + name + " ON" for name in subscriptions])
+    except CommandTimeout as e:
+        print("\tERROR: " + str(e))
+        return False
+    except:
+        return False
+    for name, response in zip(subscriptions, responses):
+        if(not check_streaming_server_response(response)):
+            print("\tFailed to subscribe to " + name.upper() + "\n")
+            print("\tresponse\n" + response)
+    return True
 
 
-        if GSR:
-            s.send(("device_subscribe gsr ON \r\n").encode())
-            response = s.recv(BUFFER_SIZE).decode("utf-8")
-            if(not check_streaming_server_response(response)):
-                print("\tFailed to subscribe to GSR\n")
 
-        if IBI:
-            s.send(("device_subscribe ibi ON \r\n").encode())
-            response = s.recv(BUFFER_SIZE).decode("utf-8")
-            if(not check_streaming_server_response(response)):
-                print("\tFailed to subscribe to IBI\n")
+def reconnect():
+    # Reconnect to the server and DEVICE_ID after a lost connection and
+    # resubscribe the active streams. Retries with exponential backoff for
+    # at most RECONNECT_TIMEOUT seconds.
+    # The files are kept open. When the stream resumes a gap marker with the
+    # length of the outage is written to every stream, see write_gaps().
+    # Returns True when streaming can be resumed with "pause OFF".
+    global RECONNECT_COUNT
+    lost_at = time.time()
+    started = time.monotonic()
+    delay = RECONNECT_INITIAL_DELAY
+    attempt = 0
+    while STREAMING:
+        attempt += 1
+        print(f"\tReconnecting to device {DEVICE_ID}, attempt {attempt}")
+        try:
+            s.close()
+        except NameError:
+            pass
+        if connect_server(CONNECT_TIMEOUT):
+            if connect_device(DEVICE_ID) and setup_subscribers():
+                s.settimeout(None)
+                RECONNECT_COUNT += 1
+                METRICS.device(DEVICE_ID).reconnects += 1
+                write_gaps(lost_at, time.monotonic() - started)
+                print(f"\tReconnected after {time.monotonic() - started:.1f} seconds")
+                return True
+
+        if time.monotonic() - started + delay > RECONNECT_TIMEOUT:
+            break
+        if not wait_while_streaming(delay):
+            break
+        delay = min(delay * 2, RECONNECT_MAX_DELAY)
 
-        if TMP:
-            s.send(("device_subscribe tmp ON \r\n").encode())
-            response = s.recv(BUFFER_SIZE).decode("utf-8")
-            if(not check_streaming_server_response(response)):
-                print("\tFailed to subscribe to TMP\n")
-        return True
-    except:
+    print("\tERROR: Could not reconnect to device " + str(DEVICE_ID))
+    return False
 
-        return False
 
+def wait_while_streaming(seconds):
+    # Sleep for seconds, checking STREAMING every RECONNECT_POLL seconds.
+    # Returns False as soon as STREAMING is cleared.
+    deadline = time.monotonic() + seconds
+    while STREAMING:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return True
+        time.sleep(min(remaining, RECONNECT_POLL))
+    return False
 
 
-def reconnect():
-    connect_server()
-    connect_device(DEVICE_ID)
-    setup_subscribers()
+def write_gaps(lost_at, duration):
+    # Record an outage in the output of every stream
+    # Args:
+    #   lost_at: float, time.time() when the connection was lost
+    #   duration: float, seconds until the stream was resumed
+    GAPS.append((lost_at, duration))
+    for writer in DATA_WRITERS.values():
+        writer.write_gap(lost_at, duration)
 
 
 
 def setup_files():
     # Create folders and files for saving the streamed data.
-    # Data will be saved in .csv files by the use of global objects of type csv.writer()
-    # Creates the following global objects:
-    # - acc_data_writer - type csv.writer
-    # - bvp_data_writer - type csv.writer
-    # - gsr_data_writer - type csv.writer
-    # - ibi_data_writer - type csv.writer
-    # - tmp_data_writer - type csv.writer
+    # Data will be saved by the storage backend STORAGE_BACKEND, by default
+    # in .csv files.
+    # Creates the global object STORAGE of type storage.Storage and fills
+    # DATA_WRITERS with its writers. If LIVE_BUFFER_SECONDS is set, also
+    # creates LIVE_BUFFERS of type ring_buffer.LiveBuffers, which receives
+    # the same data. If FEATURES is set, also creates FEATURE_STAGE of type
+    # features.FeatureStage. If CLOCK is set, also creates CLOCK_RECORDER of
+    # type clock.ClockRecorder. If PUBLISH_ADDRESS is set, also creates and
+    # starts PUBLISHER of type publisher.Publisher.
+    global STORAGE, LIVE_BUFFERS, FEATURE_STAGE, CLOCK_RECORDER, PUBLISHER
     try:
         parent_dir = Path("./" + "data/" + "Empatica_E4_" + SUBJECT_ID + "/")
 
-        parent_dir.mkdir(parents=True, exist_ok=True)
-
-        # print("Directory " + "\"" + "./" + SUBJECT_ID + "/" + "Data/" + "\"" + " created")
-
-
+        streams = []
         if ACC:
-            global acc_data 
-            acc_data = open(parent_dir.joinpath("acc_data.csv"), "w")
-            global acc_data_writer 
-            acc_data_writer = csv.writer(acc_data)
-            acc_header = ["timestamp","x","y","z"]
-            acc_data_writer.writerow(acc_header)
-
+            streams.append("acc")
         if BVP:
-            global bvp_data 
-            bvp_data = open(parent_dir.joinpath("bvp_data.csv"), "w")
-            global bvp_data_writer 
-            bvp_data_writer = csv.writer(bvp_data)
-            bvp_header = ["timestamp","BVP"]
-            bvp_data_writer.writerow(bvp_header)
-
+            streams.append("bvp")
         if GSR:
-            global gsr_data 
-            gsr_data = open(parent_dir.joinpath("gsr_data.csv"), "w")
-            global gsr_data_writer 
-            gsr_data_writer = csv.writer(gsr_data)
-            gsr_header = ["timestamp","GSR"]
-            gsr_data_writer.writerow(gsr_header)
-
+            streams.append("gsr")
         if IBI:
-            global ibi_data 
-            ibi_data = open(parent_dir.joinpath("ibi_data.csv"), "w")
-            global ibi_data_writer 
-            ibi_data_writer = csv.writer(ibi_data)
-            ibi_header = ["timestamp","IBI"]
-            ibi_data_writer.writerow(ibi_header)
-
-            global hr_data 
-            hr_data = open(parent_dir.joinpath("hr_data.csv"), "w")
-            global hr_data_writer 
-            hr_data_writer = csv.writer(hr_data)
-            hr_header = ["timestamp","HR"]
-            hr_data_writer.writerow(hr_header)
-
+            streams += ["ibi", "hr"]
         if TMP:
-            global tmp_data 
-            tmp_data = open(parent_dir.joinpath("tmp_data.csv"), "w")
-            global tmp_data_writer 
-            tmp_data_writer = csv.writer(tmp_data)
-            tmp_header = ["timestamp","Tmp"]
-            tmp_data_writer.writerow(tmp_header)
-        
+            streams.append("tmp")
+
+        STORAGE = Storage(parent_dir, streams, STORAGE_BACKEND,
+                          flush_rows=STORAGE_FLUSH_ROWS, flush_interval=STORAGE_FLUSH_INTERVAL,
+                          buffer_size=STORAGE_BUFFER_SIZE, fsync_interval=STORAGE_FSYNC_INTERVAL)
+        DATA_WRITERS.clear()
+        DATA_WRITERS.update(STORAGE.writers)
+
+        if LIVE_BUFFER_SECONDS:
+            from ring_buffer import LiveBuffers
+            LIVE_BUFFERS = LiveBuffers(LIVE_BUFFER_SECONDS, streams)
+            for stream_name in streams:
+                DATA_WRITERS[stream_name] = TeeWriter(STORAGE.writers[stream_name],
+                                                      LIVE_BUFFERS.writers[stream_name])
+
+        if FEATURES:
+            FEATURE_STAGE = FeatureStage(parent_dir.joinpath("features_data.csv"),
+                                         buffer_size=STORAGE_BUFFER_SIZE,
+                                         flush_interval=STORAGE_FLUSH_INTERVAL,
+                                         fsync_interval=STORAGE_FSYNC_INTERVAL)
+            for stream_name, writer in FEATURE_STAGE.writers.items():
+                if stream_name in DATA_WRITERS:
+                    DATA_WRITERS[stream_name] = TeeWriter(DATA_WRITERS[stream_name], writer)
+
+        if PUBLISH_ADDRESS and PUBLISHER is None:
+            from publisher import Publisher
+            PUBLISHER = Publisher(PUBLISH_ADDRESS)
+            PUBLISHER.start()
+            print(f"\tPublishing samples on {PUBLISHER.address}")
+        if PUBLISHER is not None:
+            for stream_name in streams:
+                DATA_WRITERS[stream_name] = TeeWriter(DATA_WRITERS[stream_name],
+                                                      PUBLISHER.writer(DEVICE_ID, stream_name))
+
+        CLOCK_RECORDER = None
+        if CLOCK:
+            CLOCK_RECORDER = ClockRecorder(parent_dir.joinpath("clock_data.csv"),
+                                           buffer_size=STORAGE_BUFFER_SIZE,
+                                           flush_interval=STORAGE_FLUSH_INTERVAL,
+                                           fsync_interval=STORAGE_FSYNC_INTERVAL)
         return True
     except:
         return False
@@ -241,56 +341,65 @@ def stream():
     # Starts the stream and saves the incomming data in the correct .csv files.
     global STREAMING
     STREAMING = True
+    framer = LineFramer()
+    device_metrics = METRICS.device(DEVICE_ID)
+    start_metrics()
+    if BATCH_MODE:
+        # Only needed in batch mode, so numpy stays optional
+        from batch import BlockDecoder
+        block_decoder = BlockDecoder()
     s.send("pause OFF \r\n".encode())
     try:
         while(STREAMING):
             try:
                 # print("Trying to get response")
-                response = s.recv(BUFFER_SIZE).decode("utf-8")
+                n_bytes = framer.recv_from(s, BUFFER_SIZE)
+                receive_ns = time.monotonic_ns()
+                device_metrics.add_bytes(n_bytes)
+                if n_bytes == 0:
+                    print("\tConnection closed by the streaming server")
+                    if not resume_stream():
+                        break
+                    framer = LineFramer()
+                    continue
+                # Lines received before a connection lost message are written first
+                samples, lost = split_connection_lost(framer.lines())
                 # print("Got response")
-                if "connection lost to device" in response:
-                    reconnect()
-                    break
 
-                samples = response.split("\n")
-                for i in range(len(samples)-1):
-                    stream_type = samples[i].split()[0]
-                    if stream_type == "E4_Acc":
-                        timestamp = float(samples[i].split()[1].replace(',','.'))
-                        data = [int(samples[i].split()[2].replace(',','.')), int(samples[i].split()[3].replace(',','.')), int(samples[i].split()[4].replace(',','.'))]
-                        acc_data_writer.writerow([timestamp] + data)
-
-                    if stream_type == "E4_Bvp":
-                        timestamp = float(samples[i].split()[1].replace(',','.'))
-                        data = float(samples[i].split()[2].replace(',','.'))
-                        bvp_data_writer.writerow([timestamp,data])
-
-                    if stream_type == "E4_Ibi":
-                        timestamp = float(samples[i].split()[1].replace(',','.'))
-                        data = float(samples[i].split()[2].replace(',','.'))
-                        ibi_data_writer.writerow([timestamp,data])
-                        # print("IBI")
-
-                    if stream_type == "E4_Hr":
-                        timestamp = float(samples[i].split()[1].replace(',','.'))
-                        data = float(samples[i].split()[2].replace(',','.'))
-                        hr_data_writer.writerow([timestamp,data])
-                        # print("HR")
-
-                    if stream_type == "E4_Gsr":
-                        timestamp = float(samples[i].split()[1].replace(',','.'))
-                        data = float(samples[i].split()[2].replace(',','.'))
-                        gsr_data_writer.writerow([timestamp,data])
-
-                    if stream_type == "E4_Temperature":
-                        timestamp = float(samples[i].split()[1].replace(',','.'))
-                        data = float(samples[i].split()[2].replace(',','.'))
-                        tmp_data_writer.writerow([timestamp,data])
+                counts = {}
+                decode_start = time.perf_counter()
+                if BATCH_MODE:
+                    blocks, n_malformed = block_decoder.decode(samples)
+                    decode_seconds = time.perf_counter() - decode_start
+                    if CLOCK_RECORDER is not None:
+                        CLOCK_RECORDER.observe_blocks(receive_ns, blocks)
+                    for stream_name, (timestamps, values) in blocks.items():
+                        writer = DATA_WRITERS.get(stream_name)
+                        if writer is not None:
+                            writer.write_block(timestamps, values)
+                        counts[stream_name] = len(timestamps)
+                else:
+                    rows, n_malformed = decode_lines(samples)
+                    decode_seconds = time.perf_counter() - decode_start
+                    if CLOCK_RECORDER is not None:
+                        CLOCK_RECORDER.observe_rows(receive_ns, rows)
+                    for stream_name, row in rows:
+                        writer = DATA_WRITERS.get(stream_name)
+                        if writer is not None:
+                            writer.writerow(row)
+                        counts[stream_name] = counts.get(stream_name, 0) + 1
+                device_metrics.add_chunk(counts, n_malformed, decode_seconds, receive_ns)
                 # print("Data registered")
+                if lost:
+                    print("\tConnection lost to device")
+                    if not resume_stream():
+                        break
+                    framer = LineFramer()
             except socket.timeout:
                 print("Socket timeout")
-                reconnect()
-                break
+                if not resume_stream():
+                    break
+                framer = LineFramer()
         else:
             print("\tDisconnecting from device\n")
             s.send("device_disconnect\r\n".encode())
@@ -299,8 +408,108 @@ def stream():
         print("\tDisconnecting from device\n")
         s.send("device_disconnect\r\n".encode())
         s.close()
+    finally:
+        close_files()
+
+
+
+def stream_pipelined():
+    # Starts the stream like stream(), but receives on a reader thread and
+    # writes on WRITER_THREADS writer threads connected by bounded queues.
+    # Returns when STREAMING is cleared or the connection is lost.
+    global STREAMING, PIPELINE
+    STREAMING = True
+    connection_lost = threading.Event()
+    start_metrics()
+
+    s.send("pause OFF \r\n".encode())
+    try:
+        while True:
+            # A new pipeline for every connection, the writers are reused
+            connection_lost.clear()
+            PIPELINE = StreamPipeline(s, DATA_WRITERS, lambda: STREAMING,
+                                      n_writers=WRITER_THREADS, queue_size=QUEUE_SIZE,
+                                      recv_size=BUFFER_SIZE, batch_mode=BATCH_MODE,
+                                      on_connection_lost=connection_lost.set,
+                                      clock=CLOCK_RECORDER,
+                                      device_metrics=METRICS.device(DEVICE_ID))
+            PIPELINE.start()
+            try:
+                PIPELINE.join()
+            except KeyboardInterrupt:
+                PIPELINE.stop()
+                PIPELINE.join()
+                break
+            print("\tPipeline stopped: " + str(PIPELINE.metrics.as_dict()))
+            if not connection_lost.is_set() or not resume_stream():
+                break
+    finally:
+        # The writer threads have finished, so nothing writes to the files any more
+        close_files()
+    if not connection_lost.is_set():
+        print("\tDisconnecting from device\n")
+        s.send("device_disconnect\r\n".encode())
+    s.close()
 
 
+def resume_stream():
+    # Reconnect after a lost connection and restart the data stream.
+    # Returns False if streaming has to end.
+    if not reconnect():
+        return False
+    s.send("pause OFF \r\n".encode())
+    return True
+
+
+def start_metrics():
+    # Start reporting METRICS, see METRICS_INTERVAL and METRICS_PORT.
+    # Creates the global METRICS_REPORTER of type metrics.MetricsReporter.
+    global METRICS_REPORTER
+    METRICS_REPORTER = None
+    if METRICS_INTERVAL or METRICS_PORT is not None:
+        # Rates are still updated for the endpoint when nothing is printed
+        try:
+            METRICS_REPORTER = MetricsReporter(METRICS, METRICS_INTERVAL or INTERVAL, METRICS_PORT,
+                                               log=bool(METRICS_INTERVAL))
+        except OSError as e:
+            print(f"\tWARNING: Cannot serve metrics on port {METRICS_PORT}: {e}")
+            return
+        METRICS_REPORTER.start()
+
+
+def stop_metrics():
+    global METRICS_REPORTER
+    reporter = globals().get("METRICS_REPORTER")
+    METRICS_REPORTER = None
+    if reporter is not None:
+        reporter.stop()
+        if reporter.log:
+            reporter.report()
+
+
+def close_files():
+    # Flush and close all files opened by setup_files() and print the
+    # writer counters. Does nothing if the files are already closed.
+    global PUBLISHER
+    try:
+        storage = STORAGE
+    except NameError:
+        return
+    stop_metrics()
+    writers = dict(storage.writers)
+    DATA_WRITERS.clear()
+    storage.close()
+    if PUBLISHER is not None:
+        PUBLISHER.stop()
+        PUBLISHER = None
+    if FEATURES:
+        FEATURE_STAGE.close()
+    if CLOCK_RECORDER is not None:
+        CLOCK_RECORDER.close()
+    for stream_name, writer in writers.items():
+        counters = writer.stats.as_dict()
+        print(f"\t{stream_name}: {counters['bytes_written']} bytes, {counters['flushes']} flushes, "
+              f"max flush {counters['max_flush_seconds'] * 1000:.1f} ms")
 
 
 ## Helper functions
@@ -443,7 +652,7 @@ def main():
     get_specific_input("Enter 'start' to start streaming: ", ["start"])
 
     print("\n\tStreaming is starting.\n")
-    stream_thread = threading.Thread(target=stream, args=())
+    stream_thread = threading.Thread(target=stream_pipelined if PIPELINED else stream, args=())
     stream_thread.start()
 
     print("\tStreaming started.\n")
@@ -452,7 +661,12 @@ def main():
 
     input_thread.start()
 
-            
+    if LIVE_PLOT and LIVE_BUFFER_SECONDS:
+        # Tk has to run on the main thread
+        from live_plot import run_monitor
+        run_monitor({device: LIVE_BUFFERS})
 
-main()
+            
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,534 @@
+#!/usr/bin/env python3
+
+# Record many devices with a pool of worker processes.
+#
+# The devices are split round robin over the workers. Every worker process
+# connects, subscribes and streams its devices with asyncio, the same way as
+# async_recorder.py, reconnects lost devices like stream.reconnect(), and
+# decodes the data with batch.BlockDecoder. Decoding runs in the workers, so
+# it is not limited by the GIL of a single process.
+#
+# Every worker also writes its devices with storage.Storage (one directory
+# per device, like async_recorder.py), so decoding and writing both scale
+# with the workers. The parent only receives the sample counts and timings
+# of every block for its metrics (see metrics.py), which cover all devices.
+# Every worker sends its messages on its own pipe: a killed worker can
+# leave the lock of a shared multiprocessing.Queue held, which would block
+# all other workers.
+#
+# With a publisher, the decoded blocks also go to the parent through a
+# SharedRing per worker, a byte ring buffer in multiprocessing.shared_memory:
+# the worker copies the arrays into the ring and sends only their offsets.
+# The parent publishes the blocks and releases the space in the ring. When
+# a ring is full the worker still writes the block but does not publish it.
+#
+# Every worker reports the state of its devices every HEALTH_INTERVAL
+# seconds. A worker that exits or stops reporting is restarted, and the new
+# worker appends to the files of its devices (see storage.Storage) after a
+# gap from the last data the parent heard of. The parquet backend cannot
+# append and is not available. Gaps are only written for devices that sent
+# data, not for a first connect that fails.
+# Needs numpy.
+#
+# Usage:
+#   python supervisor.py SUBJECT_ID [DEVICE_ID ...] [--workers N] [--duration SECONDS]
+
+import argparse
+import asyncio
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import struct
+import time
+from multiprocessing import shared_memory
+from pathlib import Path
+
+import numpy as np
+
+from async_recorder import READ_SIZE, SUBSCRIPTIONS, list_devices, send_commands
+from batch import BlockDecoder, VALUE_COLUMNS, VALUE_DTYPES
+from commands import CommandTimeout
+from framing import LineFramer, split_connection_lost
+from metrics import MetricsRegistry, MetricsReporter
+from storage import BACKENDS, Storage
+from stream import (HOST, PORT, RECONNECT_INITIAL_DELAY, RECONNECT_MAX_DELAY, RECONNECT_TIMEOUT,
+                    check_streaming_server_response)
+
+
+RING_SIZE = 8 * 1024 * 1024     # Bytes of shared memory per worker
+HEALTH_INTERVAL = 2.0           # Seconds between health reports of a worker
+HEALTH_TIMEOUT = 10.0           # Restart a worker that has not reported for this many seconds
+RESTART_DELAY = 1.0             # Seconds before a stopped worker is restarted
+
+_TAIL = struct.Struct("<Q")
+_DATA_OFFSET = 64               # The ring data starts after the tail counter
+
+
+class SharedRing(object):
+    # Byte ring buffer in shared memory with one producer (a worker) and one
+    # consumer (the parent). The producer counts the bytes it has reserved
+    # in head, the consumer stores the bytes it has released as tail at the
+    # start of the segment. Both only grow, so head - tail is the space in use.
+
+    def __init__(self, size = RING_SIZE, name = None):
+        # Args:
+        #   size: int, bytes of ring data, used when creating the segment
+        #   name: string, name of an existing segment to attach to, None to create one
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=_DATA_OFFSET + size)
+            _TAIL.pack_into(self.shm.buf, 0, 0)
+        else:
+            # Worker processes share the resource tracker of the parent,
+            # which unlinks the segment if the parent does not
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        self.capacity = self.shm.size - _DATA_OFFSET
+        self.head = 0
+
+    def tail(self):
+        return _TAIL.unpack_from(self.shm.buf, 0)[0]
+
+    def reserve(self, n_bytes):
+        # Reserve n_bytes (rounded up to 8) in the producer.
+        # Returns the offset into the segment, or None if the ring is full.
+        n_bytes = (n_bytes + 7) & ~7
+        position = self.head % self.capacity
+        # Records are never split, skip the end of the ring if it is too short
+        padding = self.capacity - position if position + n_bytes > self.capacity else 0
+        if self.head + padding + n_bytes - self.tail() > self.capacity:
+            return None
+        self.head += padding
+        offset = _DATA_OFFSET + self.head % self.capacity
+        self.head += n_bytes
+        return offset
+
+    def release(self, head):
+        # Release everything up to head in the consumer
+        _TAIL.pack_into(self.shm.buf, 0, head)
+
+    def put_block(self, stream, timestamps, values):
+        # Copy a block into the ring.
+        # Returns the offset of the block, or None if the ring is full.
+        offset = self.reserve(timestamps.nbytes + values.nbytes)
+        if offset is not None:
+            ring_timestamps, ring_values = self.block(stream, offset, len(timestamps))
+            ring_timestamps[:] = timestamps
+            ring_values[:] = values
+        return offset
+
+    def block(self, stream, offset, n_samples, copy = False):
+        # Returns arrays (timestamps, values) of a block put by put_block(),
+        # views into the ring unless copy is True
+        buf = self.shm.buf
+        timestamps = np.frombuffer(buf, np.float64, n_samples, offset)
+        shape = (n_samples, 3) if VALUE_COLUMNS[stream] == 3 else (n_samples,)
+        n_values = n_samples * VALUE_COLUMNS[stream]
+        values = np.frombuffer(buf, VALUE_DTYPES[stream], n_values, offset + timestamps.nbytes).reshape(shape)
+        if copy:
+            return timestamps.copy(), values.copy()
+        return timestamps, values
+
+    def close(self, unlink = False):
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class _Worker(object):
+    # Runs in a worker process, records and writes a share of the devices
+
+    def __init__(self, worker_id, generation, device_ids, storages, ring, messages, stop, subscriptions, host,
+                 port, lost_at):
+        self.worker_id = worker_id
+        self.generation = generation
+        self.device_ids = device_ids
+        self.storages = storages    # device ID -> storage.Storage
+        self.ring = ring            # SharedRing for the publisher, or None
+        self.messages = messages    # multiprocessing.connection.Connection to the parent
+        self.stop = stop
+        self.subscriptions = subscriptions
+        self.host = host
+        self.port = port
+        self.lost_at = lost_at      # device ID -> time.time() of the last data before a restart
+        self.states = {device_id: "connecting" for device_id in device_ids}
+        self.received = {device_id: device_id in lost_at for device_id in device_ids}
+        self.decoder = BlockDecoder()
+
+    def send(self, *message):
+        self.messages.send((message[0], self.worker_id, self.generation) + message[1:])
+
+    def set_state(self, device_id, state):
+        if self.states[device_id] != state:
+            self.states[device_id] = state
+            self.send("health", dict(self.states))
+
+    async def run(self):
+        tasks = [asyncio.create_task(self.record(device_id, self.lost_at.get(device_id)))
+                 for device_id in self.device_ids]
+        try:
+            while not self.stop.is_set():
+                self.send("health", dict(self.states))
+                for _ in range(int(HEALTH_INTERVAL / 0.1)):
+                    if self.stop.is_set():
+                        break
+                    await asyncio.sleep(0.1)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def record(self, device_id, lost_at = None):
+        # Record device_id, reconnecting with exponential backoff for at
+        # most RECONNECT_TIMEOUT seconds after every loss
+        # Args:
+        #   lost_at: time.time() the device was lost by the previous worker, or None
+        started = time.monotonic() - (time.time() - lost_at) if lost_at is not None else 0.0
+        delay = 0.0
+
+        def streaming():
+            nonlocal lost_at, delay
+            if lost_at is not None:
+                # There is nothing to mark before the first data
+                if self.received[device_id]:
+                    self.write_gap(device_id, lost_at, time.monotonic() - started)
+                lost_at = None
+                delay = 0.0
+            self.set_state(device_id, "streaming")
+
+        while True:
+            try:
+                await self.session(device_id, streaming)
+            except (OSError, CommandTimeout) as e:
+                print(f"\t{device_id}: {e}")
+            if lost_at is None:
+                lost_at = time.time()
+                started = time.monotonic()
+            delay = min(delay * 2, RECONNECT_MAX_DELAY) if delay else RECONNECT_INITIAL_DELAY
+            if time.monotonic() - started + delay > RECONNECT_TIMEOUT:
+                print(f"\tERROR: Could not reconnect to device {device_id}")
+                self.set_state(device_id, "failed")
+                return
+            self.set_state(device_id, "reconnecting")
+            await asyncio.sleep(delay)
+
+    async def session(self, device_id, on_streaming):
+        # One connection to device_id, returns when it is lost
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            responses = await send_commands(reader, writer, ["device_connect " + device_id, "pause ON"] +
+                                            [f"device_subscribe {name} ON" for name in self.subscriptions])
+            if not check_streaming_server_response(responses[0]):
+                raise ConnectionError(f"failed to connect to device {device_id}: {responses[0]}")
+            writer.write("pause OFF\r\n".encode())
+            await writer.drain()
+            on_streaming()
+
+            framer = LineFramer()
+            while True:
+                data = await reader.read(READ_SIZE)
+                if not data:
+                    print(f"\t{device_id}: connection closed by the streaming server")
+                    return
+                receive_ns = time.monotonic_ns()
+                framer.feed(data)
+                lines, lost = split_connection_lost(framer.lines())
+                if lines:
+                    self.put(device_id, receive_ns, len(data), lines)
+                if lost:
+                    print(f"\t{device_id}: connection lost to device")
+                    return
+        finally:
+            try:
+                writer.write("device_disconnect\r\n".encode())
+                await writer.drain()
+            except ConnectionError:
+                pass
+            writer.close()
+
+    def put(self, device_id, receive_ns, n_bytes, lines):
+        # Decode and write lines, put the blocks into the ring for the
+        # publisher and tell the parent what was written
+        decode_start = time.perf_counter()
+        blocks, n_malformed = self.decoder.decode(lines)
+        decode_seconds = time.perf_counter() - decode_start
+        writers = self.storages[device_id].writers
+        counts = {}
+        records = []
+        n_dropped = 0
+        for stream, (timestamps, values) in blocks.items():
+            writer = writers.get(stream)
+            if writer is not None:
+                writer.write_block(timestamps, values)
+            counts[stream] = len(timestamps)
+            if self.ring is not None:
+                offset = self.ring.put_block(stream, timestamps, values)
+                if offset is None:
+                    n_dropped += len(timestamps)
+                else:
+                    records.append((stream, offset, len(timestamps)))
+        if counts:
+            self.received[device_id] = True
+        head = self.ring.head if self.ring is not None else 0
+        self.send("blocks", device_id, head, receive_ns, time.monotonic_ns(), n_bytes, n_malformed, n_dropped,
+                  decode_seconds, counts, records)
+
+    def write_gap(self, device_id, lost_at, duration):
+        for writer in self.storages[device_id].writers.values():
+            writer.write_gap(lost_at, duration)
+        self.send("gap", device_id, lost_at, duration)
+
+
+def worker_main(worker_id, generation, device_ids, ring_name, messages, stop, subscriptions, host, port,
+                directory, backend, policy, lost_at):
+    # Entry point of a worker process
+    # Args (see Supervisor):
+    #   ring_name: string, name of the SharedRing of the publisher, or None
+    #   directory: pathlib.Path, data is saved under directory/<device ID>/
+    #   lost_at: dict of device ID -> time.time() of the last data of a
+    #       previous worker, whose files are appended to, empty for the first worker
+    # Ctrl+C is handled by the parent, which stops the workers through stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    ring = SharedRing(name=ring_name) if ring_name is not None else None
+    streams = [stream for subscription in subscriptions for stream in SUBSCRIPTIONS[subscription]]
+    storages = {}
+    try:
+        for device_id in device_ids:
+            storages[device_id] = Storage(directory.joinpath(device_id), streams, backend,
+                                          append=generation > 1, **policy)
+        worker = _Worker(worker_id, generation, device_ids, storages, ring, messages, stop, subscriptions,
+                         host, port, lost_at)
+        asyncio.run(worker.run())
+    finally:
+        for storage in storages.values():
+            storage.close()
+        if ring is not None:
+            ring.close()
+        messages.close()
+
+
+class _WorkerHandle(object):
+    # The parent's view of one worker
+
+    def __init__(self, worker_id, device_ids):
+        self.worker_id = worker_id
+        self.device_ids = device_ids
+        self.generation = 0
+        self.process = None
+        self.messages = None        # Receiving end of the pipe of the current process
+        self.ring = None            # SharedRing of the current process, only with a publisher
+        self.last_report = None
+        self.last_data = {}         # device ID -> time.time() of its last block
+        self.states = {}
+
+
+class Supervisor(object):
+
+    def __init__(self, subject_id, device_ids, n_workers = None, subscriptions = tuple(SUBSCRIPTIONS),
+                 backend = "npz", host = HOST, port = PORT, data_dir = Path("./data"), ring_size = RING_SIZE,
+                 metrics = None, publisher = None, **policy):
+        # Args:
+        #   subject_id: string, data is saved under data_dir/Empatica_E4_<subject_id>/<device ID>/
+        #   device_ids: list of strings
+        #   n_workers: int, worker processes, default one per CPU but at most one per device
+        #   subscriptions: list of strings, keys of async_recorder.SUBSCRIPTIONS
+        #   backend: string, one of storage.BACKENDS except parquet
+        #   metrics: metrics.MetricsRegistry, or None for a new one
+        #   publisher: started publisher.Publisher the samples are also sent to, or None
+        #   policy: buffer sizes and intervals passed to storage.Storage
+        if not device_ids:
+            raise ValueError("no devices to record")
+        if backend not in BACKENDS:
+            raise ValueError("unknown storage backend " + str(backend))
+        if backend == "parquet":
+            raise ValueError("the parquet backend cannot append the files of a restarted worker")
+        n_workers = min(n_workers or os.cpu_count() or 1, len(device_ids))
+        self.subscriptions = list(subscriptions)
+        self.backend = backend
+        self.policy = policy
+        self.host = host
+        self.port = port
+        self.ring_size = ring_size
+        self.metrics = metrics if metrics is not None else MetricsRegistry()
+        self.publisher = publisher
+        self.workers = [_WorkerHandle(i, device_ids[i::n_workers]) for i in range(n_workers)]
+        # Fail here rather than in every worker if the directories cannot be created
+        self.directory = Path(data_dir).joinpath("Empatica_E4_" + subject_id)
+        for device_id in device_ids:
+            self.directory.joinpath(device_id).mkdir(parents=True, exist_ok=True)
+
+        self._context = multiprocessing.get_context()
+        self._stop = self._context.Event()
+
+    def start(self):
+        for worker in self.workers:
+            self._start_worker(worker)
+
+    def _start_worker(self, worker):
+        # The previous process of worker has exited, what it did not send is lost
+        self._close_worker(worker)
+        worker.generation += 1
+        ring_name = None
+        if self.publisher is not None:
+            worker.ring = SharedRing(self.ring_size)
+            ring_name = worker.ring.name
+        worker.messages, messages = self._context.Pipe(duplex=False)
+        worker.last_report = time.monotonic()
+        worker.process = self._context.Process(
+            target=worker_main, name="e4-worker-%d" % worker.worker_id,
+            args=(worker.worker_id, worker.generation, worker.device_ids, ring_name, messages,
+                  self._stop, self.subscriptions, self.host, self.port, self.directory, self.backend,
+                  self.policy, dict(worker.last_data)))
+        worker.process.start()
+        messages.close()
+
+    def _close_worker(self, worker):
+        if worker.messages is not None:
+            worker.messages.close()
+            worker.messages = None
+        if worker.ring is not None:
+            worker.ring.close(unlink=True)
+            worker.ring = None
+
+    def run(self, duration = None):
+        # Handle the messages of the workers until duration seconds have
+        # passed (or forever), restarting workers that stop
+        end = time.monotonic() + duration if duration is not None else None
+        while end is None or time.monotonic() < end:
+            self.poll(0.1)
+            self.check_workers()
+
+    def poll(self, timeout):
+        # Handle all waiting messages, waiting at most timeout seconds for the first
+        workers = {worker.messages: worker for worker in self.workers if worker.messages is not None}
+        for messages in multiprocessing.connection.wait(list(workers), timeout):
+            try:
+                # The messages are small enough to be written to the pipe in
+                # one piece, recv() never waits for the rest of one
+                while messages.poll():
+                    self._handle(workers[messages], messages.recv())
+            except (EOFError, OSError):
+                # The worker has exited, check_workers() restarts it
+                messages.close()
+                workers[messages].messages = None
+
+    def _handle(self, worker, message):
+        kind, worker_id, generation = message[:3]
+        if kind == "blocks":
+            (device_id, head, receive_ns, written_ns, n_bytes, n_malformed, n_dropped, decode_seconds, counts,
+             records) = message[3:]
+            if records:
+                # The publisher encodes the blocks right away, so the ring space can be released afterwards
+                ring = worker.ring
+                for stream, offset, n_samples in records:
+                    self.publisher.publish_block(device_id, stream, *ring.block(stream, offset, n_samples))
+                ring.release(head)
+            if counts:
+                worker.last_data[device_id] = time.time()
+            device_metrics = self.metrics.device(device_id)
+            device_metrics.add_bytes(n_bytes)
+            device_metrics.add_chunk(counts, n_malformed, decode_seconds, receive_ns, written_ns)
+            if n_dropped:
+                device_metrics.add_dropped(n_dropped)
+        elif kind == "gap":
+            device_id, lost_at, duration = message[3:]
+            self.metrics.device(device_id).reconnects += 1
+            if self.publisher is not None:
+                for subscription in self.subscriptions:
+                    for stream in SUBSCRIPTIONS[subscription]:
+                        self.publisher.publish_gap(device_id, stream, lost_at, duration)
+        elif kind == "health":
+            if generation == worker.generation:
+                worker.last_report = time.monotonic()
+                states = message[3]
+                for device_id, state in states.items():
+                    if worker.states.get(device_id) != state:
+                        print(f"\t{device_id}: {state} (worker {worker_id})")
+                worker.states = states
+
+    def check_workers(self):
+        # Restart workers that have exited or stopped reporting. Workers
+        # whose devices have all failed are left stopped.
+        now = time.monotonic()
+        for worker in self.workers:
+            if worker.states and all(state == "failed" for state in worker.states.values()):
+                continue
+            alive = worker.process.is_alive()
+            if alive and now - worker.last_report < HEALTH_TIMEOUT:
+                continue
+            if now - worker.last_report < RESTART_DELAY:
+                continue
+            print(f"\tWARNING: Restarting worker {worker.worker_id} " +
+                  ("(not reporting)" if alive else f"(exit code {worker.process.exitcode})"))
+            if alive:
+                worker.process.terminate()
+            worker.process.join()
+            self._start_worker(worker)
+
+    def health(self):
+        # Returns a dict of device ID -> state reported by its worker
+        return {device_id: state for worker in self.workers for device_id, state in worker.states.items()}
+
+    def stop(self):
+        # Stop the workers, which close their files, and handle what they sent
+        self._stop.set()
+        deadline = time.monotonic() + 10.0
+        for worker in self.workers:
+            while worker.process.is_alive() and time.monotonic() < deadline:
+                self.poll(0.1)
+            if worker.process.is_alive():
+                worker.process.terminate()
+            worker.process.join()
+        self.poll(0.1)
+        for worker in self.workers:
+            self._close_worker(worker)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Record many Empatica E4 devices with worker processes.")
+    parser.add_argument("subject_id", help="data is saved under ./data/Empatica_E4_<subject_id>/")
+    parser.add_argument("devices", nargs="*", help="device IDs, default all devices of the server")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, default one per CPU")
+    parser.add_argument("--duration", type=float, default=None, help="seconds to record, default until Ctrl+C")
+    parser.add_argument("--streams", default="acc,bvp,gsr,ibi,tmp", help="comma separated subscriptions")
+    parser.add_argument("--backend", default="npz", choices=sorted(set(BACKENDS) - {"parquet"}),
+                        help="output format")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--metrics-interval", type=float, default=10.0, help="seconds between metrics lines")
+    parser.add_argument("--publish", help="also send the samples to subscribers on tcp:HOST:PORT or unix:PATH")
+    args = parser.parse_args()
+
+    subscriptions = [stream.strip().lower() for stream in args.streams.split(",") if stream.strip()]
+    for subscription in subscriptions:
+        if subscription not in SUBSCRIPTIONS:
+            parser.error("unknown stream " + subscription)
+    devices = [device.upper() for device in args.devices]
+    if not devices:
+        devices = asyncio.run(list_devices(args.host, args.port))
+
+    publisher = None
+    if args.publish:
+        from publisher import Publisher
+        publisher = Publisher(args.publish)
+        publisher.start()
+        print(f"\tPublishing samples on {publisher.address}")
+    supervisor = Supervisor(args.subject_id, devices, args.workers, subscriptions, args.backend,
+                            args.host, args.port, publisher=publisher)
+    reporter = MetricsReporter(supervisor.metrics, args.metrics_interval)
+    supervisor.start()
+    reporter.start()
+    try:
+        supervisor.run(args.duration)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        supervisor.stop()
+        reporter.stop()
+        reporter.report()
+        if publisher is not None:
+            publisher.stop()
+
+
+if __name__ == "__main__":
+    main()
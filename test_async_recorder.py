@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+# Tests of async_recorder.py against mock_server.py, run with python -m pytest
+
+import asyncio
+
+import pytest
+
+import mock_server
+from async_recorder import ConnectionLost, list_devices, record
+from metrics import MetricsRegistry
+
+
+def start_server(*args):
+    server = mock_server.MockE4Server(mock_server.parse_args(["--rate-scale", "4"] + list(args)), port=0)
+    server.start()
+    return server
+
+
+@pytest.fixture
+def server():
+    server = start_server("--devices", "2")
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def count_rows(path):
+    with open(path) as f:
+        return sum(1 for line in f if not line.startswith(("timestamp", "#"))) if path.exists() else 0
+
+
+def test_records_every_device(server, tmp_path):
+    port = server.server_address[1]
+    assert asyncio.run(list_devices("127.0.0.1", port)) == server.devices
+    results = asyncio.run(record("test", [], ["acc", "ibi"], 1.0, port=port, host="127.0.0.1", data_dir=tmp_path))
+    assert sorted(results) == server.devices
+    for device_id, n_rows in results.items():
+        directory = tmp_path.joinpath("Empatica_E4_test", device_id)
+        assert n_rows > 0
+        assert n_rows == sum(count_rows(directory.joinpath(stream + "_data.csv")) for stream in ["acc", "ibi", "hr"])
+        assert not directory.joinpath("bvp_data.csv").exists()
+
+
+def test_metrics_record_writer_lag(server, tmp_path):
+    registry = MetricsRegistry()
+    results = asyncio.run(record("test", server.devices[:1], ["bvp"], 0.5, port=server.server_address[1],
+                                 host="127.0.0.1", data_dir=tmp_path, metrics=registry))
+    device_metrics = registry.devices[server.devices[0]]
+    assert device_metrics.samples["bvp"] == results[server.devices[0]] > 0
+    assert device_metrics.writer_lag_seconds.count > 0
+    assert device_metrics.bytes_received > 0
+
+
+def test_unknown_device_does_not_stop_the_others(server, tmp_path):
+    port = server.server_address[1]
+    results = asyncio.run(record("test", [server.devices[0], "FFFFFF"], ["bvp"], 0.5, port=port,
+                                 host="127.0.0.1", data_dir=tmp_path))
+    assert results[server.devices[0]] > 0
+    assert isinstance(results["FFFFFF"], ConnectionError)
+
+
+def test_connection_lost(tmp_path):
+    server = start_server("--lose-after", "0.3")
+    try:
+        results = asyncio.run(record("test", server.devices, ["bvp"], 5.0, port=server.server_address[1],
+                                     host="127.0.0.1", data_dir=tmp_path))
+    finally:
+        server.shutdown()
+        server.server_close()
+    result = results[server.devices[0]]
+    assert isinstance(result, ConnectionLost)
+    directory = tmp_path.joinpath("Empatica_E4_test", server.devices[0])
+    assert result.n_rows == count_rows(directory.joinpath("bvp_data.csv")) > 0
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+# Tests of batch.py, run with python -m pytest
+
+import csv
+import io
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from batch import BlockDecoder, block_csv
+from bench_framing import synthetic_recording
+from decoder import decode_lines
+
+
+def synthetic_lines(seconds = 5):
+    return [line for line in synthetic_recording(seconds).decode("utf-8").split("\r\n") if line]
+
+
+def test_matches_decode_lines():
+    lines = synthetic_lines()
+    blocks, n_malformed = BlockDecoder().decode(lines)
+    rows, _ = decode_lines(lines)
+    assert n_malformed == 0
+    for stream, (timestamps, values) in blocks.items():
+        expected = np.array([row for name, row in rows if name == stream])
+        assert np.array_equal(timestamps, expected[:, 0])
+        assert np.allclose(values.reshape(len(timestamps), -1), expected[:, 1:], rtol=1e-6)
+
+
+def test_misaligned_lines_are_malformed():
+    # The token counts add up, but neither line has three values
+    blocks, n_malformed = BlockDecoder().decode(["E4_Acc 1,5 1 2", "E4_Acc 2,5 1 2 3"])
+    timestamps, values = blocks["acc"]
+    assert n_malformed == 1
+    assert timestamps.tolist() == [2.5]
+    assert values.tolist() == [[1, 2, 3]]
+
+
+def test_acc_outside_int16_is_malformed():
+    blocks, n_malformed = BlockDecoder().decode(["E4_Acc 1,5 100000 2 3", "E4_Acc 2,5 1 2 3",
+                                                 "E4_Acc 3,5 1.5 2 3"])
+    assert n_malformed == 2
+    assert blocks["acc"][1].tolist() == [[1, 2, 3]]
+
+
+def test_order_kept_and_other_lines_skipped():
+    lines = ["E4_Bvp 3,0 1,5", "R device_subscribe bvp OK", "E4_Hr 1,0 60", "E4_Bvp 1,0 2,5",
+             "E4_Accel 1 2", "E4_Bvp 2,0 x"]
+    blocks, n_malformed = BlockDecoder().decode(lines)
+    assert n_malformed == 1
+    assert blocks["bvp"][0].tolist() == [3.0, 1.0]
+    assert blocks["hr"][1].tolist() == [60.0]
+    assert "acc" not in blocks
+
+
+def test_block_csv_matches_csv_writer():
+    blocks, _ = BlockDecoder().decode(synthetic_lines())
+    for stream, (timestamps, values) in blocks.items():
+        if stream == "acc":
+            rows = [[t] + xyz for t, xyz in zip(timestamps.tolist(), values.tolist())]
+        else:
+            rows = list(zip(timestamps.tolist(), values.astype(str).tolist()))
+        expected = io.StringIO(newline="")
+        csv.writer(expected).writerows(rows)
+        assert block_csv(stream, timestamps, values) == expected.getvalue()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+# Tests of clock.py with a simulated drifting device clock, run with python -m pytest
+
+import csv
+import random
+
+import pytest
+
+from clock import MIN_SPAN, ClockRecorder, DriftEstimator
+
+
+SERVER_START = 1.6e9        # Server time of the first sample
+LOCAL_START = 1000.0        # Monotonic time of the first sample
+
+
+def local_time(server_time, drifts):
+    # Monotonic time at which the sample of server_time was taken.
+    # drifts: list of (server seconds from the start, drift in ppm from then on)
+    elapsed = server_time - SERVER_START
+    local = LOCAL_START
+    for i, (start, drift) in enumerate(drifts):
+        end = drifts[i + 1][0] if i + 1 < len(drifts) else float("inf")
+        if elapsed > start:
+            local += (min(elapsed, end) - start) * (1 + drift * 1e-6)
+    return local
+
+
+def batches(rate, duration, drifts, seed = 0):
+    # Yields (receive_ns, newest server timestamp, local time it was taken) of
+    # batches sent every 50 to 150 ms, received after 5 ms on average and
+    # now and then after another 200 ms
+    rnd = random.Random(seed)
+    send = LOCAL_START
+    i = 0
+    while True:
+        send += rnd.uniform(0.05, 0.15)
+        while local_time(SERVER_START + (i + 1) / rate, drifts) <= send:
+            i += 1
+        server_time = SERVER_START + i / rate
+        if server_time - SERVER_START > duration:
+            return
+        delay = rnd.expovariate(200.0) + (0.2 if rnd.random() < 0.05 else 0.0)
+        yield int((send + delay) * 1e9), server_time, local_time(server_time, drifts)
+
+
+def test_injected_drift_is_found():
+    estimator = DriftEstimator()
+    for receive_ns, server_time, local in batches(64, 600.0, [(0.0, 50.0)]):
+        estimator.add(server_time, receive_ns)
+        if server_time - SERVER_START < MIN_SPAN:
+            assert estimator.drift_ppm() is None
+        # Corrected to within a few ms of when the sample was taken
+        corrected = estimator.corrected_ns(server_time) / 1e9
+        assert -0.003 < corrected - local < 0.02
+    assert estimator.drift_ppm() == pytest.approx(50.0, abs=3.0)
+    assert estimator.drift_error() < 1.0
+
+
+def test_delayed_batches_do_not_bend_the_fit():
+    # A constant offset with long and frequent delays: the lower envelope sees no drift
+    estimator = DriftEstimator()
+    rnd = random.Random(3)
+    for i in range(6000):
+        server_time = SERVER_START + i * 0.1
+        delay = rnd.choice([0.001, 0.05, 0.25, 1.0]) if i % 7 else 0.001
+        estimator.add(server_time, int((LOCAL_START + i * 0.1 + delay) * 1e9))
+    assert estimator.drift_ppm() == pytest.approx(0.0, abs=0.5)
+    assert estimator.corrected_ns(SERVER_START) == pytest.approx((LOCAL_START + 0.001) * 1e9, abs=1e5)
+
+
+def test_forgetting_follows_a_changing_drift():
+    estimator = DriftEstimator()
+    for receive_ns, server_time, _ in batches(64, 3600.0, [(0.0, 50.0), (1200.0, -20.0)], seed=1):
+        estimator.add(server_time, receive_ns)
+        if server_time - SERVER_START == pytest.approx(1199.0, abs=0.01):
+            assert estimator.drift_ppm() == pytest.approx(50.0, abs=3.0)
+    assert -25.0 < estimator.drift_ppm() < -10.0
+
+
+def test_recorder_fits_every_stream_on_its_own(tmp_path):
+    path = tmp_path.joinpath("clock_data.csv")
+    recorder = ClockRecorder(path)
+    # The same batches carry a gsr sample only when a new one was taken
+    gsr = [server_time for _, server_time, _ in batches(4, 600.0, [(0.0, 50.0)], seed=2)]
+    for (receive_ns, server_time, _), gsr_time, previous in zip(batches(64, 600.0, [(0.0, 50.0)], seed=2),
+                                                                gsr, [None] + gsr):
+        rows = [("bvp", [server_time - 1 / 64.0, 0.5]), ("bvp", [server_time, 0.5])]
+        if gsr_time != previous:
+            rows.append(("gsr", [gsr_time, 0.25]))
+        recorder.observe_rows(receive_ns, rows)
+    recorder.close()
+    assert sorted(recorder.estimators) == ["bvp", "gsr"]
+    bvp = recorder.estimators["bvp"]
+    assert bvp.drift_ppm() == pytest.approx(50.0, abs=3.0)
+    assert recorder.estimators["gsr"].n_observations < bvp.n_observations
+    with open(path, newline="") as f:
+        rows = list(csv.DictReader(f))
+    assert rows[0]["drift_ppm"] == ""
+    assert [row["samples"] for row in rows if row["stream"] == "bvp"][:3] == ["2", "2", "2"]
+    assert float([row for row in rows if row["stream"] == "bvp"][-1]["drift_ppm"]) == pytest.approx(50.0, abs=3.0)
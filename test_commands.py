@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+# Tests of commands.py, run with python -m pytest
+
+import socket
+import threading
+
+import pytest
+
+from commands import CommandChannel, CommandTimeout, PendingCommands, parse_reply
+
+
+def test_replies_matched_by_name_and_stream():
+    pending = PendingCommands(["device_subscribe acc ON", "device_subscribe bvp ON", "pause OFF"])
+    assert pending.match(parse_reply("R device_subscribe bvp OK"))
+    assert pending.match(parse_reply("R pause OFF"))
+    assert not pending.done()
+    assert pending.missing() == ["device_subscribe acc ON"]
+    assert pending.match(parse_reply("R device_subscribe acc OK"))
+    assert pending.done()
+    assert pending.replies == ["R device_subscribe acc OK", "R device_subscribe bvp OK", "R pause OFF"]
+
+
+def test_error_without_stream_completes_the_oldest():
+    pending = PendingCommands(["device_subscribe acc ON", "device_subscribe bvp ON"])
+    assert pending.match(parse_reply("R device_subscribe ERR not connected"))
+    assert pending.missing() == ["device_subscribe bvp ON"]
+
+
+def test_data_lines_and_unknown_replies():
+    pending = PendingCommands(["device_list"])
+    assert parse_reply("E4_Bvp 1,0 2,5") is None
+    assert not pending.match(parse_reply("R device_connect OK"))
+
+
+def reply_server(sock, n_commands, replies):
+    # Read n_commands commands and answer with replies in one write
+    data = b""
+    while data.count(b"\n") < n_commands:
+        data += sock.recv(4096)
+    sock.sendall(b"".join(reply.encode() + b"\r\n" for reply in replies))
+
+
+def test_request_over_a_socket():
+    client, server = socket.socketpair()
+    replies = ["E4_Bvp 1,0 2,5", "R device_subscribe bvp OK", "R device_subscribe acc OK"]
+    thread = threading.Thread(target=reply_server, args=(server, 2, replies))
+    thread.start()
+    try:
+        channel = CommandChannel(client, timeout=5.0)
+        assert channel.request(["device_subscribe acc ON", "device_subscribe bvp ON"]) == \
+            ["R device_subscribe acc OK", "R device_subscribe bvp OK"]
+        assert list(channel.unsolicited) == ["E4_Bvp 1,0 2,5"]
+    finally:
+        thread.join()
+        client.close()
+        server.close()
+
+
+def test_request_timeout():
+    client, server = socket.socketpair()
+    try:
+        with pytest.raises(CommandTimeout):
+            CommandChannel(client).command("device_list", timeout=0.1)
+    finally:
+        client.close()
+        server.close()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+# Tests of compression.py, run with python -m pytest
+
+import csv
+
+import pytest
+
+from compression import (CODECS, HEADER, CompressedStreamWriter, encode_frame, read_compressed, read_frames,
+                         read_lines)
+from storage import CSV_HEADERS
+
+
+def write_frames(path, frames, codec = "zlib"):
+    with open(path, "wb") as f:
+        for data in frames:
+            f.write(encode_frame(data, codec))
+
+
+@pytest.mark.parametrize("codec", sorted(CODECS))
+def test_frames_round_trip(tmp_path, codec):
+    path = tmp_path.joinpath("acc_data.csvz")
+    frames = [b"timestamp,x,y,z\r\n", b"1.0,1,2,3\r\n" * 1000, b"", b"2.0,-4,5,-6\r\n"]
+    write_frames(path, frames, codec)
+    assert list(read_frames(path)) == frames
+    assert list(read_frames(path, first_frame=3)) == frames[3:]
+
+
+def test_crc_failure_ends_the_file(tmp_path):
+    path = tmp_path.joinpath("bvp_data.csvz")
+    write_frames(path, [b"1.0,0.5\r\n", b"2.0,1.5\r\n", b"3.0,2.5\r\n"])
+    data = bytearray(path.read_bytes())
+    # Flip a bit in the compressed bytes of the second frame
+    second = len(encode_frame(b"1.0,0.5\r\n", "zlib"))
+    data[second + HEADER.size] ^= 0x01
+    path.write_bytes(bytes(data))
+    assert list(read_frames(path)) == [b"1.0,0.5\r\n"]
+
+
+def test_truncated_last_frame_is_skipped(tmp_path):
+    path = tmp_path.joinpath("gsr_data.csvz")
+    write_frames(path, [b"1.0,0.25\r\n", b"2.0,0.5\r\n"])
+    data = path.read_bytes()
+    for cut in (1, HEADER.size + 1):
+        path.write_bytes(data[:-cut])
+        assert read_compressed(path) == "1.0,0.25\r\n"
+
+
+def test_unknown_codec_is_an_error(tmp_path):
+    path = tmp_path.joinpath("hr_data.csvz")
+    frame = bytearray(encode_frame(b"1.0,60.0\r\n", "zlib"))
+    frame[4] = 99
+    path.write_bytes(bytes(frame))
+    with pytest.raises(ValueError):
+        list(read_frames(path))
+
+
+def test_writer_frames_end_after_complete_rows(tmp_path):
+    path = tmp_path.joinpath("acc_data.csvz")
+    writer = CompressedStreamWriter(path, "acc", "zlib", frame_size=100)
+    rows = [[i / 32.0, i % 128, -(i % 128), 64] for i in range(500)]
+    for row in rows[:250]:
+        writer.writerow(row)
+    writer.write_gap(8.0, 1.5)
+    writer.writerows(rows[250:])
+    writer.close()
+    frames = list(read_frames(path))
+    assert len(frames) == writer.n_frames > 10
+    assert all(frame.endswith(b"\r\n") for frame in frames)
+    expected = [CSV_HEADERS["acc"]] + [[str(value) for value in row] for row in rows[:250]]
+    expected += [["#gap", "8.0", "1.5"]] + [[str(value) for value in row] for row in rows[250:]]
+    assert list(csv.reader(read_lines(path))) == expected
+    assert writer.stats.raw_bytes == sum(len(frame) for frame in frames)
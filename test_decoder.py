@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+
+# Tests of decoder.py, run with python -m pytest
+
+import pytest
+
+from decoder import STREAM_TAGS, decode_line, decode_lines
+
+
+def test_decode_line():
+    assert decode_line("E4_Acc 1600000000,125 -12 3 60") == ("acc", [1600000000.125, -12, 3, 60])
+    assert decode_line("E4_Temperature 1600000000,5 33,25") == ("tmp", [1600000000.5, 33.25])
+    assert decode_line("R device_subscribe acc OK") is None
+    assert decode_line("") is None
+
+
+def test_decode_line_malformed():
+    with pytest.raises(ValueError):
+        decode_line("E4_Acc 1,0 1,5 2 3")
+    with pytest.raises(IndexError):
+        decode_line("E4_Bvp 1,0")
+    with pytest.raises(ValueError):
+        decode_line("E4_Acc 1,0 1 32768 3")
+
+
+def test_acc_outside_int16_is_malformed():
+    rows, n_malformed = decode_lines(["E4_Acc 1,0 -32769 2 3", "E4_Acc 2,0 -32768 2 32767"])
+    assert rows == [("acc", [2.0, -32768, 2, 32767])]
+    assert n_malformed == 1
+
+
+def test_decode_lines_skips_and_counts():
+    lines = ["E4_Bvp 1,0 2,5", "R device_subscribe bvp OK", "", "E4_Ibi 2,0 x", "E4_Hr 3,0 61", "E4_Acc 4,0 1"]
+    rows, n_malformed = decode_lines(lines)
+    assert rows == [("bvp", [1.0, 2.5]), ("hr", [3.0, 61.0])]
+    assert n_malformed == 2
+
+
+def test_stream_tags():
+    for stream, tag in STREAM_TAGS.items():
+        line = tag + " 1,0 1 2 3" if stream == "acc" else tag + " 1,0 2"
+        assert decode_line(line)[0] == stream
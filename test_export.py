@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+# Tests of export.py, run with python -m pytest
+
+import csv
+import io
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from export import MAX_GAP, export, find_sources
+from session_reader import read_chunks, read_range
+from storage import Storage
+
+
+def record(directory, backend):
+    # bvp = t - 100 at 64 Hz with a 3 s gap from 103 s, acc at 32 Hz,
+    # hr at 100.5 s and 115 s, from 100 s to 120 s
+    storage = Storage(directory, ["bvp", "acc", "hr"], backend)
+    t = 100.0 + np.arange(64 * 20) / 64.0
+    t = t[(t < 103.0) | (t >= 106.0)]
+    storage.writers["bvp"].write_block(t, (t - 100.0).astype(np.float32))
+    storage.writers["bvp"].write_gap(103.0, 3.0)
+    t = 100.0 + np.arange(32 * 20) / 32.0
+    storage.writers["acc"].write_block(t, np.column_stack([np.arange(len(t)), -np.arange(len(t)),
+                                                           np.full(len(t), 64)]).astype(np.int16))
+    storage.writers["hr"].writerows([[100.5, 60.0], [115.0, 70.0]])
+    storage.close()
+
+
+def export_rows(session, **options):
+    output = io.StringIO()
+    n_rows = export(session, output, **options)
+    rows = list(csv.reader(io.StringIO(output.getvalue())))
+    assert n_rows == len(rows) - 1
+    return rows[0], [[float(value) if value else None for value in row] for row in rows[1:]]
+
+
+@pytest.mark.parametrize("backend", ["csv", "csvz", "npz"])
+def test_every_backend_is_resampled(tmp_path, backend):
+    record(tmp_path, backend)
+    header, rows = export_rows(tmp_path, rate=4.0, chunk_seconds=2.0)
+    assert header == ["timestamp", "acc_x", "acc_y", "acc_z", "bvp_BVP", "hr_HR"]
+    assert [row[0] for row in rows] == pytest.approx([100.0 + i / 4.0 for i in range(80)])
+    for t, acc_x, acc_y, acc_z, bvp, hr in rows:
+        assert acc_x == pytest.approx((t - 100.0) * 32) and acc_y == -acc_x and acc_z == 64
+        if 103.0 - 1 / 64.0 < t < 106.0:
+            # The gap is longer than MAX_GAP, so it is not interpolated
+            assert MAX_GAP < 3.0
+            assert bvp is None
+        else:
+            assert bvp == pytest.approx(t - 100.0, abs=1e-5)
+        if t < 100.5 or 110.5 < t < 115.0:
+            assert hr is None
+        else:
+            assert hr == (60.0 if t < 115.0 else 70.0)
+
+
+@pytest.mark.parametrize("backend", ["csv", "csvz", "npz"])
+def test_chunks_match_read_range(tmp_path, backend):
+    record(tmp_path, backend)
+    for start, end in [(None, None), (101.0, 104.5), (106.0, 119.99), (119.0, None)]:
+        chunks = list(read_chunks(tmp_path, "acc", start, end, chunk_rows=100))
+        timestamps, values = read_range(tmp_path, "acc", start, end)
+        assert all(len(chunk[0]) for chunk in chunks)
+        assert np.array_equal(np.concatenate([chunk[0] for chunk in chunks]), timestamps)
+        assert np.array_equal(np.concatenate([chunk[1] for chunk in chunks]), values)
+        assert values.dtype == np.int16 and values.shape == (len(timestamps), 3)
+
+
+def test_devices_are_merged_and_workers_agree(tmp_path):
+    record(tmp_path.joinpath("A00000"), "csv")
+    record(tmp_path.joinpath("A00001"), "npz")
+    sources = find_sources(tmp_path)
+    assert [(source.device, source.stream, source.backend) for source in sources] == [
+        ("A00000", "acc", "csv"), ("A00000", "bvp", "csv"), ("A00000", "hr", "csv"),
+        ("A00001", "acc", "npz"), ("A00001", "bvp", "npz"), ("A00001", "hr", "npz")]
+    header, rows = export_rows(tmp_path, rate=8.0, chunk_seconds=3.0)
+    assert header[1] == "A00000_acc_x" and header[6] == "A00001_acc_x"
+    assert len(rows) == 160
+    for row in rows:
+        assert row[1:6] == pytest.approx(row[6:11], abs=1e-5)
+    assert export_rows(tmp_path, rate=8.0, chunk_seconds=3.0, workers=2) == (header, rows)
+
+
+def test_empty_session(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        export(tmp_path, io.StringIO())
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+# Tests of features.py, run with python -m pytest
+
+import csv
+import math
+import random
+import statistics
+
+import pytest
+
+from features import ACC_SCALE, ActivityEpochs, FeatureStage, HrvWindow, ScrDetector
+
+
+def test_hrv_window_matches_recomputation():
+    rnd = random.Random(1)
+    window = HrvWindow(window=10.0)
+    beats = []
+    timestamp = 0.0
+    for _ in range(200):
+        ibi = rnd.uniform(0.6, 1.1)
+        timestamp += ibi
+        beats.append((timestamp, ibi))
+        result = window.add(timestamp, ibi)
+        in_window = [b for t, b in beats if t >= timestamp - 10.0]
+        if len(in_window) < 3:
+            assert result is None
+            continue
+        differences = [(b - a) ** 2 for a, b in zip(in_window, in_window[1:])]
+        rmssd, sdnn = result
+        assert rmssd == pytest.approx(math.sqrt(sum(differences) / (len(in_window) - 1)), rel=1e-9)
+        assert sdnn == pytest.approx(statistics.stdev(in_window), rel=1e-6)
+
+
+def gsr_signal(duration, response_at = None, rate = 4.0):
+    # Skin conductance of 2 uS, with a 0.3 uS response rising for 2 s from response_at
+    samples = []
+    for i in range(int(duration * rate)):
+        t = i / rate
+        value = 2.0
+        if response_at is not None and t >= response_at:
+            since = t - response_at
+            value += 0.3 * (since / 2.0 if since < 2.0 else math.exp(-(since - 2.0) / 3.0))
+        samples.append((t, value))
+    return samples
+
+
+def test_scr_detects_one_response():
+    detector = ScrDetector()
+    responses = [r for r in (detector.add(t, value) for t, value in gsr_signal(60.0, 30.0)) if r is not None]
+    assert len(responses) == 1
+    peak_time, amplitude = responses[0]
+    assert 30.0 < peak_time < 33.0
+    assert amplitude > 0.1
+
+
+def test_scr_ignores_a_flat_level():
+    detector = ScrDetector()
+    assert all(detector.add(t, value) is None for t, value in gsr_signal(60.0))
+    assert detector.tonic == pytest.approx(2.0)
+
+
+def acc_samples(n_samples, rate = 32.0):
+    # Magnitude alternating between 1 g and 2 g
+    return [(i / rate, (1 + i % 2) * ACC_SCALE, 0, 0) for i in range(n_samples)]
+
+
+def test_activity_of_alternating_magnitude():
+    epochs = ActivityEpochs(epoch=1.0)
+    results = [r for r in (epochs.add(*sample) for sample in acc_samples(32 * 5 + 1)) if r is not None]
+    assert [start for start, _ in results] == [0.0, 1.0, 2.0, 3.0, 4.0]
+    assert [activity for _, activity in results] == pytest.approx([0.5] * 5)
+
+
+def test_activity_blocks_match_rows():
+    np = pytest.importorskip("numpy")
+    rnd = random.Random(2)
+    samples = [(i / 32.0, rnd.randint(-128, 127), rnd.randint(-128, 127), rnd.randint(-128, 127))
+               for i in range(32 * 10)]
+    by_row = ActivityEpochs()
+    expected = [r for r in (by_row.add(*sample) for sample in samples) if r is not None]
+    by_block = ActivityEpochs()
+    results = []
+    for start in range(0, len(samples), 45):
+        block = samples[start:start + 45]
+        results += by_block.add_block(np.array([s[0] for s in block]),
+                                      np.array([s[1:] for s in block], dtype=np.int16))
+    assert [start for start, _ in results] == [start for start, _ in expected]
+    assert [activity for _, activity in results] == pytest.approx([activity for _, activity in expected])
+
+
+def test_feature_stage_writes_all_features(tmp_path):
+    path = tmp_path.joinpath("features_data.csv")
+    stage = FeatureStage(path)
+    timestamp = 0.0
+    for i in range(10):
+        timestamp += 0.8 + 0.05 * (i % 2)
+        stage.writers["ibi"].writerow([timestamp, 0.8 + 0.05 * (i % 2)])
+    stage.writers["gsr"].writerows([[t, value] for t, value in gsr_signal(30.0, 10.0)])
+    stage.writers["acc"].writerows([list(sample) for sample in acc_samples(32 * 3 + 1)])
+    stage.close()
+    with open(path, newline="") as f:
+        rows = list(csv.reader(f))
+    assert rows[0] == ["timestamp", "feature", "value"]
+    counts = {}
+    for _, feature, _ in rows[1:]:
+        counts[feature] = counts.get(feature, 0) + 1
+    assert counts == {"rmssd": 8, "sdnn": 8, "scr_amplitude": 1, "scl": 3, "activity": 3}
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+# Tests of framing.py, run with python -m pytest
+
+from framing import LineFramer, split_connection_lost
+
+
+class ChunkSocket(object):
+    # Socket stand-in returning the given chunks from recv_into
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    def recv_into(self, view):
+        if not self.chunks:
+            return 0
+        chunk = self.chunks.pop(0)
+        view[:len(chunk)] = chunk
+        return len(chunk)
+
+
+def test_lines_split_anywhere():
+    data = b"E4_Bvp 1,0 2,5\r\nE4_Gsr 1,0 0,3\r\n\r\nR device_subscribe bvp OK\r\n"
+    for split in range(len(data) + 1):
+        framer = LineFramer(size=4)
+        framer.feed(data[:split])
+        lines = framer.lines()
+        framer.feed(data[split:])
+        lines += framer.lines()
+        assert lines == ["E4_Bvp 1,0 2,5", "E4_Gsr 1,0 0,3", "R device_subscribe bvp OK"]
+        assert framer.pending() == 0
+
+
+def test_tail_is_kept():
+    framer = LineFramer()
+    framer.feed(b"E4_Hr 1,0 60\nE4_Hr 2,")
+    assert framer.lines() == ["E4_Hr 1,0 60"]
+    assert framer.pending() == len(b"E4_Hr 2,")
+    assert framer.lines() == []
+    framer.feed(b"0 61\n")
+    assert framer.lines() == ["E4_Hr 2,0 61"]
+
+
+def test_recv_from_grows_the_buffer():
+    line = b"E4_Acc 1,0 1 2 3\n"
+    sock = ChunkSocket([line * 100, line[:5], line[5:]])
+    framer = LineFramer(size=16)
+    lines = []
+    while framer.recv_from(sock, len(line) * 100):
+        lines += framer.lines()
+    assert lines == ["E4_Acc 1,0 1 2 3"] * 101
+
+
+def test_split_connection_lost():
+    lines = ["E4_Bvp 1,0 2,5", "R connection lost to device A00000", "E4_Bvp 2,0 2,5"]
+    assert split_connection_lost(lines) == (["E4_Bvp 1,0 2,5"], True)
+    assert split_connection_lost(lines[:1]) == (lines[:1], False)
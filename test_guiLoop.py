@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+# Tests of guiLoop.FrameScheduler with a fake timer and clock, run with python -m pytest
+
+import pytest
+
+import guiLoop
+from guiLoop import FrameScheduler
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 100.0
+
+    def perf_counter(self):
+        return self.now
+
+
+class FakeTimer(object):
+    # start_in_gui keeping the scheduled calls instead of running them
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.calls = []         # [(delay in ms, function)]
+
+    def __call__(self, gui_element, wait_time, call_this):
+        self.calls.append((wait_time, call_this))
+
+    def run_next(self):
+        # Advance the clock by the delay of the oldest call and run it
+        wait_time, call_this = self.calls.pop(0)
+        self.clock.now += wait_time / 1000.0
+        call_this()
+        return wait_time
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(guiLoop, "time", clock)
+    return clock
+
+
+def counting_loop(clock, steps, step_seconds = 0.0, wait = None, finished = None):
+    # Appends the time of every step to steps, each step takes step_seconds
+    try:
+        while True:
+            steps.append(clock.now)
+            clock.now += step_seconds
+            yield wait
+    finally:
+        if finished is not None:
+            finished.append(True)
+
+
+def test_frame_loop_is_stepped_every_frame(clock):
+    timer = FakeTimer(clock)
+    scheduler = FrameScheduler(None, fps=25, start_in_gui=timer)
+    steps = []
+    scheduler.start(counting_loop, clock, steps, 0.01)
+    assert timer.run_next() == 0
+    # The time the step took is subtracted from the frame
+    assert [timer.run_next() for _ in range(4)] == [30, 30, 30, 30]
+    assert len(steps) == 5
+    assert [round(b - a, 6) for a, b in zip(steps, steps[1:])] == [0.04] * 4
+    assert scheduler.overruns == 0
+
+
+def test_waiting_loop_is_stepped_when_due(clock):
+    timer = FakeTimer(clock)
+    scheduler = FrameScheduler(None, fps=50, start_in_gui=timer)
+    frames, waits = [], []
+    scheduler.start(counting_loop, clock, frames)
+    scheduler.start(counting_loop, clock, waits, 0.0, 0.1)
+    for _ in range(16):
+        timer.run_next()
+    assert len(frames) == 16
+    assert len(waits) == 4
+    assert [round(b - a, 6) for a, b in zip(waits, waits[1:])] == [0.1] * 3
+
+
+def test_idle_scheduler_sleeps_until_the_next_loop_is_due(clock):
+    timer = FakeTimer(clock)
+    scheduler = FrameScheduler(None, fps=50, start_in_gui=timer)
+    steps = []
+    scheduler.start(counting_loop, clock, steps, 0.0, 0.5)
+    timer.run_next()
+    assert timer.calls[0][0] == 500
+    timer.run_next()
+    assert len(steps) == 2 and scheduler.ticks == 2
+
+
+def test_slow_steps_are_overruns(clock):
+    timer = FakeTimer(clock)
+    scheduler = FrameScheduler(None, fps=50, start_in_gui=timer)
+    scheduler.start(counting_loop, clock, [], 0.05)
+    assert [timer.run_next() for _ in range(3)] == [0, 0, 0]
+    assert scheduler.overruns == 3
+
+
+def test_stopped_and_finished_loops_are_removed(clock):
+    timer = FakeTimer(clock)
+    scheduler = FrameScheduler(None, fps=50, start_in_gui=timer)
+    finished = []
+    stopped = scheduler.start(counting_loop, clock, [], 0.0, None, finished)
+    scheduler.start(lambda: iter([None, None]))
+    timer.run_next()
+    scheduler.stop(stopped)
+    assert finished == [True]
+    assert [loop["steps"] for loop in scheduler.stats()["loops"]] == [1]
+    timer.run_next()
+    timer.run_next()
+    # The last loop has finished, so no further tick is scheduled
+    assert timer.calls == []
+    assert scheduler.stats() == {"ticks": 3, "overruns": 0, "loops": []}
+    # Starting a loop again restarts the ticks
+    scheduler.start(counting_loop, clock, [])
+    assert len(timer.calls) == 1
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+# Tests of headless.py against mock_server.py, run with python -m pytest
+
+import signal
+import socket
+
+import pytest
+
+import headless
+import mock_server
+import stream
+
+
+@pytest.fixture(autouse=True)
+def restore(monkeypatch, tmp_path):
+    # main() installs a SIGTERM handler and record_one() sets the globals of stream.py
+    monkeypatch.chdir(tmp_path)
+    handler = signal.getsignal(signal.SIGTERM)
+    settings = dict(vars(stream))
+    yield
+    signal.signal(signal.SIGTERM, handler)
+    for name in set(vars(stream)) - set(settings):
+        delattr(stream, name)
+    vars(stream).update(settings)
+
+
+def start_server(*args):
+    server = mock_server.MockE4Server(mock_server.parse_args(["--devices", "2", "--rate-scale", "4"] + list(args)),
+                                      port=0)
+    server.start()
+    return server
+
+
+@pytest.fixture
+def server():
+    server = start_server()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def write_config(tmp_path, text):
+    path = tmp_path.joinpath("recorder.ini")
+    path.write_text(text)
+    return str(path)
+
+
+def test_config_file_and_command_line(tmp_path):
+    path = write_config(tmp_path, "[recorder]\n"
+                                  "subject = s1\n"
+                                  "devices = a02de7, 7a3166 9FF167   ; three devices\n"
+                                  "streams = acc, BVP\n"
+                                  "duration = 60\n"
+                                  "fsync_interval =\n"
+                                  "clock = no\n"
+                                  "workers = 2\n")
+    config = headless.load_config(headless.build_parser().parse_args(
+        ["--config", path, "--duration", "5", "--backend", "npz"]))
+    assert config["subject"] == "s1"
+    assert config["devices"] == ["A02DE7", "7A3166", "9FF167"]
+    assert config["streams"] == ["acc", "bvp"]
+    assert config["duration"] == 5.0
+    assert config["backend"] == "npz"
+    assert config["fsync_interval"] is None
+    assert config["clock"] is False
+    assert config["workers"] == 2
+    assert config["port"] == 28000
+
+
+def test_default_backend():
+    parser = headless.build_parser()
+    assert headless.load_config(parser.parse_args(["--subject", "s1", "--all"]))["backend"] == "csv"
+    assert headless.load_config(parser.parse_args(["--subject", "s1", "--all", "--workers", "2"]))["backend"] == "npz"
+    assert headless.load_config(parser.parse_args(["--subject", "s1", "--workers", "2"]))["backend"] == "csv"
+
+
+@pytest.mark.parametrize("text, args", [
+    ("", []),                                                       # No subject
+    ("[recorder]\nsubject = s1\nstreams = acc, ecg\n", []),         # Unknown stream
+    ("[recorder]\nsubject = s1\nbackend = hdf5\n", []),             # Unknown backend
+    ("[recorder]\nsubject = s1\nclock = maybe\n", []),              # Not a boolean
+    ("[recorder]\nsubject = s1\nport = http\n", []),                # Not a number
+    ("[recorder]\nsubject = s1\ncolour = red\n", []),               # Unknown option
+    ("[other]\nsubject = s1\n", []),                                # No [recorder] section
+    ("[recorder]\nsubject = s1\ndevices = A, B\nfeatures = yes\n", []),
+    ("[recorder]\nsubject = s1\n", ["--all", "--clock"]),
+    ("[recorder]\nsubject = s1\nbackend = parquet\nworkers = 2\n", ["--all"]),
+])
+def test_usage_errors(tmp_path, text, args):
+    assert headless.main(["--config", write_config(tmp_path, text)] + args) == headless.EXIT_USAGE
+
+
+def test_missing_config_file(tmp_path):
+    assert headless.main(["--config", str(tmp_path.joinpath("missing.ini"))]) == headless.EXIT_USAGE
+
+
+def test_no_server():
+    port = str(free_port())
+    assert headless.main(["--subject", "s1", "--port", port]) == headless.EXIT_SERVER
+    assert headless.main(["--subject", "s1", "--port", port, "--all"]) == headless.EXIT_SERVER
+    assert headless.main(["--subject", "s1", "--port", port, "--all", "--workers", "2"]) == headless.EXIT_SERVER
+
+
+def test_unknown_device(server):
+    port = str(server.server_address[1])
+    assert headless.main(["--subject", "s1", "--port", port, "--device", "FFFFFF",
+                          "--metrics-interval", "0"]) == headless.EXIT_DEVICE
+    assert headless.main(["--subject", "s1", "--port", port, "--device", "FFFFFF", "--device", server.devices[0],
+                          "--duration", "0.3", "--metrics-interval", "0"]) == headless.EXIT_DEVICE
+
+
+def test_records_one_device(server, tmp_path):
+    status = headless.main(["--subject", "s1", "--port", str(server.server_address[1]), "--streams", "bvp",
+                            "--duration", "0.5", "--clock", "--metrics-interval", "0"])
+    assert status == headless.EXIT_OK
+    directory = tmp_path.joinpath("data", "Empatica_E4_s1")
+    with open(directory.joinpath("bvp_data.csv")) as f:
+        assert len(f.readlines()) > 10
+    assert directory.joinpath("clock_data.csv").exists()
+
+
+def test_records_all_devices(server, tmp_path):
+    status = headless.main(["--subject", "s1", "--port", str(server.server_address[1]), "--streams", "gsr",
+                            "--all", "--duration", "0.5", "--metrics-interval", "0"])
+    assert status == headless.EXIT_OK
+    for device in server.devices:
+        assert tmp_path.joinpath("data", "Empatica_E4_s1", device, "gsr_data.csv").exists()
+
+
+def test_lost_connection():
+    server = start_server("--lose-after", "0.3")
+    try:
+        status = headless.main(["--subject", "s1", "--port", str(server.server_address[1]), "--streams", "bvp",
+                                "--all", "--duration", "5", "--metrics-interval", "0"])
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert status == headless.EXIT_CONNECTION_LOST
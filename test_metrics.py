@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+# Tests of metrics.py, run with python -m pytest
+
+import time
+import urllib.request
+
+from metrics import Histogram, MetricsRegistry, MetricsReporter
+
+
+def parse_prometheus(text):
+    # Returns {family: type} and {sample name with labels: value} of the text format
+    types = {}
+    samples = {}
+    for line in text.splitlines():
+        if line.startswith("# TYPE "):
+            _, _, name, type_ = line.split()
+            types[name] = type_
+        elif line and not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            samples[name] = float(value)
+    return types, samples
+
+
+def recorded_registry():
+    registry = MetricsRegistry()
+    device_metrics = registry.device("A00000")
+    assert registry.device("A00000") is device_metrics
+    device_metrics.add_bytes(1000)
+    device_metrics.add_chunk({"bvp": 64, "acc": 32}, 1, 0.0002, time.monotonic_ns())
+    device_metrics.add_chunk({"bvp": 64}, 0, 0.002, time.monotonic_ns() - 50 * 10 ** 6)
+    device_metrics.add_dropped(5)
+    device_metrics.reconnects += 1
+    device_metrics.set_queue_depth(3)
+    return registry
+
+
+def test_histogram_quantile():
+    histogram = Histogram([1, 2, 4])
+    assert histogram.quantile(0.5) is None
+    for value in [0.5, 1.5, 1.5, 3, 10]:
+        histogram.observe(value)
+    assert histogram.counts == [1, 2, 1, 1]
+    assert histogram.quantile(0.5) == 2
+    assert histogram.quantile(0.8) == 4
+    assert histogram.quantile(1.0) == float("inf")
+
+
+def test_prometheus_text():
+    types, samples = parse_prometheus(recorded_registry().prometheus())
+    assert types["e4_samples_total"] == "counter"
+    assert types["e4_writer_lag_seconds"] == "histogram"
+    assert samples['e4_samples_total{device="A00000",stream="bvp"}'] == 128
+    assert samples['e4_samples_total{device="A00000",stream="acc"}'] == 32
+    assert samples['e4_expected_hz{stream="bvp"}'] == 64
+    assert 'e4_expected_hz{stream="ibi"}' not in samples
+    assert samples['e4_received_bytes_total{device="A00000"}'] == 1000
+    assert samples['e4_malformed_lines_total{device="A00000"}'] == 1
+    assert samples['e4_dropped_lines_total{device="A00000"}'] == 5
+    assert samples['e4_reconnects_total{device="A00000"}'] == 1
+    # Buckets are cumulative and end with +Inf equal to the count
+    buckets = [(name, value) for name, value in samples.items() if name.startswith("e4_writer_lag_seconds_bucket")]
+    assert [value for _, value in buckets] == sorted(value for _, value in buckets)
+    assert buckets[-1] == ('e4_writer_lag_seconds_bucket{device="A00000",le="+Inf"}', 2)
+    assert samples['e4_writer_lag_seconds_bucket{device="A00000",le="0.01"}'] == 1
+    assert samples['e4_writer_lag_seconds_count{device="A00000"}'] == 2
+    assert 0.05 <= samples['e4_writer_lag_seconds_sum{device="A00000"}'] < 1.0
+    assert samples['e4_decode_seconds_bucket{device="A00000",le="0.0003"}'] == 1
+
+
+def test_rates_and_queue_depth_per_interval():
+    registry = recorded_registry()
+    device_metrics = registry.devices["A00000"]
+    device_metrics._last_update -= 2.0
+    device_metrics.update_rates()
+    assert 60 < device_metrics.observed_rates["bvp"] <= 64
+    assert device_metrics.queue_depth == 3
+    assert "queue 3, malformed 1, dropped 5, reconnects 1" in device_metrics.summary()
+    _, samples = parse_prometheus(registry.prometheus())
+    assert samples['e4_queue_depth{device="A00000"}'] == 3
+    assert 'e4_observed_hz{device="A00000",stream="bvp"}' in samples
+
+
+def test_endpoint_serves_the_registry():
+    registry = recorded_registry()
+    reporter = MetricsReporter(registry, interval=60.0, port=0, log=False)
+    reporter.start()
+    try:
+        url = "http://127.0.0.1:%d/metrics" % reporter.server.server_address[1]
+        with urllib.request.urlopen(url, timeout=5) as response:
+            assert response.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+            assert response.read().decode("utf-8") == registry.prometheus()
+    finally:
+        reporter.stop()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+# Tests of the faults injected by mock_server.py, run with python -m pytest
+
+import re
+import socket
+import time
+
+import mock_server
+
+
+DATA_LINE = re.compile(r"E4_\w+ \d+\.\d{3} -?\d+(\.\d+)?( -?\d+ -?\d+)?$")
+
+
+def wait_until(predicate, timeout = 5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def start_streaming(*args):
+    # Returns the server and a client socket receiving bvp and acc data
+    server = mock_server.MockE4Server(mock_server.parse_args(["--rate-scale", "500"] + list(args)), port=0)
+    server.start()
+    client = socket.create_connection(server.server_address)
+    client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    client.sendall(("device_connect %s\r\ndevice_subscribe bvp ON\r\ndevice_subscribe acc ON\r\n"
+                    "pause OFF\r\n" % server.devices[0]).encode())
+    return server, client
+
+
+def read_for(client, seconds):
+    # Returns everything received in the next seconds
+    deadline = time.monotonic() + seconds
+    data = b""
+    while time.monotonic() < deadline:
+        client.settimeout(max(deadline - time.monotonic(), 0.001))
+        try:
+            chunk = client.recv(65536)
+        except socket.timeout:
+            break
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def test_stalled_client_loses_whole_lines():
+    server, client = start_streaming("--send-buffer", "4096", "--client-timeout", "0.05")
+    try:
+        wait_until(lambda: server.lines_dropped > 0)
+        data = read_for(client, 0.5)
+        lines = data.decode("utf-8").split("\n")[:-1]       # The last line may still be arriving
+        data_lines = [line for line in lines if not line.startswith("R ")]
+        assert data_lines
+        assert all(DATA_LINE.match(line) for line in data_lines)
+    finally:
+        client.close()
+        server.shutdown()
+        server.server_close()
+
+
+def test_stalled_client_is_closed():
+    server, client = start_streaming("--send-buffer", "4096", "--client-timeout", "0.05",
+                                     "--slow-client", "close")
+    try:
+        time.sleep(0.5)
+        client.settimeout(5.0)
+        while client.recv(65536):
+            pass
+        assert server.lines_dropped == 0
+    finally:
+        client.close()
+        server.shutdown()
+        server.server_close()
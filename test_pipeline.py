@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+# Tests of pipeline.py, run with python -m pytest
+
+import socket
+import threading
+import time
+
+import pytest
+
+from pipeline import StreamPipeline
+
+
+class ListWriter(object):
+    # Storage writer keeping the rows, optionally blocking until released
+
+    def __init__(self, release = None):
+        self.rows = []
+        self.release = release
+
+    def writerow(self, row):
+        if self.release is not None:
+            self.release.wait()
+        self.rows.append(row)
+
+    def write_block(self, timestamps, values):
+        for timestamp, value in zip(timestamps.tolist(), values.tolist()):
+            self.writerow([timestamp] + value if isinstance(value, list) else [timestamp, value])
+
+
+def wait_until(predicate, timeout = 5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def bvp_lines(start, n):
+    return "".join("E4_Bvp %d,5 %d,25\r\n" % (i, i) for i in range(start, start + n)).encode()
+
+
+@pytest.fixture
+def sockets():
+    client, server = socket.socketpair()
+    yield client, server
+    client.close()
+    server.close()
+
+
+@pytest.mark.parametrize("batch_mode", [False, True])
+def test_rows_written_in_order(sockets, batch_mode):
+    if batch_mode:
+        pytest.importorskip("numpy")
+    client, server = sockets
+    writers = {"bvp": ListWriter(), "acc": ListWriter()}
+    pipeline = StreamPipeline(client, writers, lambda: True, n_writers=2, batch_mode=batch_mode)
+    pipeline.start()
+    server.sendall(bvp_lines(0, 500) + b"E4_Acc 1,0 1 2 3\r\nE4_Bvp x\r\nR device_subscribe bvp OK\r\n")
+    server.shutdown(socket.SHUT_WR)
+    pipeline.join(5.0)
+    assert writers["bvp"].rows == [[i + 0.5, i + 0.25] for i in range(500)]
+    assert writers["acc"].rows == [[1.0, 1, 2, 3]]
+    assert pipeline.metrics.rows_written == 501
+    assert pipeline.metrics.malformed_lines == 1
+    assert pipeline.metrics.dropped_chunks == 0
+
+
+def test_full_queue_drops_chunks(sockets):
+    client, server = sockets
+    release = threading.Event()
+    writers = {"bvp": ListWriter(release)}
+    pipeline = StreamPipeline(client, writers, lambda: True, queue_size=2, recv_size=64)
+    pipeline.start()
+    # The writer blocks on the first row, the reader keeps receiving
+    for i in range(20):
+        server.sendall(bvp_lines(i, 1))
+    server.shutdown(socket.SHUT_WR)
+    wait_until(lambda: pipeline.metrics.dropped_chunks > 0)
+    release.set()
+    pipeline.join(5.0)
+    assert not pipeline._reader.is_alive() and not any(thread.is_alive() for thread in pipeline._writers)
+    n_written = len(writers["bvp"].rows)
+    assert n_written + pipeline.metrics.dropped_lines == 20
+    assert pipeline.metrics.queue_high_water[0] == 2
+
+
+def test_stop_ends_reader_and_writers(sockets):
+    client, server = sockets
+    streaming = [True]
+    writers = {"bvp": ListWriter()}
+    pipeline = StreamPipeline(client, writers, lambda: streaming[0])
+    pipeline.start()
+    server.sendall(bvp_lines(0, 10))
+    wait_until(lambda: pipeline.metrics.rows_written == 10)
+    streaming[0] = False
+    pipeline.join(5.0)
+    assert not pipeline._reader.is_alive() and not any(thread.is_alive() for thread in pipeline._writers)
+    assert len(writers["bvp"].rows) == 10
+
+
+def test_connection_lost(sockets):
+    client, server = sockets
+    lost = []
+    writers = {"bvp": ListWriter()}
+    pipeline = StreamPipeline(client, writers, lambda: True, on_connection_lost=lambda: lost.append(True))
+    pipeline.start()
+    server.sendall(bvp_lines(0, 3) + b"R connection lost to device A00000\r\n" + bvp_lines(3, 3))
+    pipeline.join(5.0)
+    assert lost == [True]
+    assert len(writers["bvp"].rows) == 3
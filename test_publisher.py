@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+# Tests of publisher.py, run with python -m pytest
+
+import time
+
+import pytest
+
+from publisher import BLOCK, FRAME, GAP, Publisher, Subscriber, decode_frame, encode_gap, encode_rows
+
+
+def wait_for_subscribers(publisher, n_subscribers = 1):
+    deadline = time.monotonic() + 5.0
+    while len(publisher.subscribers) < n_subscribers:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def publisher():
+    publisher = Publisher("tcp:127.0.0.1:0")
+    publisher.start()
+    yield publisher
+    publisher.stop(drain=0)
+
+
+def test_rows_round_trip():
+    frame = encode_rows(7, "A00000", "acc", [[1.5, 1, -2, 64], [1.53125, 3, 4, -64]])
+    decoded = decode_frame(frame[:FRAME.size], frame[FRAME.size:])
+    assert (decoded.kind, decoded.sequence, decoded.device, decoded.stream) == (BLOCK, 7, "A00000", "acc")
+    assert decoded.timestamps == [1.5, 1.53125]
+    assert decoded.values == [[1, -2, 64], [3, 4, -64]]
+
+
+def test_block_matches_rows():
+    np = pytest.importorskip("numpy")
+    from publisher import encode_block
+    rows = [[10.0, 0.5], [10.015625, -1.25]]
+    timestamps = np.array([row[0] for row in rows])
+    values = np.array([row[1] for row in rows], dtype=np.float32)
+    assert encode_block(3, "A00000", "bvp", timestamps, values) == encode_rows(3, "A00000", "bvp", rows)
+
+
+def test_gap_round_trip():
+    frame = encode_gap(1, "A00000", "gsr", 100.25, 3.5)
+    decoded = decode_frame(frame[:FRAME.size], frame[FRAME.size:])
+    assert decoded.kind == GAP
+    assert (decoded.timestamps, decoded.values) == ([100.25], [3.5])
+
+
+def test_waiting_rows_are_sent_after_max_delay(publisher):
+    subscriber = Subscriber(publisher.address, timeout=5.0)
+    try:
+        wait_for_subscribers(publisher)
+        writer = publisher.writer("A00000", "ibi")
+        written = time.monotonic()
+        writer.writerow([1.0, 0.8])
+        frame = next(subscriber.frames())
+        assert time.monotonic() - written < writer.max_delay + 0.5
+        assert (frame.stream, frame.timestamps, frame.values) == ("ibi", [1.0], [pytest.approx(0.8)])
+    finally:
+        subscriber.close()
+
+
+def test_stop_sends_waiting_rows():
+    publisher = Publisher("tcp:127.0.0.1:0")
+    publisher.start()
+    subscriber = Subscriber(publisher.address, timeout=5.0)
+    try:
+        wait_for_subscribers(publisher)
+        writer = publisher.writer("A00000", "hr")
+        writer.max_delay = 60.0
+        writer.writerow([1.0, 60.0])
+        publisher.stop()
+        assert [frame.values for frame in subscriber.frames()] == [[60.0]]
+    finally:
+        subscriber.close()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+# Tests of ring_buffer.py, run with python -m pytest
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from ring_buffer import LiveBuffers, RingBuffer
+
+
+def test_append_wraps_around():
+    ring = RingBuffer(4)
+    for i in range(11):
+        ring.append(float(i), i * 0.5)
+        timestamps, values = ring.last(4)
+        expected = np.arange(max(0, i - 3), i + 1, dtype=np.float64)
+        assert np.array_equal(timestamps, expected)
+        assert np.array_equal(values, expected * 0.5)
+    assert ring.count == 11
+
+
+def test_extend_wraps_around_and_matches_append():
+    appended = RingBuffer(5, 3, np.int16)
+    extended = RingBuffer(5, 3, np.int16)
+    timestamps = np.arange(23, dtype=np.float64)
+    values = np.arange(69, dtype=np.int16).reshape(23, 3)
+    for timestamp, row in zip(timestamps, values):
+        appended.append(timestamp, row)
+    # Blocks that cross the end of the buffer, and one longer than the buffer
+    for start, end in [(0, 3), (3, 7), (7, 8), (8, 21), (21, 23)]:
+        extended.extend(timestamps[start:end], values[start:end])
+        assert np.array_equal(extended.last(5)[0], timestamps[max(0, end - 5):end])
+    assert extended.count == appended.count == 23
+    for ring in (appended, extended):
+        last_timestamps, last_values = ring.last(5)
+        assert np.array_equal(last_timestamps, timestamps[-5:])
+        assert np.array_equal(last_values, values[-5:])
+
+
+def test_last_returns_views():
+    ring = RingBuffer(4)
+    ring.extend(np.arange(6, dtype=np.float64), np.ones(6, dtype=np.float32))
+    timestamps, values = ring.last(3)
+    assert np.shares_memory(timestamps, ring._timestamps) and np.shares_memory(values, ring._values)
+    assert timestamps.tolist() == [3.0, 4.0, 5.0]
+    assert len(RingBuffer(4).last(3)[0]) == 0
+
+
+def test_latest_seconds_after_wraparound():
+    ring = RingBuffer(8)
+    ring.extend(np.arange(20) / 4.0, np.arange(20, dtype=np.float32))
+    timestamps, values = ring.latest(1.0)
+    assert timestamps.tolist() == [3.75, 4.0, 4.25, 4.5, 4.75]
+    assert values.tolist() == [15, 16, 17, 18, 19]
+    # Never more than the capacity
+    assert len(ring.latest(100.0)[0]) == 8
+
+
+def test_live_buffers_receive_rows_and_blocks():
+    buffers = LiveBuffers(seconds=1, streams=["acc", "gsr"])
+    for i in range(100):
+        buffers.writers["acc"].writerow([i / 32.0, i, -i, 1])
+    buffers.writers["gsr"].write_block(np.arange(10) / 4.0, np.full(10, 0.25, dtype=np.float32))
+    timestamps, values = buffers.latest("acc", 0.5)
+    assert timestamps.tolist() == [i / 32.0 for i in range(83, 100)]
+    assert values.tolist() == [[i, -i, 1] for i in range(83, 100)]
+    # Limited to the seconds given to LiveBuffers
+    assert buffers.latest("gsr", 10)[0].tolist() == [1.25, 1.5, 1.75, 2.0, 2.25]
+    assert buffers.count("acc") == 100
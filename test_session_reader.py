@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+# Tests of session_reader.py, run with python -m pytest
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from session_reader import build_manifest, read_index, read_manifest, read_range
+from storage import Storage
+
+
+BACKENDS = ["csv", "csvz", "npz"]
+
+
+def samples(seconds, rate, start = 1000.0):
+    timestamps = start + np.arange(int(seconds * rate)) / rate
+    acc = (np.arange(len(timestamps) * 3) % 100 - 50).astype(np.int16).reshape(-1, 3)
+    bvp = np.sin(np.arange(len(timestamps)) / 10.0).astype(np.float32)
+    return timestamps, acc, bvp
+
+
+def record(directory, backend, seconds = 60, rate = 32, block = 100, **options):
+    # Write acc and bvp in blocks and tmp row by row, with a gap half way
+    timestamps, acc, bvp = samples(seconds, rate)
+    storage = Storage(directory, ["acc", "bvp", "tmp"], backend, flush_rows=256, **options)
+    gap_at = len(timestamps) // 2 // block * block
+    try:
+        for i in range(0, len(timestamps), block):
+            if i == gap_at:
+                for writer in storage.writers.values():
+                    writer.write_gap(float(timestamps[i]), 1.5)
+            storage.writers["acc"].write_block(timestamps[i:i + block], acc[i:i + block])
+            storage.writers["bvp"].write_block(timestamps[i:i + block], bvp[i:i + block])
+            storage.writers["tmp"].writerow([float(timestamps[i]), 33.25])
+    finally:
+        storage.close()
+    return timestamps, acc, bvp
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_round_trip(tmp_path, backend):
+    timestamps, acc, bvp = record(tmp_path, backend, block=100)
+    read_timestamps, read_acc = read_range(tmp_path, "acc")
+    assert np.array_equal(read_timestamps, timestamps)
+    assert np.array_equal(read_acc, acc)
+    read_timestamps, read_bvp = read_range(tmp_path, "bvp")
+    assert np.array_equal(read_timestamps, timestamps)
+    assert np.array_equal(read_bvp, bvp)
+    read_timestamps, read_tmp = read_range(tmp_path, "tmp")
+    assert np.array_equal(read_timestamps, timestamps[::100])
+    assert read_tmp.tolist() == [33.25] * len(read_timestamps)
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_read_range(tmp_path, backend):
+    timestamps, acc, _ = record(tmp_path, backend, index_interval=5.0)
+    start, end = 1012.3, 1041.7
+    keep = (timestamps >= start) & (timestamps < end)
+    read_timestamps, read_acc = read_range(tmp_path, "acc", start, end)
+    assert np.array_equal(read_timestamps, timestamps[keep])
+    assert np.array_equal(read_acc, acc[keep])
+    assert len(read_range(tmp_path, "acc", 2000.0)[0]) == 0
+
+
+def test_index_entries(tmp_path):
+    timestamps, _, _ = record(tmp_path, "csv", block=32, index_interval=10.0)
+    index_timestamps, positions, index_samples = read_index(tmp_path, "bvp")
+    # One entry every 10 seconds of data and one after the gap at 30 seconds
+    assert index_timestamps == [1000.0, 1010.0, 1020.0, 1030.0, 1040.0, 1050.0]
+    assert index_samples == [int((t - 1000.0) * 32) for t in index_timestamps]
+    with open(tmp_path.joinpath("bvp_data.csv"), "rb") as f:
+        data = f.read()
+    for timestamp, position in zip(index_timestamps, positions):
+        assert data[position:].startswith(repr(timestamp).encode() + b",")
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_manifest(tmp_path, backend):
+    timestamps, _, _ = record(tmp_path, backend)
+    manifest = read_manifest(tmp_path)
+    assert manifest["backend"] == backend
+    assert manifest["complete"]
+    assert manifest["streams"]["acc"] == {"samples": len(timestamps), "first": timestamps[0],
+                                          "last": timestamps[-1], "gaps": 1}
+    # Scanning the files gives the same streams
+    assert build_manifest(tmp_path)["streams"] == manifest["streams"]
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+# Tests of storage.py, run with python -m pytest
+
+import csv
+import threading
+import time
+
+import pytest
+
+from storage import CSV_HEADERS, Storage, load_npz
+
+
+def wait_until(predicate, timeout = 5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def csv_rows(path):
+    with open(path, newline="") as f:
+        return list(csv.reader(f))
+
+
+def test_csv_rows_blocks_and_gaps(tmp_path):
+    np = pytest.importorskip("numpy")
+    storage = Storage(tmp_path, ["acc"])
+    writer = storage.writers["acc"]
+    writer.writerow([1.0, 1, 2, 3])
+    writer.write_gap(1.0, 2.5)
+    writer.write_block(np.array([4.0, 4.5]), np.array([[4, 5, 6], [-7, 8, 9]], dtype=np.int16))
+    storage.close()
+    assert csv_rows(tmp_path.joinpath("acc_data.csv")) == [CSV_HEADERS["acc"], ["1.0", "1", "2", "3"],
+                                                           ["#gap", "1.0", "2.5"], ["4.0", "4", "5", "6"],
+                                                           ["4.5", "-7", "8", "9"]]
+
+
+def test_npz_rows_and_blocks_keep_order(tmp_path):
+    np = pytest.importorskip("numpy")
+    storage = Storage(tmp_path, ["bvp"], "npz", flush_rows=3)
+    writer = storage.writers["bvp"]
+    writer.writerows([[1.0, 0.5], [2.0, 1.5]])
+    writer.write_block(np.array([3.0, 4.0]), np.array([2.5, 3.5], dtype=np.float32))
+    writer.writerow([5.0, 4.5])
+    writer.write_gap(5.0, 1.0)
+    writer.writerow([7.0, 5.5])
+    storage.close()
+    columns = load_npz(tmp_path, "bvp")
+    assert columns["timestamp"].tolist() == [1.0, 2.0, 3.0, 4.0, 5.0, 7.0]
+    assert columns["BVP"].tolist() == [0.5, 1.5, 2.5, 3.5, 4.5, 5.5]
+    assert csv_rows(tmp_path.joinpath("bvp_gaps.csv")) == [["lost_at", "duration"], ["5.0", "1.0"]]
+
+
+def test_npz_segments_roll_by_size_only(tmp_path):
+    np = pytest.importorskip("numpy")
+    # Every write is flushed on time, but only full segments start a new file
+    storage = Storage(tmp_path, ["bvp"], "npz", flush_interval=0.0, segment_rows=1000)
+    timestamps = np.arange(2500) / 64.0
+    for start in range(0, 2500, 50):
+        storage.writers["bvp"].write_block(timestamps[start:start + 50],
+                                           np.ones(50, dtype=np.float32))
+        # The open segment is always readable
+        assert len(load_npz(tmp_path, "bvp")["timestamp"]) == start + 50
+    storage.close()
+    assert len(list(tmp_path.glob("bvp_data.*.npz"))) == 3
+    assert not list(tmp_path.glob("*.tmp"))
+    assert np.array_equal(load_npz(tmp_path, "bvp")["timestamp"], timestamps)
+
+
+@pytest.mark.parametrize("backend", ["csv", "npz", "csvz"])
+def test_idle_stream_is_flushed_on_time(tmp_path, backend):
+    if backend == "npz":
+        pytest.importorskip("numpy")
+    storage = Storage(tmp_path, ["hr"], backend, flush_interval=0.05)
+    try:
+        storage.writers["hr"].writerow([1.0, 60.0])
+        if backend == "csv":
+            wait_until(lambda: csv_rows(tmp_path.joinpath("hr_data.csv"))[1:] == [["1.0", "60.0"]])
+        elif backend == "npz":
+            wait_until(lambda: list(tmp_path.glob("hr_data.*.npz")))
+            assert load_npz(tmp_path, "hr")["HR"].tolist() == [60.0]
+        else:
+            from compression import read_compressed
+            wait_until(lambda: read_compressed(tmp_path.joinpath("hr_data.csvz")).endswith("1.0,60.0\r\n"))
+    finally:
+        storage.close()
+
+
+@pytest.mark.parametrize("backend", ["csv", "npz", "csvz"])
+def test_writes_during_timed_flushes(tmp_path, backend):
+    np = pytest.importorskip("numpy")
+    from session_reader import read_range
+    storage = Storage(tmp_path, ["bvp"], backend, flush_interval=0.001, flush_rows=64)
+    n_rows = 20000
+
+    def write():
+        for i in range(n_rows):
+            storage.writers["bvp"].writerow([float(i), 0.5])
+
+    thread = threading.Thread(target=write)
+    thread.start()
+    thread.join()
+    storage.close()
+    timestamps, _ = read_range(tmp_path, "bvp")
+    assert np.array_equal(timestamps, np.arange(n_rows, dtype=np.float64))
+
+
+def test_fsync_policy(tmp_path):
+    storage = Storage(tmp_path, ["gsr"], fsync_interval=0.0, index_interval=None)
+    storage.writers["gsr"].writerow([1.0, 0.25])
+    storage.flush()
+    stats = storage.stats()["gsr"]
+    storage.close()
+    assert stats["fsyncs"] >= 1
+    assert stats["bytes_written"] == len("timestamp,GSR\r\n1.0,0.25\r\n")
+
+
+@pytest.mark.parametrize("backend", ["csv", "npz", "csvz"])
+def test_append_after_a_crash(tmp_path, backend):
+    np = pytest.importorskip("numpy")
+    from session_reader import read_manifest, read_range
+    storage = Storage(tmp_path, ["bvp"], backend, index_interval=1.0)
+    storage.writers["bvp"].write_block(np.arange(100) / 10.0, np.ones(100, dtype=np.float32))
+    storage.close()
+    # A row or frame cut off by a killed process
+    if backend == "csv":
+        with open(tmp_path.joinpath("bvp_data.csv"), "a") as f:
+            f.write("10.0,0.")
+    elif backend == "csvz":
+        from compression import encode_frame
+        with open(tmp_path.joinpath("bvp_data.csvz"), "ab") as f:
+            f.write(encode_frame(b"10.0,0.5\r\n")[:-3])
+
+    storage = Storage(tmp_path, ["bvp"], backend, index_interval=1.0, append=True)
+    storage.writers["bvp"].write_gap(9.9, 5.0)
+    storage.writers["bvp"].write_block(15.0 + np.arange(100) / 10.0, np.zeros(100, dtype=np.float32))
+    storage.close()
+    timestamps, values = read_range(tmp_path, "bvp")
+    assert np.array_equal(timestamps, np.concatenate([np.arange(100) / 10.0, 15.0 + np.arange(100) / 10.0]))
+    assert values.tolist() == [1.0] * 100 + [0.0] * 100
+    # The index of the new rows points into the appended part
+    assert read_range(tmp_path, "bvp", 20.0, 20.25)[0].tolist() == [20.0, 20.1, 20.2]
+    manifest = read_manifest(tmp_path)["streams"]["bvp"]
+    assert (manifest["samples"], manifest["first"], manifest["last"], manifest["gaps"]) == (200, 0.0, 24.9, 1)
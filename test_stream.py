@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+# Tests of reconnecting in stream.py against mock_server.py, run with python -m pytest
+
+import csv
+import socket
+import threading
+import time
+
+import pytest
+
+import mock_server
+import stream
+
+
+def free_port():
+    # A port nothing listens on
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+@pytest.fixture
+def recorder(monkeypatch, tmp_path):
+    # stream.py settings for recording acc only, into tmp_path/data
+    monkeypatch.chdir(tmp_path)
+    for name, value in [("STREAMING", True), ("DEVICE_ID", "A00000"), ("GAPS", []), ("RECONNECT_COUNT", 0),
+                        ("ACC", True), ("BVP", False), ("GSR", False), ("IBI", False), ("TMP", False),
+                        ("SUBJECT_ID", "test"), ("METRICS_INTERVAL", 0), ("RECONNECT_INITIAL_DELAY", 0.05),
+                        ("RECONNECT_TIMEOUT", 5.0)]:
+        monkeypatch.setattr(stream, name, value, raising=False)
+    yield stream
+    # stream() and stream_pipelined() close the files, forget them and the socket
+    vars(stream).pop("STORAGE", None)
+    s = vars(stream).pop("s", None)
+    if s is not None:
+        s.close()
+
+
+def test_backoff_doubles_up_to_the_maximum(recorder, monkeypatch):
+    monkeypatch.setattr(stream, "PORT", free_port())
+    monkeypatch.setattr(stream, "RECONNECT_MAX_DELAY", 0.2)
+    monkeypatch.setattr(stream, "RECONNECT_TIMEOUT", 1.0)
+    delays = []
+
+    def wait(seconds):
+        delays.append(seconds)
+        time.sleep(seconds)
+        return True
+
+    monkeypatch.setattr(stream, "wait_while_streaming", wait)
+    started = time.monotonic()
+    assert not stream.reconnect()
+    assert time.monotonic() - started < 1.5
+    assert delays[:4] == [0.05, 0.1, 0.2, 0.2]
+    assert sum(delays) <= 1.0
+
+
+def test_stopping_ends_the_backoff(recorder, monkeypatch):
+    monkeypatch.setattr(stream, "PORT", free_port())
+    monkeypatch.setattr(stream, "RECONNECT_INITIAL_DELAY", 30.0)
+    monkeypatch.setattr(stream, "RECONNECT_TIMEOUT", 60.0)
+    threading.Timer(0.2, setattr, (stream, "STREAMING", False)).start()
+    started = time.monotonic()
+    assert not stream.reconnect()
+    assert time.monotonic() - started < 1.0
+
+
+def test_connect_timeout_is_set_before_connecting(recorder, monkeypatch):
+    timeouts = []
+
+    class Socket(socket.socket):
+        def connect(self, address):
+            timeouts.append(self.gettimeout())
+            raise ConnectionRefusedError()
+
+    monkeypatch.setattr(stream.socket, "socket", Socket)
+    assert not stream.connect_server(stream.CONNECT_TIMEOUT)
+    stream.s.close()
+    assert timeouts == [stream.CONNECT_TIMEOUT]
+
+
+@pytest.mark.parametrize("pipelined", [False, True])
+def test_lost_connections_are_written_as_gaps(recorder, monkeypatch, tmp_path, pipelined):
+    server = mock_server.MockE4Server(mock_server.parse_args(["--rate-scale", "4", "--lose-after", "0.3"]), port=0)
+    server.start()
+    try:
+        monkeypatch.setattr(stream, "HOST", "127.0.0.1")
+        monkeypatch.setattr(stream, "PORT", server.server_address[1])
+        assert stream.connect_server()
+        assert stream.connect_device(server.devices[0])
+        assert stream.setup_subscribers()
+        assert stream.setup_files()
+        thread = threading.Thread(target=stream.stream_pipelined if pipelined else stream.stream)
+        thread.start()
+        deadline = time.monotonic() + 5.0
+        while len(stream.GAPS) < 2:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+        stream.STREAMING = False
+        thread.join(5.0)
+        assert not thread.is_alive()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert stream.RECONNECT_COUNT >= 2
+    with open(tmp_path.joinpath("data", "Empatica_E4_test", "acc_data.csv"), newline="") as f:
+        rows = list(csv.reader(f))[1:]
+    gaps = [i for i, row in enumerate(rows) if row[0] == "#gap"]
+    assert [(float(rows[i][1]), float(rows[i][2])) for i in gaps] == stream.GAPS[:len(gaps)]
+    assert len(gaps) >= 2
+    # Samples before the first gap, between the gaps and after the last one
+    assert 0 < gaps[0] and gaps[0] + 1 < gaps[1]
+    for i in gaps:
+        # A gap lies between the last sample before it and the first one after it
+        before = float(rows[i - 1][0])
+        after = [float(row[0]) for row in rows[i + 1:] if row[0] != "#gap"]
+        assert before <= float(rows[i][1])
+        if after:
+            assert after[0] >= before
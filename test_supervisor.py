@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+# Tests of supervisor.py against mock_server.py, run with python -m pytest
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import mock_server
+import supervisor
+from session_reader import read_range
+from storage import Storage
+from supervisor import SharedRing, Supervisor, _Worker
+
+
+def wait_until(predicate, timeout = 10.0, poll = None):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        if poll is not None:
+            poll(0.05)
+        else:
+            time.sleep(0.01)
+
+
+@pytest.fixture
+def ring():
+    ring = SharedRing(1024)
+    yield ring
+    ring.close(unlink=True)
+
+
+def test_ring_round_trip(ring):
+    timestamps = np.array([1.0, 1.03125])
+    values = np.array([[1, -2, 3], [4, 5, -6]], dtype=np.int16)
+    offset = ring.put_block("acc", timestamps, values)
+    # A worker attaches to the ring by name
+    reader = SharedRing(name=ring.name)
+    try:
+        block = reader.block("acc", offset, 2, copy=True)
+    finally:
+        reader.close()
+    assert np.array_equal(block[0], timestamps)
+    assert np.array_equal(block[1], values)
+
+
+def test_ring_full_and_wraparound(ring):
+    values = np.ones(40, dtype=np.float32)
+    # 40 samples take 480 bytes, the third block does not fit
+    first = ring.put_block("bvp", np.arange(40.0), values)
+    second = ring.put_block("bvp", np.arange(40.0, 80.0), values)
+    assert ring.put_block("bvp", np.arange(80.0, 120.0), values) is None
+    ring.release(480)
+    # Blocks are never split, the next one starts at the beginning again
+    third = ring.put_block("bvp", np.arange(80.0, 120.0), values)
+    assert third == first
+    assert ring.head == 1024 + 480
+    assert ring.block("bvp", second, 40)[0].tolist() == list(range(40, 80))
+    assert ring.block("bvp", third, 40)[0].tolist() == list(range(80, 120))
+
+
+class Messages(list):
+    # The pipe to the parent
+    send = list.append
+
+
+def bvp_lines(start, n):
+    return ["E4_Bvp %d,5 %d,25" % (i, i) for i in range(start, start + n)]
+
+
+def test_gap_only_after_the_first_data(tmp_path, monkeypatch):
+    monkeypatch.setattr(supervisor, "RECONNECT_INITIAL_DELAY", 0.01)
+    monkeypatch.setattr(supervisor, "RECONNECT_TIMEOUT", 0.2)
+    storage = Storage(tmp_path, ["bvp"])
+    messages = Messages()
+    worker = _Worker(0, 1, ["A00000"], {"A00000": storage}, None, messages, threading.Event(), ["bvp"],
+                     "127.0.0.1", 0, {})
+    sessions = []
+
+    async def session(device_id, on_streaming):
+        sessions.append(device_id)
+        if len(sessions) == 1 or len(sessions) > 4:
+            raise ConnectionRefusedError("refused")
+        on_streaming()
+        if len(sessions) == 3:
+            worker.put(device_id, time.monotonic_ns(), 0, bvp_lines(0, 3))
+
+    monkeypatch.setattr(worker, "session", session)
+    # Refused, lost before any data, lost after data, streaming again, refused until the timeout
+    asyncio.run(worker.record("A00000"))
+    storage.close()
+    gaps = [message[3:] for message in messages if message[0] == "gap"]
+    assert len(gaps) == 1 and gaps[0][0] == "A00000"
+    with open(tmp_path.joinpath("bvp_data.csv")) as f:
+        assert [line.split(",")[0] for line in f.read().splitlines()] == ["timestamp", "0.5", "1.5", "2.5", "#gap"]
+    assert worker.states["A00000"] == "failed"
+
+
+@pytest.fixture
+def server():
+    server = mock_server.MockE4Server(mock_server.parse_args(["--devices", "2", "--rate-scale", "4"]), port=0)
+    server.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def start_supervisor(server, tmp_path):
+    pool = Supervisor("test", server.devices, 2, ["bvp"], port=server.server_address[1], host="127.0.0.1",
+                      data_dir=tmp_path, flush_interval=0.1)
+    pool.start()
+    return pool
+
+
+def stored_samples(tmp_path, device_id):
+    return len(read_range(tmp_path.joinpath("Empatica_E4_test", device_id), "bvp")[0])
+
+
+def test_workers_write_their_devices(server, tmp_path):
+    pool = start_supervisor(server, tmp_path)
+    try:
+        wait_until(lambda: all(pool.metrics.device(device_id).samples.get("bvp", 0) > 100
+                               for device_id in server.devices), poll=pool.poll)
+    finally:
+        pool.stop()
+    assert set(pool.health().values()) == {"streaming"}
+    for device_id in server.devices:
+        assert stored_samples(tmp_path, device_id) == pool.metrics.devices[device_id].samples["bvp"]
+        assert pool.metrics.devices[device_id].writer_lag_seconds.count > 0
+        assert not list(tmp_path.joinpath("Empatica_E4_test", device_id).glob("bvp_gaps.csv"))
+
+
+def test_killed_worker_is_restarted_and_appends(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(supervisor, "RESTART_DELAY", 0.0)
+    pool = start_supervisor(server, tmp_path)
+    try:
+        device_metrics = pool.metrics.device(server.devices[0])
+        wait_until(lambda: device_metrics.samples.get("bvp", 0) > 100, poll=pool.poll)
+        worker = pool.workers[0]
+        worker.process.kill()
+        worker.process.join()
+        before = device_metrics.samples["bvp"]
+        wait_until(lambda: worker.generation == 2 and device_metrics.samples["bvp"] > before + 100,
+                   poll=lambda timeout: (pool.poll(timeout), pool.check_workers()))
+    finally:
+        pool.stop()
+    timestamps = read_range(tmp_path.joinpath("Empatica_E4_test", server.devices[0]), "bvp")[0]
+    # Rows written by the killed worker may be lost, the rest is kept in order
+    assert before // 2 < len(timestamps) <= device_metrics.samples["bvp"]
+    assert np.all(np.diff(timestamps) > 0)
+    with open(tmp_path.joinpath("Empatica_E4_test", server.devices[0], "bvp_gaps.csv")) as f:
+        assert len(f.readlines()) == 2
+    assert device_metrics.reconnects == 1
+
+
+def test_blocks_are_published_through_the_ring(server, tmp_path):
+    from publisher import Publisher, Subscriber
+    publisher = Publisher("tcp:127.0.0.1:0")
+    publisher.start()
+    subscriber = Subscriber(publisher.address, timeout=5.0)
+    pool = Supervisor("test", server.devices[:1], 1, ["bvp"], port=server.server_address[1], host="127.0.0.1",
+                      data_dir=tmp_path, publisher=publisher)
+    try:
+        wait_until(lambda: publisher.subscribers)
+        pool.start()
+        # The parent publishes while it handles the messages of the workers
+        running = threading.Thread(target=pool.run, args=(1.0,))
+        running.start()
+        frame = next(subscriber.frames())
+        assert (frame.device, frame.stream) == (server.devices[0], "bvp") and len(frame.timestamps) > 0
+        running.join()
+    finally:
+        pool.stop()
+        subscriber.close()
+        publisher.stop(drain=0)
+    assert pool.workers[0].ring is None